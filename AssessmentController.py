@@ -12,6 +12,9 @@ from DAL import *
 from RFIDReader import *
 from StateModel import *
 from Counters import *
+from Prefetcher import *
+from Cursor import *
+from Startup import *
 
 INITIAL_SCREEN = 0
 WELCOME = 1
@@ -29,7 +32,21 @@ class AssessmentController:
         Configures all state transitions and initializes data access layer. Sets up the
         state machine with transitions between INITIAL_SCREEN, WELCOME, FAILED_AUTH,
         PATIENT_SELECT, and DISPLAY_ASSESMENT states.
+
+        Wi-Fi association is started first and completes while the hardware is
+        set up; then the connection to the backend is opened (including the TLS
+        handshake) so the first badge scan finds it ready, and the clock is set
+        from SNTP. The time-to-ready of each boot phase is logged and kept in
+        self._boottimes.
         """
+        boot = BootTimer()
+        boot.start('dal')
+        self._dal = DAL()
+        boot.ready('dal')
+        boot.start('wifi')
+        wifistarted = self._dal.startNetwork()
+
+        boot.start('hardware')
         self._rfid = RFIDReader(mosi=5, miso=6, sck=4, sda=7)
         self._lightstrip = LightStrip(pin=2, name='Lights')
         self._buzzer = PassiveBuzzer(pin=14, name='Buzz')
@@ -49,17 +66,33 @@ class AssessmentController:
 
         self._timer = SoftwareTimer(name="timer", handler=None)
         self._model.addTimer(self._timer)
+        boot.ready('hardware')
 
+        wifiup = wifistarted and self._dal.waitNetwork()
+        boot.ready('wifi', wifiup)
+        if wifiup:
+            boot.start('tls')
+            boot.ready('tls', self._dal.warmup())
+            boot.start('clock')
+            boot.ready('clock', self._dal.syncClock())
+        self._boottimes = boot.report()
+
+        self._state = None
         self._rfidtag = None
         self._provider = None
         self._patients = []
         self._assessments = []
         self._patindex = 0
         self._assessindex = 0
-        self._dal = DAL()
+        self._prefetcher = Prefetcher(self._dal)
+        self._dal.setLinkHandler(self.linkEvent)
+        self._dal.setBadgeHandler(self.badgeRevoked)
+        self._newassessments = []
+        self._dal.setAssessmentHandler(self.assessmentsArrived)
 
         self._model.addCustomEvent('ok_card')
         self._model.addCustomEvent('failed_card')
+        self._model.addCustomEvent('new_assessment')
         
         self._model.addTransition(INITIAL_SCREEN, ["ok_card"], WELCOME)
         self._model.addTransition(INITIAL_SCREEN, ["timer_timeout"], FAILED_AUTH)
@@ -81,9 +114,71 @@ class AssessmentController:
         scan their RFID employee badge for authentication.
         """
         self._display.clear()
+        if not self._dal.isOnline():
+            self._display.showText('Network down,', 0)
+            self._display.showText('reconnecting...', 1)
+            return
         self._display.showText('Please scan your', 0)
         self._display.showText('employee badge', 1)
 
+    def linkEvent(self, event):
+        """
+        Called by the DAL when Wi-Fi goes down ('link_down') or comes back
+        ('link_up'). The idle screen says when the network is down, and the
+        light strip flashes red or green so the provider sees the change in
+        any state.
+        """
+        self._lightstrip.setColor(GREEN if event == 'link_up' else RED, 8)
+        time.sleep(0.2)
+        self._lightstrip.off()
+        if self._state == INITIAL_SCREEN and self._rfidtag is None:
+            self.showInitialScreen()
+            self._lightstrip.setColor(YELLOW, 8)
+
+    def badgeRevoked(self, card_code):
+        """
+        Called by the DAL when the backend says a badge that was let in from
+        the badge cache is no longer active. If it is the badge logged in
+        now, the provider is logged out with the access denied screen.
+        """
+        if card_code == self._rfidtag and self._state not in (INITIAL_SCREEN, FAILED_AUTH):
+            self._dal.stopNotifications()
+            self._model.gotoState(FAILED_AUTH, 'badge_revoked')
+
+    def assessmentsArrived(self, assessments):
+        """
+        Called by the DAL with the assessments recorded for the provider's
+        patients since the last call, while the provider is logged in.
+        They are passed to the state model as a new_assessment event.
+        """
+        self._newassessments = assessments
+        self._model.processEvent('new_assessment')
+
+    def showNewAssessments(self, state):
+        """
+        Tell the provider new assessments have come in: a red flash and the
+        alarm tones if any of them is UNHEALTHY, a green flash otherwise. If
+        one is for the patient whose assessments are on screen, the list is
+        reloaded to show it.
+        """
+        unhealthy = [a for a in self._newassessments if a._result == 'UNHEALTHY']
+        if unhealthy:
+            self._lightstrip.setColor(RED, 8)
+            self._buzzer.beep(1200, 200)
+            time.sleep(0.05)
+            self._buzzer.beep(900, 200)
+        else:
+            self._lightstrip.setColor(GREEN, 8)
+            self._buzzer.beep(tones['E5'], 100)
+        time.sleep(0.2)
+        self._lightstrip.off()
+        if state == DISPLAY_ASSESMENT and self._patients and self._patindex < len(self._patients):
+            patient_id = self._patients[self._patindex]._patient_id
+            if any(a._patient_id == patient_id for a in self._newassessments):
+                self._model.gotoState(DISPLAY_ASSESMENT, 'new_assessment')
+        self._newassessments = []
+        return True
+
     def showWelcome(self, provider):
         """
         Display a welcome message for the authenticated provider.
@@ -176,7 +271,7 @@ class AssessmentController:
         """
         Handle actions when entering a new state in the state machine.
         
-        Performs state-specific initialization tasks such as posting assessments,
+        Performs state-specific initialization tasks such as requesting new assessments,
         displaying appropriate screens, setting light colors, starting timers,
         and loading data from the data access layer.
         
@@ -186,8 +281,12 @@ class AssessmentController:
             event (str): The event that triggered the state transition.
         """
         Log.d(f'State {state} entered on event {event}')
+        self._state = state
         if state == INITIAL_SCREEN:
-            self._dal.postAssessments()
+            # Generated in the background from stateDo once a provider has
+            # logged in, rate limited by the DAL
+            self._dal.requestAssessments()
+            self._dal.stopNotifications()
             self.showInitialScreen()
             self._rfidtag = None
             self._lightstrip.setColor(YELLOW, 8)
@@ -195,6 +294,9 @@ class AssessmentController:
         elif state == WELCOME:
             self.showWelcome(self._provider)
             self._lightstrip.setColor(GREEN, 8)
+            self._dal.startNotifications(self._provider['_provider_id'])
+            # Where the time of the badge login went
+            self._dal.logTimings()
             self._timer.start(5)
         elif state == FAILED_AUTH:
             self.showFailedAuth()
@@ -208,6 +310,7 @@ class AssessmentController:
             except:
                 pass
             self.showPatientSelect()
+            self.schedulePrefetch()
         elif state == DISPLAY_ASSESMENT:
             if self._patients and self._patindex < len(self._patients):
                 try:
@@ -231,12 +334,49 @@ class AssessmentController:
                         (INITIAL_SCREEN, WELCOME, FAILED_AUTH, PATIENT_SELECT, or DISPLAY_ASSESMENT).
             event (str): The event that triggered the state transition.
         """
+        if state == PATIENT_SELECT:
+            self._prefetcher.cancel()
         if state == DISPLAY_ASSESMENT:
             if self._timer._started:
                 self._timer.cancel()
             self._alarmon = False
             self._buzzer.stop()
 
+    def hasRow(self, rows, index):
+        """
+        Check whether a patient or assessment list has an entry at index.
+        Lists from the DAL are loaded a page at a time, so this loads the
+        page holding index if needed, and asks for the page after it to be
+        prefetched once index gets close to the end of what is loaded.
+        """
+        if isinstance(rows, PagedCursor):
+            try:
+                rows.ensure(index)
+            except Exception as e:
+                Log.e(f'Could not load more rows: {e}')
+            rows.prefetch(index)
+        return index < len(rows)
+
+    def pollRows(self, rows):
+        """ Load a page of a patient or assessment list asked for by hasRow """
+        if isinstance(rows, PagedCursor):
+            rows.poll()
+
+    def schedulePrefetch(self):
+        """
+        Queue the assessments of the patient on screen and the patients on
+        either side of it for prefetching while the provider is idle.
+        """
+        if not self._patients:
+            self._prefetcher.cancel()
+            return
+        patient_ids = [self._patients[self._patindex]._patient_id]
+        if self.hasRow(self._patients, self._patindex + 1):
+            patient_ids.append(self._patients[self._patindex + 1]._patient_id)
+        if self._patindex > 0:
+            patient_ids.append(self._patients[self._patindex - 1]._patient_id)
+        self._prefetcher.schedule(patient_ids)
+
     def stateEvent(self, state, event)->bool:
         """
         Handle events that occur within a specific state.
@@ -244,7 +384,8 @@ class AssessmentController:
         Processes button press events (left_press, right_press, select_press) and
         performs appropriate actions such as navigating through patients/assessments
         or marking assessments as reviewed. Provides visual and audio feedback
-        for user actions.
+        for user actions. A new_assessment event, in any state, announces
+        the assessments that have just come in.
         
         Args:
             state (int): The current state constant (PATIENT_SELECT or DISPLAY_ASSESMENT).
@@ -254,11 +395,14 @@ class AssessmentController:
         Returns:
             bool: True if the event was handled, False otherwise.
         """
+        if event == 'new_assessment':
+            return self.showNewAssessments(state)
         if state == PATIENT_SELECT:
             if event == "left_press":
                 if self._patients and self._patindex > 0:
                     self._patindex -= 1
                     self.showPatientSelect()
+                    self.schedulePrefetch()
                     self._buzzer.beep(tones['C5'], 200)
                     self._lightstrip.setColor(GREEN, 8)
                     time.sleep(0.2)
@@ -270,9 +414,10 @@ class AssessmentController:
                     self._lightstrip.off()
                 return True
             elif event == "right_press":
-                if self._patients and self._patindex < len(self._patients) - 1:
+                if self._patients and self.hasRow(self._patients, self._patindex + 1):
                     self._patindex += 1
                     self.showPatientSelect()
+                    self.schedulePrefetch()
                     self._buzzer.beep(tones['C5'], 200)
                     self._lightstrip.setColor(GREEN, 8)
                     time.sleep(0.2)
@@ -299,7 +444,7 @@ class AssessmentController:
                     self._lightstrip.off()
                 return True
             elif event == "right_press":
-                if self._assessments and self._assessindex < len(self._assessments) - 1:
+                if self._assessments and self.hasRow(self._assessments, self._assessindex + 1):
                     self._assessindex += 1
                     self.showAssessments()
                     self._lightstrip.setColor(GREEN, 8)
@@ -317,7 +462,9 @@ class AssessmentController:
                     currentassessment = self._assessments[self._assessindex]
                     assessment_id = currentassessment._assessment_id
                     try:
-                        self._dal.putProviderReviewed(assessment_id)
+                        # Queued and sent in the background by the DAL, so the
+                        # refresh below is served from memory
+                        self._dal.putProviderReviewed(assessment_id, currentassessment._patient_id)
                         self._lightstrip.setColor(GREEN, 8)
                         self._buzzer.beep(tones['C5'], 200)
                         time.sleep(0.2)
@@ -356,20 +503,32 @@ class AssessmentController:
                     self._timer.cancel()
                     self._lightstrip.off()
                     try:
-                        provider_id = self._dal.getRFIDTag(self._rfidtag).__dict__['_provider_id']
-                        if provider_id:
-                            self._provider = self._dal.getProvider(provider_id).__dict__
+                        # Known badges are let in from the badge cache and
+                        # checked with the backend in the background
+                        provider = self._dal.authenticateBadge(self._rfidtag)
+                        if provider:
+                            self._provider = provider.__dict__
                             self._model.processEvent('ok_card')
                         else:
                             self._model.processEvent('failed_card')
                     except:
                         self._model.processEvent('failed_card')
+            # Background requests block, so none are made on the idle
+            # screen, where they would hold up reading the next badge.
+            # They run once a provider has logged in
+            self._dal.poll(network=False)
+            return
+        self._dal.poll()
         if state == PATIENT_SELECT:
             if not self._patients and not self._timer._started:
                 self._timer.start(5)
+            if self._dal.isOnline():
+                self._prefetcher.poll()
+            self.pollRows(self._patients)
         if state == DISPLAY_ASSESMENT:
             if not self._assessments and not self._timer._started:
                 self._timer.start(5)
+            self.pollRows(self._assessments)
             if self._alarmon:
                 self.playUnhealthyAlarm()
 
@@ -0,0 +1,135 @@
+"""
+BadgeCache.py - badge to provider lookups kept on flash
+
+Logging in with a badge needs two round trips (the badge, then its
+provider) before the welcome screen can show. The BadgeCache remembers the
+provider of every active badge that has logged in, in a small file on
+flash, so a known badge is let in straight away from the local copy. The
+DAL then checks the badge with the backend in the background, and revokes
+it here if the backend no longer has it as ACTIVE.
+
+Entries expire after BADGE_TTL seconds (an expired badge has to be checked
+with the backend again before it is let in) and at most BADGE_MAX badges
+are kept; the one used least recently is dropped to make room.
+
+Basic usage:
+
+badges = BadgeCache()
+provider = badges.get('c908e41134')     # a Provider, or None if unknown/expired
+badges.put('c908e41134', rfidtag, provider)
+badges.revoke('c908e41134')
+"""
+
+import time
+import json
+from Log import *
+from modelclasses import *
+
+BADGE_FILE = 'badges.json'
+# Seconds a badge is let in from the local copy without a backend check
+BADGE_TTL = 7 * 24 * 3600
+# Most badges kept
+BADGE_MAX = 16
+
+class BadgeCache:
+    """
+    Persistent card_code -> provider cache of active badges.
+    """
+
+    def __init__(self, path=BADGE_FILE, ttl=BADGE_TTL, maxentries=BADGE_MAX):
+        self._path = path
+        self._ttl = ttl
+        self._maxentries = maxentries
+        # card_code -> dict of provider fields plus 'saved' and 'used' times
+        self._entries = {}
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._revoked = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._path) as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def _save(self):
+        try:
+            with open(self._path, 'w') as f:
+                json.dump(self._entries, f)
+        except OSError as e:
+            Log.e(f'BadgeCache: could not write {self._path}: {e}')
+
+    def get(self, card_code):
+        """
+        The Provider for a badge if it is known and has not expired, or None
+        """
+
+        entry = self._entries.get(card_code)
+        if entry is None:
+            self._misses += 1
+            return None
+        age = time.time() - entry['saved']
+        if age < 0 or age > self._ttl:
+            # Too old (or the clock has been reset) - check with the backend
+            self._expired += 1
+            return None
+        self._hits += 1
+        entry['used'] = time.time()
+        return Provider(entry['provider_id'], entry['first_name'], entry['last_name'],
+                        entry['title'], entry['specialty'])
+
+    def put(self, card_code, rfidtag, provider):
+        """
+        Remember the provider of an active badge. Badges that are not ACTIVE
+        are revoked instead.
+        """
+
+        if rfidtag._cardstatus != 'ACTIVE':
+            self.revoke(card_code)
+            return
+        now = time.time()
+        self._entries[card_code] = {
+            'provider_id': provider._provider_id,
+            'first_name': provider._firstname,
+            'last_name': provider._lastname,
+            'title': provider._title,
+            'specialty': provider._specialty,
+            'saved': now,
+            'used': now
+        }
+        while len(self._entries) > self._maxentries:
+            oldest = min(self._entries, key=lambda k: self._entries[k]['used'])
+            del self._entries[oldest]
+        self._save()
+
+    def revoke(self, card_code):
+        """ Forget a badge. Returns True if it was known """
+
+        if card_code not in self._entries:
+            return False
+        del self._entries[card_code]
+        self._revoked += 1
+        Log.i(f'BadgeCache: badge {card_code} revoked')
+        self._save()
+        return True
+
+    def has(self, card_code):
+        return card_code in self._entries
+
+    def clear(self):
+        self._entries = {}
+        self._save()
+
+    def getStats(self):
+        """ Get a dictionary with the hit/miss/expired/revoked counts and size """
+
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'expired': self._expired,
+            'revoked': self._revoked,
+            'entries': len(self._entries)
+        }
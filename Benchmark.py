@@ -0,0 +1,291 @@
+"""
+Benchmark.py - measure the network code against the stand-in server
+
+Runs on the Pico against a StandInServer on a laptop (or on the host, next
+to the server) and prints what each option costs on the wire and in time.
+
+Basic usage - on the laptop:
+
+python StandInServer.py 8080
+
+and then on the Pico:
+
+import Benchmark
+Benchmark.benchmarkCompression('http://<laptop ip>:8080/ords/c85/pihealth/')
+Benchmark.benchmarkAllocations('http://<laptop ip>:8080/ords/c85/pihealth/')
+Benchmark.benchmarkPipelining('http://<laptop ip>:8080/ords/c85/pihealth/')
+Benchmark.benchmarkOffline('http://<laptop ip>:8080/ords/c85/pihealth/')   # server stopped
+
+Pipelining only pays off when there is latency to hide, so for it start
+the server with some (python StandInServer.py 8080 0.05). On the host,
+python Benchmark.py runs them all against a stand-in server it starts in
+a child process, so the server's own allocations are not counted, with
+STAND_IN_LATENCY seconds of latency, and benchmarkOffline once it has
+stopped the server again.
+"""
+
+import time
+import gc
+from Log import *
+from Net import *
+from secrets import *
+import DAL
+
+# Requests made per URL and setting
+ROUNDS = 10
+# Seconds of latency the stand-in server adds to each response on the host
+STAND_IN_LATENCY = 0.05
+# Patients of the stand-in's provider, and assessments per patient
+STAND_IN_PATIENTS = 100
+STAND_IN_ASSESSMENTS = 100
+# Rows per page fetched by benchmarkAllocations, large enough that the
+# body, rather than the request, dominates what getJson holds
+ALLOCATION_ROWS = 100
+
+def timeRequests(net, urls, rounds):
+    """
+    Fetch every URL rounds times with getJson, closing the connections first
+    so each run starts cold. Returns the elapsed time of each fetch in ms.
+    """
+
+    net.closeConnections()
+    times = []
+    for i in range(rounds):
+        for url in urls:
+            start = time.ticks_ms()
+            if net.getJson(url) is None:
+                raise OSError(f'benchmark request for {url} failed')
+            times.append(time.ticks_diff(time.ticks_ms(), start))
+    return times
+
+def summarize(times):
+    """ Mean, median and worst of a list of timings """
+
+    ordered = sorted(times)
+    return {
+        'mean_ms': sum(ordered) / len(ordered),
+        'p50_ms': ordered[len(ordered) // 2],
+        'max_ms': ordered[-1]
+    }
+
+def allocated(fn):
+    """
+    Call fn(sample) and return (its result, the peak of the heap in use
+    over the starting point while it ran). fn calls sample() wherever its
+    memory use may peak. On the Pico sample collects the garbage and reads
+    gc.mem_alloc(), so the peak is of live objects only; on a host the
+    tracemalloc peak is used and sample does nothing.
+    """
+
+    gc.collect()
+    if hasattr(gc, 'mem_alloc'):
+        before = gc.mem_alloc()
+        peak = [0]
+        def sample():
+            gc.collect()
+            peak[0] = max(peak[0], gc.mem_alloc() - before)
+        result = fn(sample)
+        sample()
+        return result, peak[0]
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fn(lambda: None)
+    return result, tracemalloc.get_traced_memory()[1] - before
+
+def parseWhole(net, url, sample):
+    """ getJson a URL, the whole document parsed at once """
+
+    data = net.getJson(url)
+    sample()
+    return data
+
+def streamRows(net, url, sample):
+    """
+    getItems a URL and read the rows one at a time without keeping them,
+    as the DAL's cursors do. Returns the number of rows, or None on failure.
+    """
+
+    items = net.getItems(url)
+    if items is None:
+        return None
+    rows = 0
+    for item in items:
+        rows += 1
+        sample()
+    return rows
+
+def connectedNet():
+    """ A Net connected to Wi-Fi (when on the Pico) """
+
+    net = Net()
+    if not net.isConnected():
+        net.connect(SSID, PASSWORD)
+    return net
+
+def benchmarkCompression(baseurl, rounds=ROUNDS, patient_id=100, provider_id=1):
+    """
+    Fetch the patient list and the assessments of one patient with
+    compressed responses turned off and on, and print the body bytes
+    received and the time taken per request for each.
+    """
+
+    urls = [f'{baseurl}patients/{provider_id}', f'{baseurl}assessments/{patient_id}']
+    net = connectedNet()
+    results = {}
+    for compression in (False, True):
+        net.setCompression(compression)
+        before = net.getConnectionStats()['received']
+        gc.collect()
+        times = timeRequests(net, urls, rounds)
+        received = net.getConnectionStats()['received'] - before
+        result = summarize(times)
+        result['bytes_per_request'] = received // len(times)
+        results['compressed' if compression else 'plain'] = result
+        print(f"{'compressed' if compression else 'plain':>10}: {result['bytes_per_request']} bytes/request, "
+              f"mean {result['mean_ms']:.1f} ms, p50 {result['p50_ms']} ms, max {result['max_ms']} ms")
+    saved = 1 - results['compressed']['bytes_per_request'] / max(1, results['plain']['bytes_per_request'])
+    print(f'compression saved {saved * 100:.0f}% of the bytes on the wire')
+    return results
+
+def benchmarkAllocations(baseurl, rounds=ROUNDS, patient_id=100, provider_id=1, rows=ALLOCATION_ROWS):
+    """
+    Measure the peak heap in use per request (see allocated) when fetching
+    the patient list and one patient's assessments: with getJson, which
+    parses the whole body, and with getItems, whose rows are read one at a
+    time and dropped. Pages of up to rows rows are asked for. The
+    connection is opened before measuring so only the request counts.
+    """
+
+    urls = [f'{baseurl}patients/{provider_id}?limit={rows}', f'{baseurl}assessments/{patient_id}?limit={rows}']
+    net = connectedNet()
+    net.setCompression(False)
+    results = {}
+    for name, fetch in (('getJson', parseWhole), ('getItems', streamRows)):
+        for url in urls:
+            fetch(net, url, lambda: None)
+            sizes = []
+            for i in range(rounds):
+                result, size = allocated(lambda sample: fetch(net, url, sample))
+                if result is None:
+                    raise OSError(f'benchmark request for {url} failed')
+                sizes.append(size)
+            key = f"{name} {url[len(baseurl):]}"
+            results[key] = sum(sizes) // len(sizes)
+            print(f'{key:>32}: {results[key]} bytes peak heap per request')
+    return results
+
+def benchmarkPipelining(baseurl, rounds=3, provider_id=1):
+    """
+    Load the assessments of every patient of a provider, one getAssessments
+    round trip after another and with a single getAssessmentsBulk, and print
+    the time each takes. The cache is emptied before every run.
+    """
+
+    DAL.setBaseUrl(baseurl)
+    dal = DAL.DAL()
+    dal.startNetwork()
+    dal.waitNetwork()
+    patient_ids = [patient._patient_id for patient in dal.getPatients(provider_id)]
+    def serial():
+        for patient_id in patient_ids:
+            dal.prefetchAssessments(patient_id)
+        return len(patient_ids)
+    def bulk():
+        return len(dal.getAssessmentsBulk(patient_ids))
+    results = {}
+    for name, load in (('serial', serial), ('pipelined', bulk)):
+        times = []
+        for i in range(rounds):
+            dal.invalidateAssessments()
+            start = time.ticks_ms()
+            if load() != len(patient_ids):
+                raise OSError(f'{name} benchmark did not load every patient')
+            times.append(time.ticks_diff(time.ticks_ms(), start))
+        results[name] = summarize(times)
+        print(f"{name:>10}: {len(patient_ids)} patients, mean {results[name]['mean_ms']:.1f} ms, "
+              f"p50 {results[name]['p50_ms']} ms, max {results[name]['max_ms']} ms")
+    print(f"pipelining was {results['serial']['mean_ms'] / max(1, results['pipelined']['mean_ms']):.1f}x faster")
+    return results
+
+def benchmarkOffline(baseurl, rounds=3, provider_id=1, patient_id=100, card_code='c908e41134'):
+    """
+    With no server answering at baseurl (stop the stand-in first), time how
+    long each DAL getter takes to give up, and check that it comes back with
+    None or an empty list rather than raising. The cache is emptied before
+    every run, so there is no expired copy to fall back on. With rounds up
+    to the breaker threshold, every run goes to the network.
+    """
+
+    DAL.setBaseUrl(baseurl)
+    getters = (
+        ('getRFIDTag', lambda: dal.getRFIDTag(card_code), None),
+        ('getProvider', lambda: dal.getProvider(provider_id), None),
+        ('getPatients', lambda: dal.getPatients(provider_id), []),
+        ('getAssessments', lambda: dal.getAssessments(patient_id), []),
+        ('agetRFIDTag', lambda: DAL.asyncio.run(dal.agetRFIDTag(card_code)), None),
+        ('agetProvider', lambda: DAL.asyncio.run(dal.agetProvider(provider_id)), None),
+        ('agetPatients', lambda: DAL.asyncio.run(dal.agetPatients(provider_id)), []),
+        ('agetAssessments', lambda: DAL.asyncio.run(dal.agetAssessments(patient_id)), [])
+    )
+    results = {}
+    for name, get, expected in getters:
+        # A new DAL each time, so no circuit breaker is open yet
+        dal = DAL.DAL()
+        times = []
+        for i in range(rounds):
+            dal.clearCache()
+            start = time.ticks_ms()
+            result = get()
+            times.append(time.ticks_diff(time.ticks_ms(), start))
+            if result != expected:
+                raise OSError(f'{name} returned {result!r} with the server down')
+        results[name] = summarize(times)
+        print(f"{name:>16}: {expected!r} after mean {results[name]['mean_ms']:.1f} ms, "
+              f"max {results[name]['max_ms']} ms")
+    return results
+
+BENCHMARKS = {
+    'compression': benchmarkCompression,
+    'allocations': benchmarkAllocations,
+    'pipelining': benchmarkPipelining,
+    'offline': benchmarkOffline
+}
+
+if __name__ == '__main__':
+    import sys
+    names = sys.argv[2:] or list(BENCHMARKS)
+    if len(sys.argv) > 1 and sys.argv[1] != '-':
+        for name in names:
+            BENCHMARKS[name](sys.argv[1])
+    else:
+        # On the host: run against a stand-in server in a child process
+        import os
+        import socket
+        import subprocess
+        from StandInServer import BASEPATH
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'StandInServer.py'), str(port), str(STAND_IN_LATENCY),
+                                   str(STAND_IN_PATIENTS), str(STAND_IN_ASSESSMENTS)],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        baseurl = f'http://127.0.0.1:{port}{BASEPATH}'
+        try:
+            for i in range(50):
+                try:
+                    socket.create_connection(('127.0.0.1', port), 0.1).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            for name in names:
+                if name != 'offline':
+                    BENCHMARKS[name](baseurl)
+        finally:
+            server.terminate()
+            server.wait()
+        if 'offline' in names:
+            benchmarkOffline(baseurl)
@@ -0,0 +1,207 @@
+"""
+Cache.py - a small in-memory response cache for the Pico
+
+Entries expire after a per-entry time to live (TTL), and the least recently
+used entries are evicted whenever the estimated size of everything cached
+goes over a byte budget. Sizes are rough estimates of the heap used by
+the cached objects - good enough to keep the cache from eating the heap.
+Expired entries are not dropped straight away: until they are evicted they
+can still be fetched with getStale, e.g. to revalidate them with the server.
+
+Basic usage:
+
+cache = ResponseCache(budget=8192)
+cache.put('patients/1', patients, ttl=120)
+patients = cache.get('patients/1')   # None if missing or expired
+patients = cache.getStale('patients/1')   # None only if missing
+cache.expire('patients/1')      # getStale still finds it
+cache.invalidate('patients/1')
+cache.invalidatePrefix('assessments/')
+"""
+
+import time
+from Log import *
+
+# Rough per-object overhead on the MicroPython heap
+OBJECT_OVERHEAD = 16
+
+def estimateSize(obj):
+    """
+    Estimate how many bytes of heap an object uses. Handles the types that
+    come back from the REST endpoints and the model classes built from them.
+    """
+
+    if obj is None or isinstance(obj, bool):
+        return 0
+    if isinstance(obj, (int, float)):
+        return OBJECT_OVERHEAD
+    if isinstance(obj, (str, bytes, bytearray)):
+        return OBJECT_OVERHEAD + len(obj)
+    if isinstance(obj, dict):
+        size = OBJECT_OVERHEAD + 8 * len(obj)
+        for k in obj:
+            size += estimateSize(k) + estimateSize(obj[k])
+        return size
+    if isinstance(obj, (list, tuple)):
+        size = OBJECT_OVERHEAD + 4 * len(obj)
+        for item in obj:
+            size += estimateSize(item)
+        return size
+    if hasattr(obj, '__dict__'):
+        return OBJECT_OVERHEAD + estimateSize(obj.__dict__)
+    return OBJECT_OVERHEAD
+
+class ResponseCache:
+    """
+    A TTL + LRU cache with a memory budget. Keys are strings (typically the
+    endpoint URL) so whole groups of entries can be dropped by prefix.
+    """
+
+    def __init__(self, budget=8192):
+        """
+        budget is the maximum estimated size in bytes of all cached values
+        """
+
+        self._budget = budget
+        # key -> (value, size, expiry ticks). Insertion order is kept by
+        # the list below so the oldest used key is always at the front
+        self._entries = {}
+        self._order = []
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key):
+        """ Get a cached value, or None if it is missing or has expired """
+
+        entry = self._entries.get(key)
+        if entry is None:
+            self._misses += 1
+            return None
+        value, size, expiry = entry
+        if time.ticks_diff(expiry, time.ticks_ms()) <= 0:
+            self._misses += 1
+            return None
+        self._touch(key)
+        self._hits += 1
+        return value
+
+    def getStale(self, key):
+        """ Get a cached value even if it has expired, or None if it is missing """
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._touch(key)
+        return entry[0]
+
+    def _touch(self, key):
+        """ Mark key as the most recently used """
+
+        self._order.remove(key)
+        self._order.append(key)
+
+    def has(self, key):
+        """
+        True if key is cached and has not expired. Unlike get, this does not
+        count as a use of the entry.
+        """
+
+        entry = self._entries.get(key)
+        return entry is not None and time.ticks_diff(entry[2], time.ticks_ms()) > 0
+
+    def put(self, key, value, ttl):
+        """
+        Cache a value for ttl seconds. Values larger than the whole budget
+        are not cached at all.
+        """
+
+        size = estimateSize(key) + estimateSize(value)
+        if key in self._entries:
+            self._remove(key)
+        if size > self._budget:
+            Log.d(f'Cache: {key} too large to cache ({size} bytes)')
+            return
+        while self._order and self._size + size > self._budget:
+            Log.d(f'Cache: evicting {self._order[0]}')
+            self._remove(self._order[0])
+            self._evictions += 1
+        self._entries[key] = (value, size, time.ticks_add(time.ticks_ms(), int(ttl * 1000)))
+        self._order.append(key)
+        self._size += size
+
+    def resize(self, key):
+        """
+        Re-estimate the size of a cached value that has grown (or shrunk)
+        since it was put, evicting other entries if the budget is now exceeded
+        """
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        value, size, expiry = entry
+        newsize = estimateSize(key) + estimateSize(value)
+        self._entries[key] = (value, newsize, expiry)
+        self._size += newsize - size
+        while self._size > self._budget and self._order[0] != key:
+            Log.d(f'Cache: evicting {self._order[0]}')
+            self._remove(self._order[0])
+            self._evictions += 1
+
+    def _remove(self, key):
+        value, size, expiry = self._entries.pop(key)
+        self._order.remove(key)
+        self._size -= size
+
+    def expire(self, key):
+        """
+        Mark an entry as expired without dropping it, so the next get misses
+        but getStale can still return it for revalidation
+        """
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries[key] = (entry[0], entry[1], time.ticks_ms())
+
+    def invalidate(self, key):
+        """ Drop a single entry if it is cached """
+
+        if key in self._entries:
+            self._remove(key)
+
+    def invalidatePrefix(self, prefix):
+        """ Drop every entry whose key starts with prefix """
+
+        for key in [k for k in self._order if k.startswith(prefix)]:
+            self._remove(key)
+
+    def clear(self):
+        """ Drop everything """
+
+        self._entries = {}
+        self._order = []
+        self._size = 0
+
+    def getStats(self):
+        """ Get a dictionary with the cache hit/miss counts and current size """
+
+        return {
+            'entries': len(self._entries),
+            'size': self._size,
+            'budget': self._budget,
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions
+        }
+
+if __name__ == '__main__':
+    cache = ResponseCache(budget=200)
+    cache.put('a', 'x' * 50, ttl=1)
+    cache.put('b', 'y' * 50, ttl=10)
+    print(cache.get('a'))
+    cache.put('c', 'z' * 80, ttl=10)   # evicts b, the least recently used
+    print(cache.getStats())
+    time.sleep(1.1)
+    print(cache.get('a'))              # expired
+    print(cache.getStats())
@@ -0,0 +1,189 @@
+"""
+Cursor.py - lazily loaded, paginated ORDS collections
+
+ORDS returns long collections one page at a time: each page has the rows
+in "items", "hasMore" tells if there are more, and the "next" link in
+"links" gives the URL of the following page. A PagedCursor holds the rows
+loaded so far and fetches further pages only when they are needed - when
+an index past the loaded rows is asked for, or (one page ahead) when the
+caller gets close to the end of what is loaded.
+
+It behaves like a read-only list of what has been loaded so far: len(),
+indexing, iteration and truth testing all work on the loaded rows.
+
+Basic usage:
+
+cursor = PagedCursor(make, fetch)  # make(item) -> model, fetch(url) -> page
+cursor.addPage(firstpage)          # e.g. an ItemsStream of the first page
+cursor.ensure(30)                  # load pages until index 30 exists
+cursor.prefetch(index)             # ask for the next page if index is near the end
+cursor.poll()                      # call regularly - loads a requested page
+"""
+
+from Log import *
+
+# Ask for the next page when the caller is this many rows from the end
+PAGE_MARGIN = 3
+
+def nextPageUrl(fields, url=None):
+    """
+    Find the URL of the next page from the top-level members of an ORDS
+    collection. Uses the "next" link, or failing that builds one from the
+    offset and count of this page. Returns None on the last page.
+    """
+
+    if not fields.get('hasMore'):
+        return None
+    for link in fields.get('links', []):
+        if link.get('rel') == 'next':
+            return link.get('href')
+    if url is None or 'count' not in fields:
+        return None
+    offset = fields.get('offset', 0) + fields['count']
+    base, query = url.split('?', 1) if '?' in url else (url, '')
+    limit = fields.get('limit')
+    # Keep any other parameters, such as a q= filter
+    params = [p for p in query.split('&') if p and not p.startswith('offset=') and not p.startswith('limit=')]
+    params.append(f'offset={offset}')
+    if limit:
+        params.append(f'limit={limit}')
+    return f'{base}?' + '&'.join(params)
+
+class PagedCursor:
+    """
+    The rows of a paginated collection, loaded a page at a time.
+    """
+
+    def __init__(self, make, fetch, margin=PAGE_MARGIN, onpage=None, keep=None, maxrows=None, key=None):
+        """
+        make turns one item of a page into a model object. fetch(url)
+        returns the next page: an iterable of items that either has a
+        fields attribute (like ItemsStream) or is a dict with an items list.
+        onpage(cursor, newrows) is called after each page is added.
+        If keep is given, only rows for which keep(row) is true are kept,
+        and if maxrows is given no more pages are loaded once that many
+        rows have been kept. key(row) identifies a row; it is used to skip
+        rows that turn up again on a later page after prepend() has shifted
+        the server's offsets.
+        """
+
+        self._make = make
+        self._fetch = fetch
+        self._margin = margin
+        self._onpage = onpage
+        self._keep = keep
+        self._maxrows = maxrows
+        self._key = key
+        self._prepended = False
+        self._rows = []
+        self._next = None
+        self._wanted = False
+        self.pages = 0
+        self.dropped = 0
+
+    def addPage(self, page, url=None):
+        """ Add the rows of one page, and remember where the next one is """
+
+        if isinstance(page, dict):
+            items, fields = page.get('items', []), page
+        else:
+            items, fields = page, None
+        start = len(self._rows)
+        for item in items:
+            row = self._make(item)
+            if self._keep is not None and not self._keep(row):
+                self.dropped += 1
+            elif self._prepended and self._key is not None and self._isLoaded(self._key(row)):
+                pass
+            elif self._maxrows is None or len(self._rows) < self._maxrows:
+                self._rows.append(row)
+        if fields is None:
+            fields = getattr(page, 'fields', {})
+        self._next = nextPageUrl(fields, url)
+        if self._maxrows is not None and len(self._rows) >= self._maxrows:
+            self._next = None
+        self.pages += 1
+        if self._onpage:
+            self._onpage(self, self._rows[start:])
+
+    def _isLoaded(self, key):
+        for row in self._rows:
+            if self._key(row) == key:
+                return True
+        return False
+
+    def prepend(self, rows):
+        """
+        Put rows that are newer than everything loaded (such as the result
+        of a delta sync) in front of the loaded rows
+        """
+
+        self._rows = list(rows) + self._rows
+        self._prepended = True
+        if self._maxrows is not None and len(self._rows) > self._maxrows:
+            self._rows = self._rows[:self._maxrows]
+
+    def discard(self, predicate):
+        """ Remove the loaded rows for which predicate(row) is true """
+
+        rows = [row for row in self._rows if not predicate(row)]
+        self.dropped += len(self._rows) - len(rows)
+        self._rows = rows
+
+    def hasMore(self):
+        """ True if there are pages that have not been loaded yet """
+
+        return self._next is not None
+
+    def loadNext(self):
+        """ Fetch and add the next page. Returns False if there was none """
+
+        if self._next is None:
+            return False
+        url = self._next
+        self._wanted = False
+        page = self._fetch(url)
+        if page is None:
+            raise OSError(f'could not load page {url}')
+        self.addPage(page, url)
+        return True
+
+    def ensure(self, index):
+        """ Load pages until index is loaded or there are no more pages """
+
+        while index >= len(self._rows) and self.hasMore():
+            self.loadNext()
+        return index < len(self._rows)
+
+    def prefetch(self, index):
+        """
+        Note that the caller is at index. If that is within the margin of the
+        end of the loaded rows, the next page is loaded on the next poll().
+        """
+
+        if self.hasMore() and index >= len(self._rows) - self._margin:
+            self._wanted = True
+
+    def poll(self):
+        """ Load the next page if prefetch asked for it """
+
+        if self._wanted:
+            try:
+                self.loadNext()
+            except Exception as e:
+                self._wanted = False
+                Log.e(f'PagedCursor: {e}')
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __bool__(self):
+        return len(self._rows) > 0
+
+    def __getitem__(self, index):
+        if index >= 0:
+            self.ensure(index)
+        return self._rows[index]
+
+    def __iter__(self):
+        return iter(self._rows)
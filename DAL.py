@@ -1,9 +1,27 @@
+import time
 from Net import *
 from modelclasses import *
 
-from secrets import *
+try:
+    from secrets import SSID, PASSWORD
+except ImportError:
+    # No secrets.py on a host, which uses its own network (see Net.py)
+    SSID = PASSWORD = None
 from Net import *
 from modelclasses import *
+from Cache import *
+from ReviewQueue import *
+from Jobs import *
+from Cursor import *
+from Link import *
+from BadgeCache import *
+from Notify import *
+from SingleFlight import *
+from Retry import *
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
 
 BASEURL = 'https://oracleapex.com/ords/c85/pihealth/'
 PROVIDER = f'{BASEURL}provider/'
@@ -11,6 +29,64 @@ PATIENTS = f'{BASEURL}patients/'
 RFID = f'{BASEURL}rfidtag/'
 ASSESSMENTS = f'{BASEURL}assessments'
 REVIEWED = f'{BASEURL}provider_reviewed/'
+NEW_ASSESSMENTS = f'{BASEURL}new_assessments/'
+# Time zone the clock is kept in (see TimeZones.ZONES)
+TIMEZONE = 'America/New_York'
+
+# Seconds each kind of response stays in the DAL cache. Badges and provider
+# details hardly ever change, patient lists and assessments change more often
+RFID_TTL = 300
+PROVIDER_TTL = 600
+PATIENTS_TTL = 120
+ASSESSMENTS_TTL = 60
+# While new-assessment notifications are coming in, a cached assessment list
+# is expired as soon as the patient gets a new assessment, so it can be
+# kept longer without going out of date
+NOTIFIED_ASSESSMENTS_TTL = 600
+# Rows asked for per page of a paginated collection
+PAGE_LIMIT = 25
+# Estimated bytes of heap the DAL cache may use. A full page of
+# assessments is roughly 9 KB, and it is kept for delta syncs
+CACHE_BUDGET = 16384
+# Assessment generation runs at most this often (seconds), plus a random jitter
+GENERATE_INTERVAL = 300
+GENERATE_JITTER = 30
+# Only fetch the assessments a provider has not reviewed yet. With
+# SERVER_FILTER the filter (and newest-first ordering) is sent to ORDS as a
+# q= parameter so reviewed rows are never downloaded; the rows are checked
+# again on the Pico either way, in case the server ignores the filter
+UNREVIEWED_ONLY = True
+SERVER_FILTER = True
+# Most assessments loaded per patient, or None for no limit
+ASSESSMENT_ROWS = None
+# A delta sync only brings new rows, so rows reviewed elsewhere stay in a
+# cached list until it is loaded in full again (conditionally, so an
+# unchanged list costs a 304). That is done instead of a delta sync after
+# FULL_SYNC_EVERY delta syncs, or once the last full load is more than
+# FULL_SYNC_MAX_AGE seconds old
+FULL_SYNC_EVERY = 10
+FULL_SYNC_MAX_AGE = 900
+# When the backend has no new_assessments endpoint (the real ORDS one
+# answers 404), the assessments of one of the provider's patients are
+# polled instead, one patient every this many seconds
+POLL_ASSESSMENTS_INTERVAL = 30
+# Seconds a piece of background network work done from poll() may take
+# before it is cut off, so the controller loop is never held up for long
+BACKGROUND_TIMEOUT = 4
+
+def setBaseUrl(baseurl):
+    """
+    Point the DAL at a different ORDS base URL (ending in /), for example a
+    StandInServer running on a laptop for offline testing.
+    """
+    global BASEURL, PROVIDER, PATIENTS, RFID, ASSESSMENTS, REVIEWED, NEW_ASSESSMENTS
+    BASEURL = baseurl
+    PROVIDER = f'{BASEURL}provider/'
+    PATIENTS = f'{BASEURL}patients/'
+    RFID = f'{BASEURL}rfidtag/'
+    ASSESSMENTS = f'{BASEURL}assessments'
+    REVIEWED = f'{BASEURL}provider_reviewed/'
+    NEW_ASSESSMENTS = f'{BASEURL}new_assessments/'
 
 class DAL:
     def __init__(self):
@@ -19,52 +95,452 @@ class DAL:
         
         Creates a new Net instance for network operations and initializes
         instance variables to store RFID tag, provider, patients, and assessments.
+        Responses are kept in a TTL + LRU cache so repeated lookups (re-login,
+        going back to the patient list) do not need a round trip.
         """
         self._net = Net()
+        self._cache = ResponseCache(CACHE_BUDGET)
+        self._writes = WriteMetrics()
+        self._reviews = ReviewQueue(self.sendProviderReviewed, metrics=self._writes)
+        self._generator = PeriodicJob('postAssessments', self._postInBackground,
+                                      GENERATE_INTERVAL, GENERATE_JITTER)
+        # Backoff of the writes the DAL retries itself (the review queue
+        # has its own), and the idempotency token, attempts and retry time
+        # of a post that failed
+        self._writeretry = RetrySchedule()
+        self._posttoken = None
+        self._postattempts = 0
+        self._postdue = None
+        self._link = LinkSupervisor(self._net, SSID, PASSWORD)
+        self._badges = BadgeCache()
+        self._badgechecks = []
+        self._badgehandler = None
+        self._notifier = AssessmentNotifier(self._net, self._newAssessments)
+        self._assessmenthandler = None
+        # Polls the assessments collection when the notifier is unsupported
+        self._poller = PeriodicJob('pollAssessments', self._pollAssessments,
+                                   POLL_ASSESSMENTS_INTERVAL, periodic=True)
+        self._notifying = False
+        self._pollindex = 0
+        # NEW_ASSESSMENTS base URLs the notifier found missing (404), so it
+        # is not tried again at every login
+        self._nonotify = set()
+        # Concurrent async reads of the same endpoint share one request
+        self._flights = SingleFlight()
+        self._supervised = False
+        # patient_id -> (assessment_id, assessment_dt) of the newest
+        # assessment loaded, for delta syncs of the cached list
+        self._highwater = {}
+        # patient_id -> [ticks_ms, delta syncs since] of the last full load
+        self._fullsyncs = {}
+        self._syncs = {'full': 0, 'revalidated': 0, 'delta': 0, 'delta_rows': 0}
+        self._unreviewedonly = UNREVIEWED_ONLY
+        self._serverfilter = SERVER_FILTER
+        self._assessmentrows = ASSESSMENT_ROWS
         self._rfidtag = None
         self._provider = None
         self._patients = []
         self._assessments = []
 
-    def postAssessments(self):
+    def invalidatePatients(self, provider_id):
+        """ Drop the cached patient list for a provider """
+        self._cache.invalidate(f'{PATIENTS}{provider_id}')
+
+    def invalidateAssessments(self, patient_id=None):
+        """
+        Drop the cached assessment list for a patient, or for every patient
+        if patient_id is None
+        """
+        if patient_id is None:
+            self._cache.invalidatePrefix(f'{ASSESSMENTS}/')
+            self._highwater = {}
+            self._fullsyncs = {}
+        else:
+            self._cache.invalidate(f'{ASSESSMENTS}/{patient_id}')
+            self._highwater.pop(patient_id, None)
+            self._fullsyncs.pop(patient_id, None)
+
+    def setAssessmentFilter(self, unreviewedonly=UNREVIEWED_ONLY, serverfilter=SERVER_FILTER, rows=ASSESSMENT_ROWS):
+        """
+        Choose which assessments getAssessments returns: only unreviewed ones
+        or all of them, whether the filter is done by ORDS or on the Pico,
+        and the most rows to load per patient (None for all). Cached
+        assessment lists are dropped, since they were loaded with the old
+        settings.
+        """
+        self._unreviewedonly = unreviewedonly
+        self._serverfilter = serverfilter
+        self._assessmentrows = rows
+        self.invalidateAssessments()
+
+    def clearCache(self):
+        """ Drop everything in the response cache """
+        self._cache.clear()
+
+    def getCacheStats(self):
+        """ Get the response cache hit/miss counts and size """
+        return self._cache.getStats()
+
+    def poll(self, network=True):
+        """
+        Do any pending background work, such as flushing queued review marks,
+        generating new assessments, refreshing cached host addresses,
+        re-checking badges, listening for new assessments or reconnecting
+        Wi-Fi. Call this regularly from the controller's loop.
+
+        It never waits for Wi-Fi to connect, and does at most one request
+        (or clock re-sync) per call, cut off after BACKGROUND_TIMEOUT
+        seconds, so the rest is left for the next calls. With network
+        False only the Wi-Fi link is looked after, which never blocks, and
+        the rest waits for a call with network True. Returns True if it
+        used the network.
+        """
+        if self._supervised:
+            self._link.poll()
+        if not network or not self.isOnline() or not self._net.isConnected():
+            return False
+        if self._notifier.isRunning():
+            if self._notifier.poll():
+                if self._notifier.isUnsupported():
+                    self._nonotify.add(NEW_ASSESSMENTS)
+                return True
+        if self._net.poll():
+            return True
+        if self._badgechecks:
+            self._revalidateBadge(self._badgechecks.pop(0))
+            return True
+        if self._reviews.poll(batch=1):
+            return True
+        if self._postdue is not None and time.ticks_diff(time.ticks_ms(), self._postdue) >= 0:
+            self._postdue = None
+            self._postInBackground()
+            return True
+        if self._notifying and NEW_ASSESSMENTS in self._nonotify and self._poller.poll():
+            return True
+        return self._generator.poll()
+
+    def requestAssessments(self):
+        """
+        Ask for new assessments to be generated in the background. The
+        postAssessments call is made from poll(), no more often than every
+        GENERATE_INTERVAL seconds, so calling this often is cheap.
+        """
+        self._generator.trigger()
+
+    def getGeneratorStats(self):
+        """ Get the run/skip counts of the background assessment generation """
+        return self._generator.getStats()
+
+    def flushReviews(self):
+        """
+        Send all queued review marks now. Returns True if none are left.
+        """
+        return self._reviews.flush()
+
+    def getReviewStats(self):
+        """ Get the review queue length and send/retry counts """
+        return self._reviews.getStats()
+
+    def startNetwork(self):
+        """
+        Start connecting to Wi-Fi without waiting, so the association can
+        complete while the rest of the device starts up. From then on the
+        link is supervised: poll() checks it and reconnects when it drops.
+        Returns False if the connection could not be started.
+        """
+        self._supervised = True
+        return self._link.start()
+
+    def waitNetwork(self, max_wait=10):
+        """
+        Wait for the Wi-Fi connection started by startNetwork. Returns True
+        if it is up; if not, poll() keeps trying in the background.
+        """
+        return self._link.wait(max_wait)
+
+    def setLinkHandler(self, handler):
+        """ Have handler(event) called with 'link_up' or 'link_down' when Wi-Fi comes and goes """
+        self._link.setHandler(handler)
+
+    def isOnline(self):
+        """ True unless the supervised Wi-Fi link is known to be down """
+        return not self._supervised or self._link.isUp()
+
+    def getLinkStats(self):
+        """ Get the Wi-Fi link state and drop/reconnect counts """
+        return self._link.getStats()
+
+    def getTimingSummary(self):
+        """ Get the p50/p95 request phase times (ms) per endpoint, see Net.getTimingSummary """
+        return self._net.getTimingSummary()
+
+    def logTimings(self):
+        """ Log where the time of the recent requests went, phase by phase """
+        self._net.logTimings()
+
+    def _ensureNetwork(self, connect=True):
+        """
+        Connect to Wi-Fi if nothing has yet (unless connect is False). Once
+        the link is supervised the supervisor does the reconnecting, so this
+        does not block on it. Returns True if the link is up.
+        """
+        if self._net.isConnected():
+            return True
+        if self._supervised or not connect:
+            return False
+        self._net.connect(SSID, PASSWORD)
+        return True
+
+    def warmup(self):
+        """
+        Open the connection to the backend (DNS, TCP and TLS handshake)
+        before the first request needs it. Returns True if it is open.
+        """
+        return self._net.warmup(BASEURL)
+
+    def syncClock(self):
+        """
+        Set the clock to local time in TIMEZONE from an SNTP server, and
+        keep it in sync from poll(). Returns True if it was set.
+        """
+        self._net.updateTime(TIMEZONE)
+        return self._net.getClockStats()['syncs'] > 0
+
+    def getClockStats(self):
+        """ Get the clock sync counts, SNTP delay and drift, see Net.getClockStats """
+        return self._net.getClockStats()
+
+    def postAssessments(self, background=False):
         """
         Post new health assessments to the remote API endpoint.
         
         Ensures network connectivity before posting. If not connected,
-        attempts to connect using credentials from secrets module.
+        attempts to connect using credentials from secrets module (or, once
+        the link is supervised, returns None and leaves reconnecting to it).
+        A background post, made from poll(), never connects and is cut off
+        after BACKGROUND_TIMEOUT seconds.
+
+        The post carries an idempotency token. If it fails in a way worth
+        retrying, poll() tries it again with the same token after a jittered,
+        exponentially growing wait, until RETRY_ATTEMPTS attempts have been
+        made (see Retry.py). Every attempt is recorded in getWriteStats.
         
         Returns:
             tuple: A tuple containing (status_code, json_data) if successful,
                    or None if the request fails. The status_code is an HTTP
                    status code and json_data is the JSON response from the API.
         """
-        status = self._net.isConnected()
-        if status == False:
-            self._net.connect(SSID, PASSWORD)
+        if not self._postStarted(self._ensureNetwork(connect=not background)):
+            return None
 
         newassessmentsendpoint = f"{ASSESSMENTS}"
-        response = self._net.postJson(newassessmentsendpoint)
+        start = time.ticks_ms()
+        response = self._net.postJson(newassessmentsendpoint, headers={IDEMPOTENCY_HEADER: self._posttoken},
+                                      timeout=BACKGROUND_TIMEOUT if background else None)
+        if self._postDone(response, start) == RETRY:
+            self._postdue = time.ticks_add(time.ticks_ms(), self._writeretry.delay(self._postattempts))
         return response
 
+    def _postStarted(self, online):
+        """
+        Start an attempt at the post: mint its token if it is a new one and,
+        if online, count the attempt. If not online, the post is retried
+        from poll() later. Returns online.
+        """
+        if self._posttoken is None:
+            self._posttoken = makeToken()
+            self._postattempts = 0
+        if not online:
+            self._postdue = time.ticks_add(time.ticks_ms(), self._writeretry.delay(max(1, self._postattempts)))
+            return False
+        self._postattempts += 1
+        return True
+
+    def _postDone(self, response, start):
+        """
+        Record the attempt at the post that was started at ticks_ms start,
+        and forget the post unless it is to be retried. Returns the outcome.
+        """
+        outcome = self._writeOutcome(response, self._postattempts)
+        self._writes.record('post', self._posttoken, self._postattempts, outcome,
+                            time.ticks_diff(time.ticks_ms(), start), response[0] if response else None)
+        if outcome != RETRY:
+            self._posttoken = None
+            self._postdue = None
+        return outcome
+
+    def _postInBackground(self):
+        """ The background assessment generation, run from poll() """
+        self.postAssessments(background=True)
+
+    def authenticateBadge(self, card_code):
+        """
+        Log in with a badge. A badge that has logged in before is let in at
+        once from the badge cache on flash, and checked with the backend
+        from poll() afterwards; if the backend says it is no longer active it
+        is revoked and the badge handler is told. Other badges are looked up
+        with getRFIDTag and getProvider, and only ACTIVE ones are let in.
+
+        Args:
+            card_code (str): The RFID tag code read from the badge.
+
+        Returns:
+            Provider: The provider the badge belongs to, or None if the badge
+                    is unknown or not active.
+        """
+        provider = self._badges.get(card_code)
+        if provider is not None:
+            if card_code not in self._badgechecks:
+                self._badgechecks.append(card_code)
+            self._provider = provider
+            return provider
+        rfidtag = self.getRFIDTag(card_code)
+        if rfidtag is None or not rfidtag._provider_id:
+            return None
+        if rfidtag._cardstatus != 'ACTIVE':
+            self._badges.revoke(card_code)
+            return None
+        provider = self.getProvider(rfidtag._provider_id)
+        if provider is not None:
+            self._badges.put(card_code, rfidtag, provider)
+        return provider
+
+    def setBadgeHandler(self, handler):
+        """ Have handler(card_code) called when a badge that was let in is revoked """
+        self._badgehandler = handler
+
+    def startNotifications(self, provider_id):
+        """
+        Start listening in the background for new assessments of the
+        provider's patients. Each one expires the cached assessment list of
+        its patient and is passed to the assessment handler. If the backend
+        has no new_assessments endpoint, the assessments of the patients
+        from getPatients are polled instead (see _pollAssessments). Once
+        the endpoint has been found missing it is not tried again.
+        """
+        self._notifying = True
+        if NEW_ASSESSMENTS not in self._nonotify:
+            self._notifier.start(f'{NEW_ASSESSMENTS}{provider_id}')
+
+    def stopNotifications(self):
+        """ Stop listening for new assessments """
+        self._notifying = False
+        self._notifier.stop()
+
+    def setAssessmentHandler(self, handler):
+        """ Have handler(assessments) called with the HealthAssessments that come in """
+        self._assessmenthandler = handler
+
+    def getNotifyStats(self):
+        """ Get the new-assessment notification request/failure counts """
+        return self._notifier.getStats()
+
+    def _newAssessments(self, rows):
+        """ Called by the notifier with the rows of new assessments """
+        assessments = [self._makeAssessment(row) for row in rows]
+        for assessment in assessments:
+            # The next getAssessments brings the list up to date
+            self._cache.expire(f'{ASSESSMENTS}/{assessment._patient_id}')
+        if self._assessmenthandler is not None:
+            self._assessmenthandler(assessments)
+
+    def _pollAssessments(self):
+        """
+        The fallback for a backend without new_assessments: bring the
+        assessment list of the next of the provider's patients up to date
+        (a delta sync if it is cached) and pass the ones newer than its
+        high-water mark to the assessment handler
+        """
+        patients = [patient._patient_id for patient in self._patients]
+        if not patients:
+            return
+        patient_id = patients[self._pollindex % len(patients)]
+        self._pollindex += 1
+        mark = self._highwater.get(patient_id)
+        self._cache.expire(f'{ASSESSMENTS}/{patient_id}')
+        assessments = self._loadAssessments(patient_id, BACKGROUND_TIMEOUT)
+        if mark is None:
+            # Not seen before - this load only sets the high-water mark
+            return
+        rows = [assessment for assessment in assessments if assessment._assessment_id > mark[0]]
+        if rows and self._assessmenthandler is not None:
+            self._assessmenthandler(rows)
+
+    def _assessmentsTtl(self):
+        """ How long an assessment list stays cached """
+        if self._notifier.isListening():
+            return NOTIFIED_ASSESSMENTS_TTL
+        return ASSESSMENTS_TTL
+
+    def getBadgeStats(self):
+        """ Get the badge cache hit/miss/revoked counts """
+        stats = self._badges.getStats()
+        stats['pending_checks'] = len(self._badgechecks)
+        return stats
+
+    def _revalidateBadge(self, card_code):
+        """
+        Check a badge that was let in from the badge cache with the backend,
+        refreshing its provider details, or revoking it if it is no longer
+        active: the backend answers 404 for it, or a 2xx whose card_status
+        is not ACTIVE. If the backend cannot be reached, or answers with
+        any other status (say a 5xx during an outage), the local copy is
+        kept. Both requests together must finish within BACKGROUND_TIMEOUT
+        seconds.
+        """
+        deadline = time.ticks_add(time.ticks_ms(), BACKGROUND_TIMEOUT * 1000)
+        rfidendpoint = f'{RFID}{card_code}'
+        answer = self._net.getJsonStatus(rfidendpoint, timeout=BACKGROUND_TIMEOUT)
+        if answer is None:
+            return
+        status, response = answer
+        if status != 404 and (status >= 300 or not isinstance(response, dict)):
+            return
+        if status == 404 or response.get('card_status') != 'ACTIVE' or not response.get('provider_id'):
+            if self._badges.revoke(card_code):
+                self._cache.invalidate(rfidendpoint)
+                if self._badgehandler is not None:
+                    self._badgehandler(card_code)
+            return
+        rfidtag = self._makeRFIDTag(response)
+        self._cache.put(rfidendpoint, rfidtag, RFID_TTL)
+        left = time.ticks_diff(deadline, time.ticks_ms())
+        if left <= 0:
+            # Still active; the provider details are refreshed next time
+            return
+        providerendpoint = f'{PROVIDER}{rfidtag._provider_id}'
+        response = self._net.getJson(providerendpoint, timeout=left / 1000)
+        if response is None or 'provider_id' not in response:
+            return
+        provider = self._makeProvider(response)
+        self._cache.put(providerendpoint, provider, PROVIDER_TTL)
+        self._badges.put(card_code, rfidtag, provider)
+
     def getRFIDTag(self, rfidtag):
         """
         Retrieve RFID tag information from the remote API.
         
         Fetches RFID tag data using the provided RFID tag code and creates
-        an RFIDTag object with the retrieved information.
+        an RFIDTag object with the retrieved information. Like the other
+        getters, if the request fails (including when Net's circuit breaker
+        for the endpoint is open) an expired cached copy is returned if
+        there is one.
         
         Args:
             rfidtag (str): The RFID tag code to look up.
         
         Returns:
             RFIDTag: An RFIDTag object containing provider_id, card_code,
-                    and card_status. Returns None if the request fails.
+                    and card_status. Returns None if the badge is unknown,
+                    or if the request fails and nothing is cached.
         """
         rfidendpoint = f'{RFID}{rfidtag}'
+        cached = self._cache.get(rfidendpoint)
+        if cached is not None:
+            self._rfidtag = cached
+            return self._rfidtag
         response = self._net.getJson(rfidendpoint)
-        self._rfidtag = RFIDTag(response['provider_id'],
-                                    response['card_code'],
-                                    response['card_status'])
+        self._rfidtag = self._lookupResult(rfidendpoint, response, self._makeRFIDTag, 'provider_id', RFID_TTL)
         return self._rfidtag
 
     def getProvider(self, provider_id):
@@ -83,40 +559,73 @@ class DAL:
                      request fails.
         """
         providerendpoint = f'{PROVIDER}{provider_id}'
+        cached = self._cache.get(providerendpoint)
+        if cached is not None:
+            self._provider = cached
+            return self._provider
         response = self._net.getJson(providerendpoint)
-        self._provider = Provider(response['provider_id'],
-                                    response['first_name'],
-                                    response['last_name'],
-                                    response['title'],
-                                    response['specialty'])
+        self._provider = self._lookupResult(providerendpoint, response, self._makeProvider, 'provider_id', PROVIDER_TTL)
         return self._provider
 
-    def getPatients(self, provider_id):
+    def _lookupResult(self, endpoint, response, make, key, ttl):
+        """
+        The model object for the response to a single-row lookup, which is
+        cached. If the request failed, the expired cached copy if there is
+        one; None if there is not, or if the id is unknown (a 404, whose
+        body has no key member).
+        """
+        if response is None:
+            # Network trouble - fall back to an expired copy if there is one
+            return self._cache.getStale(endpoint)
+        if key not in response:
+            Log.d(f'DAL: {endpoint} not found')
+            return None
+        model = make(response)
+        self._cache.put(endpoint, model, ttl)
+        return model
+
+    def getPatients(self, provider_id, limit=PAGE_LIMIT):
         """
         Retrieve all patients associated with a specific provider.
         
-        Fetches a list of patients from the remote API for the given provider ID
-        and creates Patient objects for each patient in the response.
+        Fetches the first page of patients from the remote API for the given
+        provider ID and creates Patient objects for each patient in it. The
+        following pages are fetched lazily, following the ORDS next links,
+        as the returned cursor is read further (see Cursor.PagedCursor).
         
         Args:
             provider_id (int): The unique identifier of the provider whose
                              patients are to be retrieved.
+            limit (int): The number of patients fetched per page.
         
         Returns:
-            list: A list of Patients objects, each containing patient_id,
-                  first_name, last_name, and birth_date. Returns an empty
-                  list if no patients are found or if the request fails.
+            PagedCursor: A list-like cursor of Patients objects, each
+                  containing patient_id, first_name, last_name, and
+                  birth_date. Empty if no patients are found. If the
+                  request fails, the expired cached list if there is one,
+                  or else an empty list.
         """
         patientsendpoint = f'{PATIENTS}{provider_id}'
-        response = self._net.getJson(patientsendpoint)
-        self._patients = []
-        for item in response['items']:
-            self._patients.append(
-                Patients(item['patient_id'],
-                            item['first_name'],
-                            item['last_name'],
-                            item['birth_date'])
-            )
+        cached = self._cache.get(patientsendpoint)
+        if cached is not None:
+            self._patients = cached
+            return self._patients
+        # An expired copy can be revalidated instead of downloaded again
+        stale = self._cache.getStale(patientsendpoint)
+        url = f'{patientsendpoint}?limit={limit}'
+        items = self._net.getItems(url, conditional=stale is not None)
+        if items is NOT_MODIFIED:
+            self._patients = stale
+            self._cache.put(patientsendpoint, self._patients, PATIENTS_TTL)
+            return self._patients
+        if items is None:
+            # Network trouble - show the expired list, or an empty one if
+            # there is none (not cached, so the next call tries again)
+            self._patients = stale if stale is not None else []
+            return self._patients
+        self._patients = self._newCursor(patientsendpoint, self._makePatient)
+        self._patients.addPage(items, url)
+        self._cache.put(patientsendpoint, self._patients, PATIENTS_TTL)
         return self._patients
 
     def getAssessments(self, patient_id):
@@ -125,51 +634,544 @@ class DAL:
         
         Fetches a list of health assessments from the remote API for the given
         patient ID and creates HealthAssessments objects for each assessment
-        in the response.
+        in the response. By default only assessments the provider has not
+        reviewed yet are fetched, newest first (see setAssessmentFilter).
         
         Args:
             patient_id (int): The unique identifier of the patient whose
                             assessments are to be retrieved.
         
+        Like getPatients, only the first page is fetched right away and
+        the rest are loaded lazily through the returned cursor.
+        
         Returns:
-            list: A list of HealthAssessments objects, each containing
-                  assessment_id, patient_id, assessment_dt, assessment_result,
-                  provider_id, and provider_reviewed. Returns an empty list
-                  if no assessments are found or if the request fails.
+            PagedCursor: A list-like cursor of HealthAssessments objects, each
+                  containing assessment_id, patient_id, assessment_dt,
+                  assessment_result, provider_id, and provider_reviewed.
+                  Empty if no assessments are found. If the request fails,
+                  the expired cached list if there is one, or else an
+                  empty list.
         """
-        assessmentsendpoint = f'{ASSESSMENTS}/{patient_id}'
-        response = self._net.getJson(assessmentsendpoint)
-        self._assessments = []
-        for item in response['items']:
-            self._assessments.append(
-                HealthAssessments(item['assessment_id'],
-                                    item['patient_id'],
-                                    item['assessment_dt'],
-                                    item['assessment_result'],
-                                    item['provider_id'],
-                                    item['provider_reviewed'])
-            )
+        self._assessments = self._loadAssessments(patient_id)
         return self._assessments
 
-    def putProviderReviewed(self, assessment_id):
+    def prefetchAssessments(self, patient_id):
+        """
+        Load the assessments for a patient into the cache without making them
+        the current assessments, so a later getAssessments is served from memory.
+        """
+        self._loadAssessments(patient_id)
+
+    def hasAssessments(self, patient_id):
+        """ True if the assessments for a patient are already cached """
+        return self._cache.has(f'{ASSESSMENTS}/{patient_id}')
+
+    def getAssessmentsBulk(self, patient_ids):
+        """
+        Load the assessments of many patients at once, such as a provider's
+        whole panel. The ones not in the cache are fetched with pipelined
+        GETs over one connection (see Net.getItemsPipelined) rather than
+        one round trip after another. Lists that were cached are brought up
+        to date in the cache as getAssessments would, but new ones are not
+        cached, so a whole panel does not push the badge, provider and
+        patient entries out of the small cache. The current assessments are
+        left alone.
+
+        Args:
+            patient_ids (list): The ids of the patients.
+
+        Returns:
+            dict: patient_id -> PagedCursor of HealthAssessments objects.
+                  Patients whose assessments could not be loaded are left out.
+        """
+        result = {}
+        plans = {}
+        urls = []
+        conditional = []
+        for patient_id in patient_ids:
+            if patient_id in result:
+                continue
+            cached, url, stale, delta = self._planAssessments(patient_id)
+            if cached is not None:
+                result[patient_id] = cached
+            elif url not in plans:
+                plans[url] = (patient_id, stale, delta)
+                urls.append(url)
+                conditional.append(stale is not None)
+        for url, items in self._net.getItemsPipelined(urls, conditional=conditional):
+            patient_id, stale, delta = plans[url]
+            if items is None and stale is None:
+                # Failed, and nothing to fall back on - Net has logged why
+                continue
+            try:
+                result[patient_id] = self._loadedAssessments(patient_id, url, stale, delta, items,
+                                                             cache=False)
+            except Exception as e:
+                Log.e(f'DAL: could not load assessments for patient {patient_id}: {e}')
+        return result
+
+    def _loadAssessments(self, patient_id, timeout=None):
+        """
+        Get the assessment cursor for a patient from the cache or the API.
+        An expired list that the server can filter is brought up to date
+        with a delta sync instead of being downloaded again. Each request
+        must finish within timeout seconds (Net's own limit if not given).
+        """
+        cached, url, stale, delta = self._planAssessments(patient_id)
+        if cached is not None:
+            return cached
+        items = self._net.getItems(url, conditional=stale is not None, timeout=timeout)
+        return self._loadedAssessments(patient_id, url, stale, delta, items, timeout)
+
+    def _planAssessments(self, patient_id):
+        """
+        Work out how to load a patient's assessments: (cached, url, stale,
+        delta) where cached is the cursor if the cache has a fresh one, and
+        otherwise url is the first page to GET (conditionally if there is a
+        stale copy) and delta tells whether it is a delta sync of stale.
+        A full load is planned instead of a delta sync when one is due (see
+        FULL_SYNC_EVERY and FULL_SYNC_MAX_AGE).
+        """
+        assessmentsendpoint = f'{ASSESSMENTS}/{patient_id}'
+        cached = self._cache.get(assessmentsendpoint)
+        if cached is not None:
+            return cached, None, None, False
+        stale = self._cache.getStale(assessmentsendpoint)
+        if (stale is not None and self._serverfilter and patient_id in self._highwater
+                and not self._fullSyncDue(patient_id)):
+            return None, self._assessmentsUrl(assessmentsendpoint, since=self._highwater[patient_id][0]), stale, True
+        return None, self._assessmentsUrl(assessmentsendpoint), stale, False
+
+    def _fullSyncDue(self, patient_id):
+        """ True if a patient's cached list should be loaded in full rather than delta synced """
+        last = self._fullsyncs.get(patient_id)
+        return (last is None or last[1] >= FULL_SYNC_EVERY
+                or time.ticks_diff(time.ticks_ms(), last[0]) >= FULL_SYNC_MAX_AGE * 1000)
+
+    def _loadedAssessments(self, patient_id, url, stale, delta, items, timeout=None, cache=True):
+        """
+        Build (or bring up to date) and cache a patient's assessment cursor
+        from the first page fetched for a _planAssessments plan. The page is
+        an ItemsStream, or a parsed collection from the async client. If
+        cache is False, a list that was not cached before is not cached.
+        """
+        assessmentsendpoint = f'{ASSESSMENTS}/{patient_id}'
+        if delta:
+            if self._syncAssessments(patient_id, stale, url, items, timeout):
+                self._cache.put(assessmentsendpoint, stale, self._assessmentsTtl())
+            return stale
+        if items is NOT_MODIFIED:
+            # Nothing changed since the last full load, so it counts as one
+            self._syncs['revalidated'] += 1
+            self._fullsyncs[patient_id] = [time.ticks_ms(), 0]
+            self._cache.put(assessmentsendpoint, stale, self._assessmentsTtl())
+            return stale
+        if items is None:
+            # Failed - the expired list, or an empty one (not cached)
+            return stale if stale is not None else []
+        self._syncs['full'] += 1
+        self._fullsyncs[patient_id] = [time.ticks_ms(), 0]
+        self._highwater.pop(patient_id, None)
+        assessments = self._newCursor(assessmentsendpoint, self._makeAssessment,
+                                      self._assessmentKeep(), self._assessmentrows,
+                                      lambda rows: self._raiseHighwater(patient_id, rows))
+        assessments.addPage(items, url)
+        if cache or stale is not None:
+            self._cache.put(assessmentsendpoint, assessments, self._assessmentsTtl())
+        return assessments
+
+    def _syncAssessments(self, patient_id, assessments, url, items, timeout=None):
+        """
+        Merge the assessments newer than the patient's high-water mark in at
+        the front (newest first) of the cached list. items is the first page
+        of them, fetched from url; further pages are fetched here. Returns
+        False if they could not be fetched.
+        """
+        assessmentsendpoint = f'{ASSESSMENTS}/{patient_id}'
+        newrows = []
+        while items is not NOT_MODIFIED:
+            if items is None:
+                return False
+            if isinstance(items, dict):
+                rows, fields = items.get('items', []), items
+            else:
+                rows, fields = items, None
+            keep = self._assessmentKeep()
+            for item in rows:
+                assessment = self._makeAssessment(item)
+                if keep is None or keep(assessment):
+                    newrows.append(assessment)
+            url = nextPageUrl(fields if fields is not None else items.fields, url)
+            if url is None:
+                break
+            items = self._net.getItems(url, conditional=True, timeout=timeout)
+        self._syncs['delta'] += 1
+        if patient_id in self._fullsyncs:
+            self._fullsyncs[patient_id][1] += 1
+        if newrows:
+            Log.d(f'DAL: {len(newrows)} new assessments for patient {patient_id}')
+            self._syncs['delta_rows'] += len(newrows)
+            self._applyReviews(newrows)
+            assessments.prepend(newrows)
+            self._raiseHighwater(patient_id, newrows)
+            self._cache.resize(assessmentsendpoint)
+        return True
+
+    def _raiseHighwater(self, patient_id, assessments):
+        """ Move a patient's high-water mark up to the newest of some assessments """
+        mark = self._highwater.get(patient_id)
+        for assessment in assessments:
+            if mark is None or assessment._assessment_id > mark[0]:
+                mark = (assessment._assessment_id, assessment._datetime)
+        if mark is not None:
+            self._highwater[patient_id] = mark
+
+    def getSyncStats(self):
+        """
+        Get the number of full assessment loads, full reloads answered with
+        a 304, delta syncs, and rows the deltas brought
+        """
+        return dict(self._syncs)
+
+    def getFlightStats(self):
+        """
+        Get the number of async reads that went to the network and how many
+        requests were saved by sharing one already in flight
+        """
+        return self._flights.getStats()
+
+    def _assessmentsUrl(self, endpoint, since=None):
+        """
+        The URL of the first page of a patient's assessments. With the server
+        filter on, an ORDS q= filter asks for unreviewed rows only (if
+        wanted), newest first, and only those after assessment_id since for a
+        delta sync. The page size is cut down to the row limit.
+        """
+        limit = PAGE_LIMIT
+        if self._assessmentrows is not None:
+            limit = max(1, min(limit, self._assessmentrows))
+        url = f'{endpoint}?limit={limit}'
+        if self._serverfilter:
+            query = '"$orderby":{"assessment_dt":"desc"}'
+            if self._unreviewedonly:
+                query = '"provider_reviewed":{"$eq":"N"},' + query
+            if since is not None:
+                query = f'"assessment_id":{{"$gt":{since}}},' + query
+            url += '&q=' + quote('{' + query + '}')
+        return url
+
+    def _assessmentKeep(self):
+        """ The client-side filter for assessment rows, or None to keep them all """
+        if self._unreviewedonly:
+            return self._isUnreviewed
+        return None
+
+    def _isUnreviewed(self, assessment):
+        return assessment._reviewed != 'Y' and not self._reviews.isPending(assessment._assessment_id)
+
+    def _newCursor(self, endpoint, make, keep=None, maxrows=None, onrows=None):
         """
-        Update the provider_reviewed status for a specific assessment.
+        A cursor that loads further pages of a collection on demand. Each
+        page gets any queued review marks applied, and the cache's size
+        estimate of the collection is updated as it grows. keep and maxrows
+        are passed on to filter and cap the rows (see PagedCursor), and
+        onrows(rows) is called with the rows of each page.
+        """
+        def onpage(cursor, rows):
+            self._applyReviews(rows)
+            if onrows is not None:
+                onrows(rows)
+            self._cache.resize(endpoint)
+        return PagedCursor(make, self._fetchPage, onpage=onpage, keep=keep, maxrows=maxrows,
+                           key=self._rowKey)
+
+    def _rowKey(self, row):
+        """ The id of a patient or assessment row """
+        if hasattr(row, '_assessment_id'):
+            return row._assessment_id
+        return getattr(row, '_patient_id', None)
+
+    def _fetchPage(self, url):
+        """ Fetch one further page of a collection for a cursor """
+        return self._net.getItems(url)
+
+    def putProviderReviewed(self, assessment_id, patient_id=None):
+        """
+        Mark a specific assessment as reviewed by the provider.
         
-        Sends a PUT request to mark an assessment as reviewed by the provider.
-        This updates the provider_reviewed flag to 'Y' for the specified assessment.
+        The mark is applied to the in-memory assessments straight away and
+        queued in a durable write-behind queue; poll() sends it to the
+        backend (as a PUT that sets provider_reviewed to 'Y') in the
+        background, retrying if that fails. Marking the same assessment
+        again before it has been sent is coalesced into a single request.
+        When only unreviewed assessments are shown, the assessment is
+        removed from the in-memory lists.
         
         Args:
             assessment_id (int): The unique identifier of the assessment to
                                mark as provider reviewed.
+            patient_id (int): The patient the assessment belongs to. If not
+                            given, it is looked up in the last fetched
+                            assessments.
         
         Returns:
-            tuple: A tuple containing (status_code, json_data) if successful,
-                   or None if the request fails. The status_code is an HTTP
-                   status code and json_data is the JSON response from the API.
+            bool: True if the mark was queued, False if it was already queued.
+        """
+        if patient_id is None:
+            for assessment in self._assessments:
+                if assessment._assessment_id == assessment_id:
+                    patient_id = assessment._patient_id
+                    break
+        queued = self._reviews.add(assessment_id, patient_id)
+        lists = [self._assessments]
+        if patient_id is not None:
+            cached = self._cache.getStale(f'{ASSESSMENTS}/{patient_id}')
+            if cached is not None and cached is not self._assessments:
+                lists.append(cached)
+        for assessments in lists:
+            self._applyReviews(assessments)
+            if self._unreviewedonly and isinstance(assessments, PagedCursor):
+                assessments.discard(lambda assessment: assessment._reviewed == 'Y')
+        return queued
+
+    def sendProviderReviewed(self, assessment_id, token=None):
+        """
+        Send a PUT request marking an assessment as reviewed, right away.
+        Used by the review queue to flush queued marks, so it is cut off
+        after BACKGROUND_TIMEOUT seconds.
+        
+        Args:
+            assessment_id (int): The unique identifier of the assessment to
+                               mark as provider reviewed.
+            token (str): The idempotency token of the mark, the same for
+                       every attempt at it.
+        
+        Returns:
+            (result, status): result is True if the backend accepted it,
+            False if it should be retried, or None if the backend rejected
+            it for good (a 4xx status). status is the HTTP status, or None
+            if no answer came back.
         """
         reviewedendpoint = f"{REVIEWED}{assessment_id}"
-        response = self._net.putJson(reviewedendpoint)
-        return response
+        response = self._net.putJson(reviewedendpoint, headers=self._writeHeaders(token),
+                                     timeout=BACKGROUND_TIMEOUT)
+        return self._writeResult(response), response[0] if response else None
+
+    def _writeOutcome(self, response, attempts):
+        """ The outcome (see Retry.OUTCOMES) of attempt number attempts at a write """
+        result = self._writeResult(response)
+        if result:
+            return OK
+        if result is None:
+            return REJECTED
+        return GAVE_UP if self._writeretry.exhausted(attempts) else RETRY
+
+    def _writeHeaders(self, token):
+        if token is None:
+            return None
+        return {IDEMPOTENCY_HEADER: token}
+
+    def getWriteStats(self):
+        """
+        Get the attempts at each kind of write (review, post) and how they
+        turned out, with the most recent attempts (see Retry.WriteMetrics)
+        """
+        return {'writes': self._writes.getStats(), 'recent': self._writes.recent()}
+
+    def _writeResult(self, response):
+        """ Classify the response to a write: True if done, False to retry, None if rejected """
+        if response is None:
+            return False
+        status = response[0]
+        if status < 300:
+            return True
+        if status < 500 and status != 408 and status != 429:
+            return None
+        return False
+
+    def _applyReviews(self, assessments):
+        """
+        Mark any assessments still waiting in the review queue as reviewed, so
+        lists fetched before the queue is flushed do not undo local marks.
+        """
+        for assessment in assessments:
+            if hasattr(assessment, '_assessment_id') and self._reviews.isPending(assessment._assessment_id):
+                assessment._reviewed = 'Y'
+
+    def _makeRFIDTag(self, response):
+        return RFIDTag(response['provider_id'],
+                        response['card_code'],
+                        response['card_status'])
+
+    def _makeProvider(self, response):
+        return Provider(response['provider_id'],
+                        response['first_name'],
+                        response['last_name'],
+                        response['title'],
+                        response['specialty'])
+
+    def _makePatient(self, item):
+        return Patients(item['patient_id'],
+                        item['first_name'],
+                        item['last_name'],
+                        item['birth_date'])
+
+    def _makeAssessment(self, item):
+        return HealthAssessments(item['assessment_id'],
+                                    item['patient_id'],
+                                    item['assessment_dt'],
+                                    item['assessment_result'],
+                                    item['provider_id'],
+                                    item['provider_reviewed'])
+
+    # Coroutine versions of the calls above, built on the async Net client.
+    # They share the cache with the blocking calls, and several of them can
+    # be awaited together (e.g. with asyncio.gather) to overlap requests.
+
+    async def apostAssessments(self):
+        """
+        The coroutine version of postAssessments. It is the same post, with
+        the same idempotency token, retry schedule and write metrics, but a
+        failed attempt is retried here, after sleeping for the backoff,
+        rather than from poll().
+        """
+        while True:
+            if not self._postStarted(await self._aensureNetwork()):
+                return None
+            start = time.ticks_ms()
+            response = await self._net.apostJson(f"{ASSESSMENTS}", headers={IDEMPOTENCY_HEADER: self._posttoken})
+            if self._postDone(response, start) != RETRY:
+                return response
+            await asyncio.sleep(self._writeretry.delay(self._postattempts) / 1000)
+
+    async def _aensureNetwork(self, max_wait=10):
+        """
+        The coroutine version of _ensureNetwork: the connection is waited
+        for by polling it between sleeps, so the event loop keeps running
+        """
+        if self._net.isConnected():
+            return True
+        if self._supervised:
+            return False
+        try:
+            self._net.startConnect(SSID, PASSWORD)
+        except Exception as e:
+            Log.e(f'DAL: could not start connecting: {e}')
+            return False
+        deadline = time.ticks_add(time.ticks_ms(), max_wait * 1000)
+        while time.ticks_diff(deadline, time.ticks_ms()) > 0:
+            connected = self._net.checkConnecting()
+            if connected is not None:
+                return connected
+            await asyncio.sleep(0.1)
+        return False
+
+    async def agetRFIDTag(self, rfidtag):
+        """ The coroutine version of getRFIDTag """
+        rfidendpoint = f'{RFID}{rfidtag}'
+        cached = self._cache.get(rfidendpoint)
+        if cached is None:
+            async def load():
+                response = await self._net.agetJson(rfidendpoint)
+                return self._lookupResult(rfidendpoint, response, self._makeRFIDTag, 'provider_id', RFID_TTL)
+            cached = await self._flights.run(rfidendpoint, load)
+        self._rfidtag = cached
+        return self._rfidtag
+
+    async def agetProvider(self, provider_id):
+        """ The coroutine version of getProvider """
+        providerendpoint = f'{PROVIDER}{provider_id}'
+        cached = self._cache.get(providerendpoint)
+        if cached is None:
+            async def load():
+                response = await self._net.agetJson(providerendpoint)
+                return self._lookupResult(providerendpoint, response, self._makeProvider, 'provider_id', PROVIDER_TTL)
+            cached = await self._flights.run(providerendpoint, load)
+        self._provider = cached
+        return self._provider
+
+    async def agetPatients(self, provider_id):
+        """ The coroutine version of getPatients """
+        patientsendpoint = f'{PATIENTS}{provider_id}'
+        self._patients = await self._aloadList(patientsendpoint, f'{patientsendpoint}?limit={PAGE_LIMIT}',
+                                               self._makePatient, PATIENTS_TTL)
+        return self._patients
+
+    async def agetAssessments(self, patient_id):
+        """ The coroutine version of getAssessments """
+        self._assessments = await self._aloadAssessments(patient_id)
+        return self._assessments
+
+    async def aprefetchAssessments(self, patient_id):
+        """ The coroutine version of prefetchAssessments """
+        await self._aloadAssessments(patient_id)
+
+    async def asendProviderReviewed(self, assessment_id, token=None):
+        """
+        The coroutine version of sendProviderReviewed. It makes the whole
+        write rather than one attempt at it: every attempt carries the same
+        idempotency token (token, or a new one), failed attempts are retried
+        after the backoff of the DAL's retry schedule, and each attempt is
+        recorded in getWriteStats. Returns True if the backend accepted it,
+        None if it rejected it and False if the retries ran out.
+        """
+        if token is None:
+            token = makeToken()
+        attempts = 0
+        while True:
+            attempts += 1
+            start = time.ticks_ms()
+            response = await self._net.aputJson(f"{REVIEWED}{assessment_id}", headers=self._writeHeaders(token))
+            outcome = self._writeOutcome(response, attempts)
+            self._writes.record('review', assessment_id, attempts, outcome,
+                                time.ticks_diff(time.ticks_ms(), start), response[0] if response else None)
+            if outcome != RETRY:
+                return self._writeResult(response)
+            await asyncio.sleep(self._writeretry.delay(attempts) / 1000)
+
+    async def _aloadAssessments(self, patient_id):
+        """
+        The coroutine version of _loadAssessments. The first page is fetched
+        with the async client; further pages of a delta sync, like later
+        pages of the cursor, with the blocking one.
+        """
+        assessmentsendpoint = f'{ASSESSMENTS}/{patient_id}'
+        cached = self._cache.get(assessmentsendpoint)
+        if cached is not None:
+            return cached
+        async def load():
+            cached, url, stale, delta = self._planAssessments(patient_id)
+            if cached is not None:
+                return cached
+            page = await self._net.agetJson(url, conditional=stale is not None)
+            return self._loadedAssessments(patient_id, url, stale, delta, page)
+        return await self._flights.run(assessmentsendpoint, load)
+
+    async def _aloadList(self, endpoint, url, make, ttl):
+        """
+        Get a collection from the cache, or revalidate/fetch its first page
+        (url) with the async client and build the model objects with make.
+        Later pages are loaded by the cursor with the blocking client.
+        Callers asking for an endpoint that is already being fetched share
+        that fetch.
+        """
+        cached = self._cache.get(endpoint)
+        if cached is not None:
+            return cached
+        return await self._flights.run(endpoint, lambda: self._afetchList(endpoint, url, make, ttl))
+
+    async def _afetchList(self, endpoint, url, make, ttl):
+        stale = self._cache.getStale(endpoint)
+        response = await self._net.agetJson(url, conditional=stale is not None)
+        if response is NOT_MODIFIED:
+            self._cache.put(endpoint, stale, ttl)
+            return stale
+        if response is None:
+            return stale if stale is not None else []
+        models = self._newCursor(endpoint, make)
+        models.addPage(response, url)
+        self._cache.put(endpoint, models, ttl)
+        return models
 
 if __name__=='__main__':
     d = DAL()
@@ -179,5 +1181,6 @@ if __name__=='__main__':
     patients = [p.__dict__ for p in d.getPatients(provider_id)] # get all patients for provider_id = 1
     assessments = [a.__dict__ for a in d.getAssessments(patients[1]['_patient_id'])] # get all assessments for the second patient returned
     provider_reviewed = d.putProviderReviewed(1) # update assessment_id = 1 to PROVIDER_REVIEWED = 'Y'
+    d.flushReviews() # send the queued review mark now rather than waiting for poll()
     print(f"Assessment Result: {assessments[0]['_result']}\nAssessment Datetime: {assessments[0]['_datetime']}") # display assessment result and datetime
     
\ No newline at end of file
@@ -0,0 +1,132 @@
+"""
+Inflate.py - streaming decompression of gzip/deflate response bodies
+
+The JSON sent by the REST endpoints repeats the same key names in every
+row, so it compresses very well. Net asks for compressed responses with an
+Accept-Encoding header, and when the server sends one, wraps the response
+in an InflatedBody. That decompresses the body a little at a time as it is
+read, so it can be handed straight to the ItemsStream parser without the
+whole body (compressed or not) ever being in memory.
+
+On the Pico this uses the deflate module (MicroPython 1.21 and later) or
+zlib.DecompIO on older firmware; on a host it uses zlib.decompressobj.
+
+Basic usage:
+
+body = InflatedBody(response, 'gzip')
+for item in ItemsStream(body):
+    ...
+"""
+
+import io
+try:
+    import deflate
+except ImportError:
+    deflate = None
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
+# Content-Encodings we can decompress, in order of preference
+ACCEPT_ENCODING = 'gzip, deflate'
+# Compressed bytes read from the response at a time (host only)
+INFLATE_CHUNK = 256
+
+def canInflate(encoding):
+    """ True if a body sent with this Content-Encoding can be decompressed here """
+
+    if encoding not in ('gzip', 'deflate'):
+        return False
+    return deflate is not None or zlib is not None
+
+class BodyStream(io.IOBase):
+    """
+    Presents the compressed body as a MicroPython stream, which is what
+    DeflateIO/DecompIO read from. Counts the bytes that came off the wire.
+    """
+
+    def __init__(self, source):
+        self._source = source
+        self.count = 0
+
+    def readinto(self, buf):
+        # Straight into the decompressor's buffer, without a bytes copy
+        count = self._source.readinto(buf)
+        self.count += count
+        return count
+
+    def read(self, size=-1):
+        data = self._source.read(size)
+        self.count += len(data)
+        return data
+
+class InflatedBody:
+    """
+    A read(n)-able view of a compressed response body that returns the
+    decompressed bytes. compressed and inflated count the bytes read from
+    the wire and handed out, so callers can see what compression saved.
+    """
+
+    def __init__(self, response, encoding):
+        self._response = response
+        self._raw = BodyStream(response)
+        self._buf = b''
+        self._done = False
+        self._stream = None
+        self._decomp = None
+        self.inflated = 0
+        gzip = encoding == 'gzip'
+        if deflate is not None:
+            self._stream = deflate.DeflateIO(self._raw, deflate.GZIP if gzip else deflate.ZLIB)
+        elif hasattr(zlib, 'decompressobj'):
+            self._decomp = zlib.decompressobj(31 if gzip else 15)
+        else:
+            self._stream = zlib.DecompIO(self._raw, 31 if gzip else 15)
+
+    @property
+    def compressed(self):
+        return self._raw.count
+
+    def read(self, size=-1):
+        """ Read up to size decompressed bytes (all that is left if negative) """
+
+        if size < 0:
+            parts = []
+            while True:
+                part = self.read(1024)
+                if not part:
+                    return b''.join(parts)
+                parts.append(part)
+        if self._stream is not None:
+            data = self._stream.read(size) or b''
+        else:
+            while len(self._buf) < size and not self._done:
+                chunk = self._raw.read(INFLATE_CHUNK)
+                if chunk:
+                    self._buf += self._decomp.decompress(chunk)
+                else:
+                    self._buf += self._decomp.flush()
+                    self._done = True
+            data = self._buf[:size]
+            self._buf = self._buf[size:]
+        self.inflated += len(data)
+        return data
+
+    def close(self):
+        """
+        Finish with the response. Anything left after the end of the
+        compressed data is drained so the connection can be reused.
+        """
+
+        if self._response is not None:
+            # A body spilled to flash has no connection left to drain
+            if not getattr(self._response, 'spilled', False):
+                self._response.read()
+            self._response.close()
+            self._response = None
+
+def inflate(data, encoding):
+    """ Decompress a whole body that was sent with Content-Encoding encoding """
+
+    return InflatedBody(io.BytesIO(data), encoding).read()
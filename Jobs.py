@@ -0,0 +1,96 @@
+"""
+Jobs.py - rate-limited background jobs for the controller loop
+
+A PeriodicJob wraps a function that should run in the background now and
+then, without ever running more often than a minimum interval. Callers
+trigger() the job whenever it would be useful to run; the job then runs
+from poll() (called from the controller's loop) as soon as the interval
+since the last run has passed, plus a random jitter so that many devices
+do not all hit the backend at the same moment. Triggers that arrive while
+the job is waiting or running are merged into that one run.
+
+Basic usage:
+
+job = PeriodicJob('generate', dal.postAssessments, interval=300, jitter=30)
+job.trigger()       # e.g. every time the idle screen is shown
+job.poll()          # call regularly - runs the function when due
+"""
+
+import time
+import random
+from Log import *
+
+class PeriodicJob:
+    """
+    A background job that runs at most once every interval seconds, and
+    only when it has been triggered (or on every interval if periodic).
+    """
+
+    def __init__(self, name, func, interval, jitter=0, periodic=False):
+        """
+        func is called with no arguments. interval and jitter are in seconds;
+        each run is delayed by a random 0..jitter seconds on top of the
+        interval. A periodic job triggers itself again after every run.
+        """
+
+        self._name = name
+        self._func = func
+        self._interval = interval
+        self._jitter = jitter
+        self._periodic = periodic
+        self._triggered = periodic
+        self._inflight = False
+        self._lastrun = None
+        self._due = time.ticks_ms()
+        self._runs = 0
+        self._skipped = 0
+        self._failures = 0
+
+    def trigger(self):
+        """
+        Ask for the job to run. It runs on a later poll, once the minimum
+        interval since the previous run (plus jitter) has passed.
+        """
+
+        if self._triggered or self._inflight:
+            self._skipped += 1
+            return
+        self._triggered = True
+        delay = random.randint(0, int(self._jitter * 1000)) if self._jitter else 0
+        if self._lastrun is None:
+            self._due = time.ticks_add(time.ticks_ms(), delay)
+        else:
+            self._due = time.ticks_add(self._lastrun, int(self._interval * 1000) + delay)
+
+    def isDue(self):
+        return self._triggered and not self._inflight and time.ticks_diff(time.ticks_ms(), self._due) >= 0
+
+    def poll(self):
+        """ Run the job if it has been triggered and is due. Returns True if it ran """
+
+        if not self.isDue():
+            return False
+        self._inflight = True
+        self._triggered = False
+        try:
+            self._func()
+        except Exception as e:
+            self._failures += 1
+            Log.e(f'{self._name}: job failed: {e}')
+        finally:
+            self._inflight = False
+            self._lastrun = time.ticks_ms()
+            self._runs += 1
+        if self._periodic:
+            self.trigger()
+        return True
+
+    def getStats(self):
+        """ Get a dictionary with the run, skipped trigger and failure counts """
+
+        return {
+            'runs': self._runs,
+            'skipped': self._skipped,
+            'failures': self._failures,
+            'pending': self._triggered
+        }
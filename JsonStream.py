@@ -0,0 +1,190 @@
+"""
+JsonStream.py - incremental parsing of ORDS collection responses
+
+ORDS returns collections as a single JSON object with the rows in an
+"items" array, plus a few small members such as "hasMore", "count" and
+"links". Building that whole document with json.loads needs the entire body
+and the entire dict tree in RAM at once. ItemsStream instead reads the body
+in fixed-size chunks and yields one element of the items array at a time,
+so peak memory depends on the size of one row rather than the whole response.
+
+Basic usage:
+
+stream = ItemsStream(response)      # anything with a read(n) method
+for item in stream:
+    print(item['patient_id'])
+print(stream.fields)                # the other top level members, e.g. hasMore
+"""
+
+import json
+
+# Number of bytes read from the source at a time
+CHUNK_SIZE = 256
+
+WHITESPACE = b' \t\r\n'
+# Bytes that end a number or a true/false/null literal
+DELIMITERS = b' \t\r\n,}]'
+QUOTE = 0x22       # "
+BACKSLASH = 0x5c   # \
+OPENERS = b'{['
+CLOSERS = b'}]'
+
+class ItemsStream:
+    """
+    Iterates over the elements of one array member (items by default) of a
+    top-level JSON object, parsing each element on its own. Every other
+    top-level member is parsed normally and stored in the fields dictionary,
+    which is complete once iteration has finished.
+    """
+
+    def __init__(self, source, key='items', chunksize=CHUNK_SIZE):
+        """
+        source is anything with a read(n) method returning bytes, such as an
+        HttpResponse. If it has a close method, it is called once the end of
+        the document has been reached or parsing fails.
+        """
+
+        self._source = source
+        self._key = key
+        self._chunksize = chunksize
+        self._buf = b''
+        self._pos = 0
+        self.fields = {}
+        self.count = 0
+
+    def _fill(self):
+        """ Read the next chunk into the buffer. Returns False at end of input """
+
+        more = self._source.read(self._chunksize)
+        if not more:
+            return False
+        self._buf = self._buf[self._pos:] + more
+        self._pos = 0
+        return True
+
+    def _next(self):
+        """ Skip whitespace and return the next byte without consuming it """
+
+        while True:
+            while self._pos < len(self._buf):
+                c = self._buf[self._pos]
+                if c not in WHITESPACE:
+                    return c
+                self._pos += 1
+            if not self._fill():
+                raise ValueError('unexpected end of JSON')
+
+    def _expect(self, chars):
+        c = self._next()
+        if c not in chars:
+            raise ValueError(f'unexpected {chr(c)!r} in JSON')
+        self._pos += 1
+        return c
+
+    def _readRaw(self):
+        """
+        Consume exactly one JSON value and return its raw bytes. Only the value
+        itself is held in memory, never more than that plus one chunk.
+        """
+
+        first = self._next()
+        parts = []
+        start = self._pos
+        pos = self._pos
+        depth = 0
+        instring = False
+        escaped = False
+        if first == QUOTE:
+            instring = True
+            pos += 1
+        elif first in OPENERS:
+            depth = 1
+            pos += 1
+        while True:
+            buf = self._buf
+            while pos < len(buf):
+                c = buf[pos]
+                if instring:
+                    if escaped:
+                        escaped = False
+                    elif c == BACKSLASH:
+                        escaped = True
+                    elif c == QUOTE:
+                        instring = False
+                        if depth == 0:
+                            pos += 1
+                            parts.append(buf[start:pos])
+                            self._pos = pos
+                            return b''.join(parts)
+                elif depth == 0:
+                    # A number or literal runs until the next delimiter
+                    if c in DELIMITERS:
+                        parts.append(buf[start:pos])
+                        self._pos = pos
+                        return b''.join(parts)
+                elif c == QUOTE:
+                    instring = True
+                elif c in OPENERS:
+                    depth += 1
+                elif c in CLOSERS:
+                    depth -= 1
+                    if depth == 0:
+                        pos += 1
+                        parts.append(buf[start:pos])
+                        self._pos = pos
+                        return b''.join(parts)
+                pos += 1
+            # Ran out of buffer in the middle of the value - keep what we
+            # have and read another chunk
+            parts.append(buf[start:pos])
+            self._pos = pos
+            if not self._fill():
+                if depth == 0 and not instring:
+                    return b''.join(parts)
+                raise ValueError('unexpected end of JSON')
+            start = 0
+            pos = 0
+
+    def _readValue(self):
+        return json.loads(self._readRaw().decode())
+
+    def __iter__(self):
+        try:
+            self._expect(b'{')
+            if self._next() == ord('}'):
+                self._pos += 1
+                return
+            while True:
+                key = self._readValue()
+                self._expect(b':')
+                if key == self._key and self._next() == ord('['):
+                    self._pos += 1
+                    if self._next() == ord(']'):
+                        self._pos += 1
+                    else:
+                        while True:
+                            item = self._readValue()
+                            self.count += 1
+                            yield item
+                            if self._expect(b',]') == ord(']'):
+                                break
+                else:
+                    self.fields[key] = self._readValue()
+                if self._expect(b',}') == ord('}'):
+                    break
+        finally:
+            if hasattr(self._source, 'close'):
+                self._source.close()
+
+if __name__ == '__main__':
+    import io
+    doc = json.dumps({
+        'items': [{'patient_id': i, 'first_name': 'A "quoted" name', 'tags': [1, {'x': '}'}]} for i in range(5)],
+        'hasMore': False,
+        'count': 5,
+        'links': [{'rel': 'self', 'href': 'https://example.com/'}]
+    }).encode()
+    stream = ItemsStream(io.BytesIO(doc), chunksize=7)
+    for item in stream:
+        print(item)
+    print(stream.fields)
@@ -0,0 +1,215 @@
+"""
+Link.py - keeps the Wi-Fi link up between requests
+
+Without supervision an outage is only found when a request fails, in the
+middle of whatever the provider was doing. A LinkSupervisor checks the
+link every few seconds from the controller loop, reconnects with
+exponential backoff when it drops, and tells a handler about it with
+'link_down' and 'link_up' events so the controller can react right away.
+
+Reconnecting is quick because the access point (BSSID and channel) of the
+last good association is remembered, on flash so it also speeds up the
+next boot, and connected to directly instead of scanning for it. If that
+access point cannot be reached any more, the next attempt scans as usual.
+
+Basic usage:
+
+link = LinkSupervisor(net, SSID, PASSWORD, handler=controller.linkEvent)
+link.start()        # start associating without waiting
+link.poll()         # call regularly - checks and reconnects the link
+"""
+
+import os
+import time
+import json
+try:
+    import ubinascii
+except ImportError:
+    import binascii as ubinascii
+from Log import *
+
+LINK_FILE = 'wifilink.json'
+# How often the link is checked while it is up
+LINK_CHECK_MS = 2000
+# Longest wait for one association attempt
+ASSOCIATE_TIMEOUT_MS = 10000
+# Wait before reconnecting doubles from MIN to MAX after each failure
+RECONNECT_MIN_MS = 1000
+RECONNECT_MAX_MS = 60000
+
+UP = 'up'
+DOWN = 'down'
+CONNECTING = 'connecting'
+
+class LinkSupervisor:
+    """
+    Watches the station link of a Net and reconnects it. handler(event) is
+    called with 'link_up' or 'link_down' whenever the link changes.
+    """
+
+    def __init__(self, net, ssid, password=None, handler=None, path=LINK_FILE):
+        self._net = net
+        self._ssid = ssid
+        self._password = password
+        self._handler = handler
+        self._path = path
+        self._state = DOWN
+        self._attemptstart = 0
+        self._usedbssid = False
+        self._nextcheck = time.ticks_ms()
+        self._backoff = 0
+        self._bssid = None
+        self._channel = None
+        self._drops = 0
+        self._reconnects = 0
+        self._failures = 0
+        self._lastconnectms = None
+        self._load()
+
+    def _load(self):
+        """ Read the access point of the last good association from flash """
+
+        try:
+            with open(self._path) as f:
+                saved = json.load(f)
+            if saved.get('ssid') == self._ssid:
+                self._bssid = ubinascii.unhexlify(saved['bssid'])
+                self._channel = saved.get('channel')
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _save(self):
+        try:
+            with open(self._path, 'w') as f:
+                json.dump({'ssid': self._ssid, 'bssid': ubinascii.hexlify(self._bssid).decode(),
+                           'channel': self._channel}, f)
+        except OSError as e:
+            Log.e(f'LinkSupervisor: could not write {self._path}: {e}')
+
+    def _forget(self):
+        """ Drop the remembered access point, so the next attempt scans """
+
+        self._bssid = None
+        self._channel = None
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+    def setHandler(self, handler):
+        self._handler = handler
+
+    def _event(self, event):
+        Log.i(f'LinkSupervisor: {event}')
+        if self._handler is not None:
+            try:
+                self._handler(event)
+            except Exception as e:
+                Log.e(f'LinkSupervisor: handler failed on {event}: {e}')
+
+    def isUp(self):
+        return self._state == UP
+
+    def start(self):
+        """
+        Start an association attempt without waiting for it, using the
+        remembered access point if there is one. Returns False if it could
+        not be started.
+        """
+
+        self._attemptstart = time.ticks_ms()
+        self._usedbssid = self._bssid is not None
+        try:
+            self._net.startConnect(self._ssid, self._password, bssid=self._bssid, force=True,
+                                  channel=self._channel)
+        except Exception as e:
+            Log.e(f'LinkSupervisor: could not start connecting: {e}')
+            self._failed()
+            return False
+        self._state = CONNECTING
+        return True
+
+    def wait(self, max_wait=10):
+        """
+        Wait up to max_wait seconds for the attempt started by start(). Returns
+        True if the link is up.
+        """
+
+        deadline = time.ticks_add(time.ticks_ms(), max_wait * 1000)
+        while self._state == CONNECTING and time.ticks_diff(deadline, time.ticks_ms()) > 0:
+            self._checkAttempt()
+            if self._state == CONNECTING:
+                time.sleep(0.1)
+        return self._state == UP
+
+    def _checkAttempt(self):
+        result = self._net.checkConnecting()
+        if result is None and time.ticks_diff(time.ticks_ms(), self._attemptstart) > ASSOCIATE_TIMEOUT_MS:
+            result = False
+        if result is True:
+            self._connected()
+        elif result is False:
+            self._failed()
+
+    def _connected(self):
+        elapsed = time.ticks_diff(time.ticks_ms(), self._attemptstart)
+        if self._lastconnectms is not None:
+            self._reconnects += 1
+        self._lastconnectms = elapsed
+        self._state = UP
+        self._backoff = 0
+        self._nextcheck = time.ticks_add(time.ticks_ms(), LINK_CHECK_MS)
+        Log.i(f"LinkSupervisor: connected in {elapsed} ms{' (known access point)' if self._usedbssid else ''}")
+        if self._bssid is None:
+            found = self._net.findAccessPoint(self._ssid)
+            if found is not None:
+                self._bssid, self._channel = found
+                self._save()
+        self._event('link_up')
+
+    def _failed(self):
+        self._failures += 1
+        self._state = DOWN
+        if self._usedbssid:
+            # The remembered access point may be gone - scan next time
+            self._forget()
+        self._backoff = min(RECONNECT_MAX_MS, self._backoff * 2 if self._backoff else RECONNECT_MIN_MS)
+        self._nextcheck = time.ticks_add(time.ticks_ms(), self._backoff)
+        Log.d(f'LinkSupervisor: reconnecting in {self._backoff} ms')
+
+    def poll(self):
+        """
+        Check the link if a check is due, and start or follow a reconnect.
+        Returns the link state: 'up', 'down' or 'connecting'.
+        """
+
+        if self._state == CONNECTING:
+            self._checkAttempt()
+            return self._state
+        if time.ticks_diff(time.ticks_ms(), self._nextcheck) < 0:
+            return self._state
+        if self._state == UP:
+            if self._net.isConnected():
+                self._nextcheck = time.ticks_add(time.ticks_ms(), LINK_CHECK_MS)
+                return self._state
+            self._drops += 1
+            self._state = DOWN
+            # Kept-alive connections did not survive the outage
+            self._net.closeConnections()
+            self._event('link_down')
+        self.start()
+        return self._state
+
+    def getStats(self):
+        """ Get a dictionary with the link state, drop/reconnect counts and last reconnect time """
+
+        return {
+            'state': self._state,
+            'drops': self._drops,
+            'reconnects': self._reconnects,
+            'failures': self._failures,
+            'last_connect_ms': self._lastconnectms,
+            'backoff_ms': self._backoff,
+            'bssid': ubinascii.hexlify(self._bssid, ':').decode() if self._bssid else None,
+            'channel': self._channel
+        }
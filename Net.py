@@ -10,11 +10,1163 @@ This is not thoroughly tested - use at your own risk.
 """
 
 import time
-import network
-import urequests as requests
-import ubinascii
+import Ticks
+import socket
+import ssl
 import json
+import select
 from Log import *
+from JsonStream import *
+from Inflate import *
+from Timings import *
+from Sntp import *
+from Spill import *
+from Retry import *
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+try:
+    import network
+except ImportError:
+    # On a host (benchmarks, tests against the stand-in server) the
+    # machine's own network is used and there is no Wi-Fi to manage
+    network = None
+try:
+    import ubinascii
+except ImportError:
+    import binascii as ubinascii
+
+# Idle connections older than this are reopened rather than reused, unless
+# the server tells us its own keep-alive timeout
+KEEPALIVE_IDLE = 15
+# Number of URLs whose ETag/Last-Modified validators are remembered
+MAX_VALIDATORS = 32
+# Bytes in the receive buffer each connection reads responses into. It is
+# allocated once per connection; the status line and every header line
+# must fit in it
+RECV_BUFFER = 1024
+
+# Default time limits (seconds) for each phase of a request, and for the
+# request as a whole. DNS lookups cannot be interrupted on the Pico, so a
+# slow one is only reported; every other phase is cut off when it runs
+# over. body is the longest gap allowed between two reads of the body.
+TIMEOUTS = {
+    'dns': 2,
+    'connect': 3,
+    'tls': 5,
+    'first_byte': 5,
+    'body': 5,
+    'total': 15
+}
+# An endpoint that fails this many times in a row is not tried again
+# until its cooldown (seconds) has passed; the cooldown doubles, up to the
+# maximum, every time the trial request after a cooldown fails too
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 30
+BREAKER_MAX_COOLDOWN = 300
+# After a failed Wi-Fi connect, fail fast for this many seconds
+CONNECT_COOLDOWN = 30
+
+# Resolved addresses are reused for DNS_TTL seconds. poll() looks them up
+# again in the background once they are within DNS_REFRESH seconds of
+# expiring, and an expired address is still used if a new lookup fails
+DNS_TTL = 300
+DNS_REFRESH = 60
+DNS_MAX_ENTRIES = 8
+
+# Most connections kept open to one host by the async client, which is
+# also the most requests it has in flight to that host at once
+MAX_ASYNC_CONNECTIONS = 3
+# Most requests getItemsPipelined has sent ahead of the response it is
+# reading
+PIPELINE_DEPTH = 8
+
+# Bodies of collections bigger than this (bytes on the wire) are written
+# to flash and parsed from there (see Spill.py). A chunked body is spilled
+# if its first chunk alone is bigger
+SPILL_THRESHOLD = 16384
+
+# Returned by getJson/getItems for a conditional GET when the server says
+# the resource has not changed (304 Not Modified)
+NOT_MODIFIED = 'NOT_MODIFIED'
+
+def parseUrl(url):
+    """
+    Split a URL into (scheme, host, port, path). Only http and https
+    are supported, which is all the REST endpoints need.
+    """
+
+    scheme, rest = url.split('://', 1)
+    if '/' in rest:
+        hostport, path = rest.split('/', 1)
+        path = '/' + path
+    else:
+        hostport, path = rest, '/'
+    if ':' in hostport:
+        host, port = hostport.split(':', 1)
+        port = int(port)
+    else:
+        host = hostport
+        port = 443 if scheme == 'https' else 80
+    return scheme, host, port, path
+
+def quote(text):
+    """
+    Percent-encode a string for use as a query parameter value, e.g. an
+    ORDS q= filter. MicroPython has no urllib, so this is done by hand.
+    """
+
+    out = []
+    for c in str(text).encode():
+        if (48 <= c <= 57 or 65 <= c <= 90 or 97 <= c <= 122) or c in b'-_.~':
+            out.append(chr(c))
+        else:
+            out.append('%%%02X' % c)
+    return ''.join(out)
+
+class CircuitOpenError(OSError):
+    """ Raised instead of making a request to an endpoint whose circuit is open """
+    pass
+
+def endpointKey(url):
+    """
+    The endpoint a URL belongs to, for the circuit breakers: the URL minus
+    any query and minus the last path segment (the id being looked up)
+    """
+
+    return url.split('?', 1)[0].rsplit('/', 1)[0]
+
+class CircuitBreaker:
+    """
+    Tracks consecutive failures of one endpoint. After threshold failures
+    the circuit opens and allow() returns False until the cooldown has
+    passed; then one trial request is let through, which either closes the
+    circuit again or reopens it with a longer cooldown.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN,
+                 maxcooldown=BREAKER_MAX_COOLDOWN):
+        self._threshold = threshold
+        self._basecooldown = cooldown
+        self._maxcooldown = maxcooldown
+        self._cooldown = cooldown
+        self._failures = 0
+        self._openedat = None
+        self._trial = False
+        self.rejected = 0
+
+    def allow(self):
+        """ True if a request may be made now """
+
+        if self._openedat is None:
+            return True
+        if self._trial:
+            self.rejected += 1
+            return False
+        if time.ticks_diff(time.ticks_ms(), self._openedat) >= self._cooldown * 1000:
+            # Half open - let one request through to see if the endpoint is back
+            self._trial = True
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        self._failures = 0
+        self._openedat = None
+        self._trial = False
+        self._cooldown = self._basecooldown
+
+    def release(self):
+        """
+        Give back the trial request if it was never answered (its connection
+        was lost before it got to the server), so the next request is the
+        trial instead
+        """
+
+        self._trial = False
+
+    def failure(self):
+        self._failures += 1
+        if self._trial:
+            self._cooldown = min(self._maxcooldown, self._cooldown * 2)
+        if self._trial or self._failures >= self._threshold:
+            if self._openedat is None or self._trial:
+                Log.e(f'Net: circuit opened for {self._cooldown} sec')
+            self._openedat = time.ticks_ms()
+        self._trial = False
+
+    def state(self):
+        """ 'closed', 'open' or 'half-open' """
+
+        if self._openedat is None:
+            return 'closed'
+        return 'half-open' if self._trial else 'open'
+
+class Resolver:
+    """
+    A small cache of resolved host addresses, so that every new connection
+    does not need a blocking getaddrinfo round trip. When a lookup fails,
+    the last address that worked is used instead.
+    """
+
+    def __init__(self, ttl=DNS_TTL, refresh=DNS_REFRESH, maxentries=DNS_MAX_ENTRIES):
+        self._ttl = ttl
+        self._refresh = refresh
+        self._maxentries = maxentries
+        # (host, port) -> [address, time resolved]
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self.refreshes = 0
+        self.lookupms = 0
+        self.last = None
+
+    def _lookup(self, host, port):
+        start = time.ticks_ms()
+        addr = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][-1]
+        elapsed = time.ticks_diff(time.ticks_ms(), start)
+        self.lookupms += elapsed
+        self._entries[(host, port)] = [addr, time.ticks_ms()]
+        if len(self._entries) > self._maxentries:
+            oldest = min(self._entries, key=lambda k: time.ticks_diff(self._entries[k][1], start))
+            del self._entries[oldest]
+        return addr, elapsed
+
+    def _age(self, entry):
+        return time.ticks_diff(time.ticks_ms(), entry[1]) / 1000
+
+    def resolve(self, host, port):
+        """
+        The address to connect to for host and port. self.last is set to
+        (cached, ms) describing how this lookup went.
+        """
+
+        entry = self._entries.get((host, port))
+        if entry is not None and self._age(entry) < self._ttl:
+            self.hits += 1
+            self.last = (True, 0)
+            return entry[0]
+        self.misses += 1
+        try:
+            addr, elapsed = self._lookup(host, port)
+        except OSError as e:
+            if entry is None:
+                raise
+            self.fallbacks += 1
+            Log.e(f'Net: lookup of {host} failed ({e}), using last known address')
+            self.last = (True, 0)
+            return entry[0]
+        self.last = (False, elapsed)
+        return addr
+
+    def poll(self):
+        """
+        Look up again one address that is about to expire, so the next
+        connection does not have to wait for it. Returns True if it did.
+        """
+
+        for key in self._entries:
+            if self._age(self._entries[key]) >= self._ttl - self._refresh:
+                try:
+                    self._lookup(key[0], key[1])
+                    self.refreshes += 1
+                except OSError as e:
+                    # Keep the old address; it is retried on the next poll
+                    self._entries[key][1] = time.ticks_add(self._entries[key][1], self._refresh * 1000 // 2)
+                    Log.d(f'Net: refreshing {key[0]} failed: {e}')
+                return True
+        return False
+
+    def invalidate(self, host=None):
+        """ Forget the address of a host, or of every host if host is None """
+
+        for key in list(self._entries):
+            if host is None or key[0] == host:
+                del self._entries[key]
+
+    def getStats(self):
+        """ Get a dictionary with the hit/miss/fallback/refresh counts and lookup time """
+
+        lookups = self.misses - self.fallbacks + self.refreshes
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'fallbacks': self.fallbacks,
+            'refreshes': self.refreshes,
+            'entries': len(self._entries),
+            'lookup_ms': self.lookupms,
+            'mean_lookup_ms': self.lookupms / lookups if lookups else 0
+        }
+
+def makeSslContext():
+    """
+    A client TLS context. Like urequests, the server certificate is not
+    verified - the Pico has no CA bundle to check it against.
+    """
+
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if hasattr(ctx, 'check_hostname'):
+        ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+def hostHeader(scheme, host, port):
+    """ The Host header value - the port is only included if it is not the default """
+
+    if port == (443 if scheme == 'https' else 80):
+        return host
+    return f'{host}:{port}'
+
+def buildRequest(method, host, path, body=None, headers=None):
+    """ Build the request line and headers of an HTTP/1.1 request as bytes """
+
+    lines = [f'{method} {path} HTTP/1.1', f'Host: {host}', 'Connection: keep-alive']
+    if headers:
+        for k in headers:
+            lines.append(f'{k}: {headers[k]}')
+    if body is not None or method in ('POST', 'PUT'):
+        lines.append(f'Content-Length: {len(body) if body else 0}')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+def canResend(method, headers):
+    """
+    True if a request that may already have reached the server can be sent
+    again: a GET or HEAD, or a write carrying an idempotency key (see
+    Retry.py). Other writes may have been carried out already.
+    """
+
+    return method in ('GET', 'HEAD') or (headers is not None and IDEMPOTENCY_HEADER in headers)
+
+def parseStatusLine(line):
+    """ Parse a status line into (status, reason) """
+
+    if not line:
+        raise OSError('connection closed by server')
+    parts = line.decode().split(None, 2)
+    return int(parts[1]), parts[2].strip() if len(parts) > 2 else ''
+
+def parseHeaderLine(line, headers):
+    """
+    Add one header line to the headers dictionary (keys in lower case).
+    Returns False at the blank line that ends the headers.
+    """
+
+    if not line or line == b'\r\n' or line == b'\n':
+        return False
+    k, v = line.decode().split(':', 1)
+    headers[k.strip().lower()] = v.strip()
+    return True
+
+def findByte(buf, needle, start, end):
+    """
+    The offset of the first occurrence of needle (a single byte, as bytes)
+    in buf[start:end], or -1. Uses bytearray.find where the firmware has it.
+    """
+
+    if hasattr(buf, 'find'):
+        return buf.find(needle, start, end)
+    byte = needle[0]
+    for i in range(start, end):
+        if buf[i] == byte:
+            return i
+    return -1
+
+def parseHex(buf, start, end):
+    """ Parse the hex number (a chunk size) at the start of buf[start:end] """
+
+    value = 0
+    for i in range(start, end):
+        c = buf[i] | 0x20
+        if 48 <= c <= 57:
+            value = value * 16 + c - 48
+        elif 97 <= c <= 102:
+            value = value * 16 + c - 87
+        else:
+            break
+    return value
+
+def parseStatusInPlace(buf, start, end):
+    """ Parse the status line in buf[start:end] into (status, reason) without copying it """
+
+    space = findByte(buf, b' ', start, end)
+    if space < 0 or end - space < 4:
+        raise OSError('malformed status line')
+    status = 0
+    for i in range(space + 1, space + 4):
+        status = status * 10 + buf[i] - 48
+    reason = str(memoryview(buf)[space + 5:end], 'utf-8') if end > space + 5 else ''
+    return status, reason
+
+def parseHeaderInPlace(buf, start, end, headers):
+    """
+    Add the header line in buf[start:end] to the headers dictionary (keys
+    in lower case). Only the key and value strings are allocated.
+    """
+
+    colon = findByte(buf, b':', start, end)
+    if colon < 0:
+        return
+    value = colon + 1
+    while value < end and buf[value] in (32, 9):
+        value += 1
+    while end > value and buf[end - 1] in (32, 9):
+        end -= 1
+    view = memoryview(buf)
+    headers[str(view[start:colon], 'utf-8').lower()] = str(view[value:end], 'utf-8')
+
+def keepAliveTimeout(headers, default):
+    """
+    How long (seconds) the server is willing to keep the connection open
+    after this response - 0 if it is closing it.
+    """
+
+    if headers.get('connection', '').lower() == 'close':
+        return 0
+    keepalive = headers.get('keep-alive', '')
+    if 'timeout=' in keepalive:
+        try:
+            return int(keepalive.split('timeout=', 1)[1].split(',', 1)[0])
+        except ValueError:
+            pass
+    return default
+
+class HttpResponse:
+    """
+    The response to a single request on an HttpConnection. Mimics the parts
+    of the urequests Response that we use (status_code, text, json(), close())
+    but knows where the body ends so the connection can be reused afterwards.
+
+    The body is read out of the connection's receive buffer, or straight
+    from the socket with readinto, so it is only ever copied once: into
+    the caller's buffer, or into the bytes that read returns.
+    """
+
+    def __init__(self, conn, status, reason, headers, timing=None):
+        self._conn = conn
+        self._timing = timing
+        self.status_code = status
+        self.reason = reason
+        self.headers = headers
+        self._chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+        self._chunkleft = 0
+        length = headers.get('content-length')
+        self._remaining = int(length) if length is not None else None
+        if status == 204 or status == 304 or (status >= 100 and status < 200):
+            self._remaining = 0
+            self._chunked = False
+        self._done = self._remaining == 0
+        self._content = None
+
+    def _startChunk(self):
+        """ Read the size line of the next chunk. Returns False at the last (empty) chunk """
+
+        conn = self._conn
+        start, end = conn._line()
+        self._chunkleft = parseHex(conn._buf, start, end)
+        if self._chunkleft == 0:
+            # Skip any trailers up to the blank line ending the body
+            while True:
+                start, end = conn._line()
+                if start == end:
+                    break
+            self._done = True
+            return False
+        return True
+
+    def _available(self, size):
+        """ The most body bytes the next read may return, 0 at the end of the body """
+
+        if self._done:
+            return 0
+        if self._chunked:
+            if self._chunkleft == 0 and not self._startChunk():
+                return 0
+            return min(size, self._chunkleft)
+        if self._remaining is None:
+            return size
+        return min(size, self._remaining)
+
+    def _consumed(self, count):
+        """ Account for count body bytes having been read """
+
+        if count == 0:
+            if self._remaining is None and not self._chunked:
+                # No length and not chunked: the body runs until the server closes
+                self._done = True
+                self._conn._keepalive = False
+                return
+            raise OSError('connection closed mid-body')
+        self._conn.received += count
+        if self._timing is not None:
+            self._timing.received += count
+        if self._chunked:
+            self._chunkleft -= count
+            if self._chunkleft == 0:
+                # The line ending after the chunk data
+                self._conn._line()
+        elif self._remaining is not None:
+            self._remaining -= count
+            if self._remaining == 0:
+                self._done = True
+
+    def _failed(self):
+        """ A read failed or timed out - the connection cannot be reused """
+
+        if self._timing is not None:
+            self._timing.ok = False
+        if self._conn is not None:
+            self._conn._keepalive = False
+            self.close()
+
+    def readinto(self, buf):
+        """
+        Read body bytes straight into buf (a bytearray or memoryview) without
+        allocating. Returns the number of bytes read, 0 once the body has
+        been consumed.
+        """
+
+        try:
+            count = self._available(len(buf))
+            if count == 0:
+                return 0
+            start = time.ticks_us()
+            self._conn.setPhase('body')
+            count = self._conn._readinto(memoryview(buf)[:count])
+            self._consumed(count)
+            if self._timing is not None:
+                self._timing.add('body', time.ticks_diff(time.ticks_us(), start))
+            return count
+        except:
+            self._failed()
+            raise
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes of the body (the whole remaining body if size
+        is negative). Returns b'' once the body has been consumed.
+        If the read fails or times out, the connection is closed.
+        """
+
+        if size < 0:
+            return self._readAll()
+        try:
+            count = self._available(size)
+            if count == 0:
+                return b''
+            start = time.ticks_us()
+            conn = self._conn
+            conn.setPhase('body')
+            if conn._head == conn._tail:
+                conn._fill()
+            count = min(count, conn._tail - conn._head)
+            data = bytes(conn._view[conn._head:conn._head + count])
+            conn._head += count
+            self._consumed(count)
+            if self._timing is not None:
+                self._timing.add('body', time.ticks_diff(time.ticks_us(), start))
+            return data
+        except:
+            self._failed()
+            raise
+
+    def _readAll(self):
+        """
+        The rest of the body. When its length is known it is read into one
+        bytearray of that size; otherwise it is read in pieces and joined.
+        """
+
+        if self._remaining is not None and not self._chunked:
+            body = bytearray(self._remaining)
+            view = memoryview(body)
+            got = 0
+            while got < len(body):
+                count = self.readinto(view[got:])
+                if count == 0:
+                    break
+                got += count
+            return body
+        parts = []
+        while True:
+            part = self.read(RECV_BUFFER)
+            if not part:
+                return b''.join(parts)
+            parts.append(part)
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = self.read()
+            self.close()
+        return self._content
+
+    @property
+    def text(self):
+        return str(self.content, 'utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def close(self):
+        """
+        Finish with the response. If the body was fully read and the server
+        allows it, the connection goes back to the pool; otherwise it is closed.
+        """
+
+        if self._conn is None:
+            return
+        if not self._done:
+            self._conn._keepalive = False
+        self._conn.release()
+        self._conn = None
+        if self._timing is not None:
+            self._timing.end()
+
+class HttpConnection:
+    """
+    A single HTTP/1.1 connection to one host that is kept alive between
+    requests. The socket (and for https, the TLS session) is opened on the
+    first request and reused until the server closes it or it sits idle
+    for too long, at which point it is transparently reopened.
+
+    Responses are read with readinto into one receive buffer that is
+    allocated with the connection, and the status line and headers are
+    parsed where they lie in it.
+    """
+
+    def __init__(self, scheme, host, port, timeouts=TIMEOUTS, resolver=None):
+        self._scheme = scheme
+        self._host = host
+        self._port = port
+        self._timeouts = timeouts
+        self._resolver = resolver
+        self._deadline = None
+        self._raw = None
+        self._sock = None
+        self._recvinto = None
+        self._write = None
+        self._buf = bytearray(RECV_BUFFER)
+        self._view = memoryview(self._buf)
+        # Unread data in the receive buffer runs from _head to _tail
+        self._head = 0
+        self._tail = 0
+        self._keepalive = False
+        self._busy = False
+        # Requests sent with send() whose responses have not been read yet
+        self._pending = 0
+        # Closed once its last response is done, instead of being kept alive
+        self._oneoff = False
+        # Bytes of the current request written to the socket so far
+        self._written = 0
+        self._lastused = 0
+        self._idle = KEEPALIVE_IDLE
+        self.opened = 0
+        self.received = 0
+        # Time the last DNS lookup took (ms), and whether it came from the cache
+        self.dnsms = 0
+        self.dnscached = False
+
+    def isOpen(self):
+        return self._sock is not None
+
+    def setPhase(self, phase):
+        """
+        Set the socket timeout for a phase of the current request: the
+        phase's own limit, cut short by the request deadline if that is
+        closer. Raises OSError if the deadline has already passed.
+        """
+
+        limit = self._timeouts[phase]
+        if self._deadline is not None:
+            remaining = time.ticks_diff(self._deadline, time.ticks_ms()) / 1000
+            if remaining <= 0:
+                raise OSError(f'request deadline exceeded in {phase}')
+            limit = min(limit, remaining)
+        # MicroPython TLS sockets take their timeout from the raw socket
+        sock = self._sock if self._sock is not None and hasattr(self._sock, 'settimeout') else self._raw
+        if sock is not None:
+            sock.settimeout(limit)
+
+    def open(self, timing=None):
+        """
+        Open the TCP connection and do the TLS handshake if needed. The
+        time each step takes is added to timing if given.
+        """
+
+        self.close()
+        start = time.ticks_ms()
+        if self._resolver is not None:
+            addr = self._resolver.resolve(self._host, self._port)
+        else:
+            addr = socket.getaddrinfo(self._host, self._port, 0, socket.SOCK_STREAM)[0][-1]
+        self.dnsms = time.ticks_diff(time.ticks_ms(), start)
+        self.dnscached = self._resolver is not None and self._resolver.last[0]
+        if self.dnsms > self._timeouts['dns'] * 1000:
+            Log.e(f'Net: DNS lookup of {self._host} took {self.dnsms} ms')
+        if timing is not None:
+            timing.lap('dns')
+        sock = socket.socket()
+        self._raw = sock
+        try:
+            self.setPhase('connect')
+            sock.connect(addr)
+            if timing is not None:
+                timing.lap('connect')
+            if self._scheme == 'https':
+                self.setPhase('tls')
+                sock = makeSslContext().wrap_socket(sock, server_hostname=self._host)
+                if timing is not None:
+                    timing.lap('tls')
+        except:
+            sock.close()
+            self._raw = None
+            raise
+        self._sock = sock
+        # CPython sockets have recv_into/sendall, MicroPython ones readinto/write
+        self._recvinto = sock.recv_into if hasattr(sock, 'recv_into') else sock.readinto
+        self._write = sock.sendall if hasattr(sock, 'sendall') else sock.write
+        self._head = 0
+        self._tail = 0
+        self._keepalive = True
+        self.opened += 1
+        Log.d(f'Net: opened connection to {self._host}:{self._port}')
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except:
+                pass
+        self._raw = None
+        self._sock = None
+        self._recvinto = None
+        self._write = None
+        self._head = 0
+        self._tail = 0
+        self._keepalive = False
+        self._busy = False
+        self._pending = 0
+
+    def isStale(self):
+        """ True if the connection should not be reused for the next request """
+
+        if self._sock is None or not self._keepalive:
+            return True
+        return time.ticks_diff(time.ticks_ms(), self._lastused) > self._idle * 1000
+
+    def _send(self, method, path, body, headers):
+        """ Write a request. Returns the number of bytes sent """
+
+        head = buildRequest(method, hostHeader(self._scheme, self._host, self._port), path, body, headers)
+        self._written = 0
+        self._write(head)
+        self._written = len(head)
+        if body:
+            self._write(body)
+            self._written += len(body)
+        return self._written
+
+    def _fill(self):
+        """
+        Read more of the response into the receive buffer, after the unread
+        data already there. Returns the number of bytes read, 0 if the
+        server has closed the connection.
+        """
+
+        if self._head == self._tail:
+            self._head = 0
+            self._tail = 0
+        elif self._tail == len(self._buf):
+            if self._head == 0:
+                raise OSError('HTTP header line too long')
+            # Move the unread data to the front to make room
+            count = self._tail - self._head
+            self._buf[:count] = self._view[self._head:self._tail]
+            self._head = 0
+            self._tail = count
+        count = self._recvinto(self._view[self._tail:])
+        if count is None:
+            raise OSError('timed out')
+        self._tail += count
+        return count
+
+    def _line(self):
+        """
+        Consume the next line of the response and return its (start, end)
+        offsets in the receive buffer, without the line ending. The line is
+        only valid until the buffer is read into again.
+        """
+
+        while True:
+            newline = findByte(self._buf, b'\n', self._head, self._tail)
+            if newline >= 0:
+                break
+            if self._fill() == 0:
+                raise OSError('connection closed by server')
+        start = self._head
+        self._head = newline + 1
+        if newline > start and self._buf[newline - 1] == 13:
+            newline -= 1
+        return start, newline
+
+    def _readinto(self, view):
+        """
+        Read up to len(view) bytes into view: what is left in the receive
+        buffer first, otherwise straight from the socket. Returns the count,
+        0 if the server has closed the connection.
+        """
+
+        buffered = self._tail - self._head
+        if buffered:
+            count = min(buffered, len(view))
+            view[:count] = self._view[self._head:self._head + count]
+            self._head += count
+            return count
+        count = self._recvinto(view)
+        if count is None:
+            raise OSError('timed out')
+        return count
+
+    def _readHead(self):
+        self.setPhase('first_byte')
+        start, end = self._line()
+        if start == end:
+            raise OSError('connection closed by server')
+        status, reason = parseStatusInPlace(self._buf, start, end)
+        headers = {}
+        while True:
+            start, end = self._line()
+            if start == end:
+                break
+            parseHeaderInPlace(self._buf, start, end, headers)
+        return status, reason, headers
+
+    def request(self, method, path, body=None, headers=None, timeout=None, timing=None):
+        """
+        Send a request and return an HttpResponse once the status line and
+        headers have arrived. The caller must read the body and close the
+        response before the connection can carry another request. The whole
+        request, body included, must finish within timeout seconds (the
+        'total' timeout if not given). If a RequestTiming is given, the
+        phases are timed into it and it is ended when the response is closed.
+
+        Returns (response, reused) where reused tells whether an already
+        open connection was used.
+        """
+
+        if isinstance(body, str):
+            body = body.encode()
+        total = timeout if timeout is not None else self._timeouts['total']
+        self._deadline = time.ticks_add(time.ticks_ms(), int(total * 1000))
+        reused = not self.isStale()
+        if not reused:
+            self.open(timing)
+        self._busy = True
+        try:
+            sent = self._send(method, path, body, headers)
+            if timing is not None:
+                timing.lap('send')
+            status, reason, rheaders = self._readHead()
+        except Exception as e:
+            if not reused or (self._written and not canResend(method, headers)):
+                # A write the server may already have carried out is not
+                # sent twice
+                self.close()
+                raise
+            # The server dropped the idle connection before we got any
+            # response - reopen and send the request once more
+            Log.d(f'Net: reused connection failed ({e}), reopening')
+            reused = False
+            self.open(timing)
+            self._busy = True
+            try:
+                sent = self._send(method, path, body, headers)
+                if timing is not None:
+                    timing.lap('send')
+                status, reason, rheaders = self._readHead()
+            except:
+                self.close()
+                raise
+        idle = keepAliveTimeout(rheaders, KEEPALIVE_IDLE)
+        if idle == 0:
+            self._keepalive = False
+        else:
+            self._idle = idle
+        if timing is not None:
+            timing.reused = reused
+            timing.sent = sent
+            timing.status = status
+            timing.startBody()
+        return HttpResponse(self, status, reason, rheaders, timing), reused
+
+    def send(self, method, path, body=None, headers=None, timeout=None, timing=None):
+        """
+        Send a request without waiting for the response, for requests the
+        server may hold open for a long time (long polls). Check ready()
+        now and then, and call response() once it is True. The response must
+        arrive within timeout seconds.
+
+        Several requests can be sent before the first response is read
+        (HTTP/1.1 pipelining); their responses come back in the same order,
+        one response() call each. Returns True if the connection was
+        already open.
+        """
+
+        if isinstance(body, str):
+            body = body.encode()
+        total = timeout if timeout is not None else self._timeouts['total']
+        self._deadline = time.ticks_add(time.ticks_ms(), int(total * 1000))
+        # A connection with responses still to come is never reopened
+        reused = self._pending > 0 or not self.isStale()
+        if not reused:
+            self.open(timing)
+        self._busy = True
+        try:
+            sent = self._send(method, path, body, headers)
+        except:
+            self.close()
+            raise
+        self._pending += 1
+        if timing is not None:
+            timing.lap('send')
+            timing.reused = reused
+            timing.sent = sent
+        return reused
+
+    def ready(self):
+        """
+        True once the response to a request made with send() has started to
+        arrive. Raises OSError if its deadline has passed.
+        """
+
+        if self._sock is None:
+            raise OSError('connection closed')
+        if self._tail > self._head:
+            return True
+        poller = select.poll()
+        poller.register(self._sock, select.POLLIN)
+        if poller.poll(0):
+            return True
+        if time.ticks_diff(self._deadline, time.ticks_ms()) <= 0:
+            self.close()
+            raise OSError('request deadline exceeded waiting for response')
+        return False
+
+    def response(self, timing=None):
+        """ Read the head of the response to the oldest request made with send() """
+
+        try:
+            status, reason, rheaders = self._readHead()
+        except:
+            self.close()
+            raise
+        self._pending -= 1
+        if keepAliveTimeout(rheaders, KEEPALIVE_IDLE) == 0:
+            self._keepalive = False
+        if timing is not None:
+            timing.status = status
+            timing.startBody()
+        return HttpResponse(self, status, reason, rheaders, timing)
+
+    def warmup(self, timeout=None):
+        """
+        Open the connection now, if it is not open already, so the next
+        request finds it ready. Must finish within timeout seconds.
+        """
+
+        if not self.isStale():
+            return
+        total = timeout if timeout is not None else self._timeouts['total']
+        self._deadline = time.ticks_add(time.ticks_ms(), int(total * 1000))
+        self.open()
+        self._lastused = time.ticks_ms()
+
+    def release(self):
+        """ Called by the response once it is done with the connection """
+
+        # Still busy while pipelined responses are on their way
+        self._busy = self._pending > 0
+        self._lastused = time.ticks_ms()
+        if not self._keepalive or (self._oneoff and not self._busy):
+            self.close()
+
+class AsyncHttpConnection:
+    """
+    The asyncio counterpart of HttpConnection: one keep-alive HTTP/1.1
+    connection built on asyncio streams, so waiting for the server does not
+    block the event loop. Runs under uasyncio on the Pico and under asyncio
+    on a host. Requests read the whole body before returning.
+    """
+
+    def __init__(self, scheme, host, port, timeouts=TIMEOUTS, resolver=None):
+        self._scheme = scheme
+        self._host = host
+        self._port = port
+        self._timeouts = timeouts
+        self._resolver = resolver
+        self._deadline = None
+        self._reader = None
+        self._writer = None
+        self._keepalive = False
+        self._written = False
+        self._lastused = 0
+        self._idle = KEEPALIVE_IDLE
+        self.opened = 0
+        self.received = 0
+
+    def isStale(self):
+        """ True if the connection should not be reused for the next request """
+
+        if self._writer is None or not self._keepalive:
+            return True
+        return time.ticks_diff(time.ticks_ms(), self._lastused) > self._idle * 1000
+
+    def _limit(self, *phases):
+        """ The time allowed for the given phases, cut short by the deadline """
+
+        limit = sum(self._timeouts[p] for p in phases)
+        remaining = time.ticks_diff(self._deadline, time.ticks_ms()) / 1000
+        if remaining <= 0:
+            raise OSError(f'request deadline exceeded in {phases[0]}')
+        return min(limit, remaining)
+
+    async def open(self, timing=None):
+        self.close()
+        host = self._host
+        if self._resolver is not None:
+            addr = self._resolver.resolve(self._host, self._port)
+            # Connect to the cached address; TLS still checks in with the host name
+            if isinstance(addr, tuple):
+                host = addr[0]
+        if timing is not None:
+            timing.lap('dns')
+        if self._scheme == 'https':
+            connecting = asyncio.open_connection(
+                host, self._port, ssl=makeSslContext(), server_hostname=self._host)
+            limit = self._limit('dns', 'connect', 'tls')
+        else:
+            connecting = asyncio.open_connection(host, self._port)
+            limit = self._limit('dns', 'connect')
+        self._reader, self._writer = await asyncio.wait_for(connecting, limit)
+        if timing is not None:
+            # asyncio connects and does the TLS handshake in one step
+            timing.lap('connect')
+        self._keepalive = True
+        self.opened += 1
+        Log.d(f'Net: opened async connection to {self._host}:{self._port}')
+
+    def close(self):
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except:
+                pass
+        self._reader = None
+        self._writer = None
+        self._keepalive = False
+
+    async def _send(self, method, path, body, headers):
+        head = buildRequest(method, hostHeader(self._scheme, self._host, self._port), path, body, headers)
+        # Buffered by the stream, so it may have gone out whatever happens next
+        self._written = True
+        self._writer.write(head)
+        if body:
+            self._writer.write(body)
+        await self._writer.drain()
+        return len(head) + (len(body) if body else 0)
+
+    async def _readHead(self):
+        status, reason = parseStatusLine(
+            await asyncio.wait_for(self._reader.readline(), self._limit('first_byte')))
+        headers = {}
+        while parseHeaderLine(await self._reader.readline(), headers):
+            pass
+        return status, headers
+
+    async def _readBody(self, status, headers):
+        if status == 204 or status == 304 or (status >= 100 and status < 200):
+            return b''
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            parts = []
+            while True:
+                line = await self._reader.readline()
+                size = int(line.split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    while (await self._reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return b''.join(parts)
+                parts.append(await self._reader.readexactly(size))
+                await self._reader.readline()
+        length = headers.get('content-length')
+        if length is not None:
+            return await self._reader.readexactly(int(length))
+        # No length and not chunked: the body runs until the server closes
+        self._keepalive = False
+        return await self._reader.read(-1)
+
+    async def request(self, method, path, body=None, headers=None, timeout=None, timing=None):
+        """
+        Send a request and read the whole response, within timeout seconds
+        (the 'total' timeout if not given). The phases up to the end of the
+        body are timed into timing if given; ending it is up to the caller.
+        Returns (status, headers, body, reused).
+        """
+
+        if isinstance(body, str):
+            body = body.encode()
+        total = timeout if timeout is not None else self._timeouts['total']
+        self._deadline = time.ticks_add(time.ticks_ms(), int(total * 1000))
+        reused = not self.isStale()
+        if not reused:
+            await self.open(timing)
+        self._written = False
+        try:
+            sent = await self._send(method, path, body, headers)
+            if timing is not None:
+                timing.lap('send')
+            status, rheaders = await self._readHead()
+        except Exception as e:
+            if not reused or (self._written and not canResend(method, headers)):
+                self.close()
+                raise
+            Log.d(f'Net: reused async connection failed ({e}), reopening')
+            reused = False
+            await self.open(timing)
+            try:
+                sent = await self._send(method, path, body, headers)
+                if timing is not None:
+                    timing.lap('send')
+                status, rheaders = await self._readHead()
+            except:
+                self.close()
+                raise
+        if timing is not None:
+            timing.startBody()
+        try:
+            remaining = time.ticks_diff(self._deadline, time.ticks_ms()) / 1000
+            if remaining <= 0:
+                raise OSError('request deadline exceeded in body')
+            rbody = await asyncio.wait_for(self._readBody(status, rheaders), remaining)
+        except:
+            self.close()
+            raise
+        self.received += len(rbody)
+        if timing is not None:
+            timing.lap('body')
+            timing.reused = reused
+            timing.sent = sent
+            timing.status = status
+            timing.received = len(rbody)
+        idle = keepAliveTimeout(rheaders, KEEPALIVE_IDLE)
+        if idle == 0:
+            self._keepalive = False
+        else:
+            self._idle = idle
+        self._lastused = time.ticks_ms()
+        if not self._keepalive:
+            self.close()
+        return status, rheaders, rbody, reused
 
 class Net:
     
@@ -29,33 +1181,141 @@ class Net:
         self._sta = None
         self._ap = None
         self._blink = False
+        self._connections = {}
+        self._requests = 0
+        self._reused = 0
+        self._validators = {}
+        self._notmodified = 0
+        # Async client: idle connections per host, and all of them
+        self._aidle = {}
+        self._aconnections = {}
+        self._timeouts = dict(TIMEOUTS)
+        self._breakers = {}
+        self._linkbreaker = CircuitBreaker(threshold=1, cooldown=CONNECT_COOLDOWN)
+        self._compression = True
+        self._compressed = 0
+        self._resolver = Resolver()
+        self._timings = RequestTimings()
+        self._clock = ClockSync(client=SntpClient(resolver=self._resolver))
+        self._spillthreshold = SPILL_THRESHOLD
+        self._spilled = 0
+        cleanup()
         
     def connect(self, ssid, password=None, max_wait=10):
         """
-        Connect to the wifi network with a maximum wait time
+        Connect to the wifi network with a maximum wait time.
+        After a failed attempt, further attempts fail straight away for
+        CONNECT_COOLDOWN seconds instead of waiting again.
+        """
+
+        self.startConnect(ssid, password)
+        self.waitConnected(max_wait)
+
+    def startConnect(self, ssid, password=None, bssid=None, force=False, channel=None):
+        """
+        Start connecting to the wifi network without waiting for it. The
+        association carries on in the background (in the Wi-Fi chip) while
+        the caller does other work; finish with waitConnected, or poll
+        checkConnecting.
+        If the bssid of the access point is known, it is connected to
+        directly instead of scanning for one, and if its channel is known
+        too, only that channel is tried. force ignores the cooldown after a
+        failed attempt, for callers that do their own backoff.
         """
 
+        if not force and not self._linkbreaker.allow():
+            raise RuntimeError('Network Connection has failed recently - not retrying yet')
+        if network is None:
+            Log.d('Net: no Wi-Fi on this host, using its own network')
+            return
         self._sta = network.WLAN(network.STA_IF)
         self._sta.active(True)
+        options = {'bssid': bssid} if bssid else {}
+        if bssid and channel:
+            options['channel'] = channel
+        try:
+            self._associate(ssid, password, options)
+        except TypeError:
+            if 'channel' not in options:
+                raise
+            # This port's connect has no channel argument
+            del options['channel']
+            self._associate(ssid, password, options)
+        Log.i(f'Net: connecting to {ssid}')
+
+    def _associate(self, ssid, password, options):
         if password is not None:
-            self._sta.connect(ssid, password)
+            self._sta.connect(ssid, password, **options)
         else:
-            self._sta.connect(ssid, security=0)
+            self._sta.connect(ssid, security=0, **options)
 
-        # Wait for connection to establish
-        Log.i(f'Net: connecting to {ssid}')
+    def checkConnecting(self):
+        """
+        Check on a connection started with startConnect without waiting.
+        Returns True once it is up, False if it failed, None while it is
+        still being set up.
+        """
+
+        if network is None:
+            return True
+        if self._sta is None:
+            return False
+        status = self._sta.status()
+        if status == network.STAT_GOT_IP:
+            self._linkbreaker.success()
+            return True
+        if status < 0:
+            self._linkbreaker.failure()
+            return False
+        return None
+
+    def findAccessPoint(self, ssid):
+        """
+        Scan for the access point of a network with the strongest signal.
+        Returns (bssid, channel), or None if the network was not seen.
+        Scanning blocks for a second or two.
+        """
+
+        if self._sta is None:
+            return None
+        best = None
+        for found in self._sta.scan():
+            name = found[0].decode() if isinstance(found[0], bytes) else found[0]
+            if name == ssid and (best is None or found[3] > best[3]):
+                best = found
+        if best is None:
+            return None
+        return bytes(best[1]), best[2]
+
+    def waitConnected(self, max_wait=10):
+        """
+        Wait up to max_wait seconds for a connection started with
+        startConnect to come up. Raises RuntimeError if it does not.
+        """
+
+        if network is None:
+            return
+        if self._sta is None:
+            raise RuntimeError('Network Connection has not been started')
         print('waiting for connection...', end="")
-        while max_wait > 0:
+        start = time.ticks_ms()
+        deadline = time.ticks_add(start, max_wait * 1000)
+        dots = 0
+        while time.ticks_diff(deadline, time.ticks_ms()) > 0:
             if self._sta.status() < 0 or self._sta.status() >= network.STAT_GOT_IP:
                     break
-            max_wait -= 1
-            print('.', end="")
-            time.sleep(1)
+            # Checked every 0.1 s, but only one dot a second as before
+            if time.ticks_diff(time.ticks_ms(), start) >= dots * 1000:
+                print('.', end="")
+                dots += 1
+            time.sleep(0.1)
             
         # Manage connection errors
         if self._sta.status() != network.STAT_GOT_IP:
+            self._linkbreaker.failure()
             raise RuntimeError('Network Connection has failed!')
         else:
+            self._linkbreaker.success()
             print("Connected!")
             Log.i('Net: connected!')
     
@@ -112,6 +1372,8 @@ class Net:
         Returns True if connected, False otherwise
         """
         
+        if network is None:
+            return True
         if self._sta is not None:
             return self._sta.active() and self._sta.status() == network.STAT_GOT_IP
         elif self._ap is not None:
@@ -156,6 +1418,7 @@ class Net:
 
     def disconnect(self):
         """ Disconnect from wifi network """
+        self.closeConnections()
         if self._sta:
             self._sta.disconnect()
             self._sta.active(False)
@@ -186,20 +1449,25 @@ class Net:
         return mac
         
     def updateTime(self, timezone = 'America/New_York'):
-        """ Update local time using an the world timeapi """
-        
-        apiendpoint = 'https://worldtimeapi.org/api/timezone/' + timezone
-        json = self.getJson(apiendpoint)
-        if json:
-            unixtime = json['unixtime']
-            raw_offset = json['raw_offset']
-            dst_offset = json['dst_offset']
-            unixtime = unixtime + raw_offset + dst_offset
-            import machine
-            tm = time.gmtime(unixtime)
-            machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+        """
+        Update local time from an SNTP server, with the UTC offset and
+        daylight saving time of timezone worked out locally (see Sntp.py
+        and TimeZones.py). From then on poll() re-syncs the clock now and
+        then to keep it from drifting.
+        """
+
+        try:
+            self._clock.setTimezone(timezone)
+        except ValueError as e:
+            Log.e(f'Net: {e}, keeping {self._clock.getStats()["timezone"]}')
+        self._clock.sync()
         return time.localtime()
 
+    def getClockStats(self):
+        """ Get the clock sync counts, last SNTP delay and drift corrected (see ClockSync) """
+
+        return self._clock.getStats()
+
     def getFormattedTime(self, extra='day'):
         """
         Get the local time as a String that fits a 16 char line
@@ -222,63 +1490,659 @@ class Net:
         else:
             return f'{mm:02}/{dd:02}/{yy:04} {h:02}{col}{m:02}'
 
-    def getJson(self, url):
+    def _connection(self, scheme, host, port):
+        """
+        Get the pooled keep-alive connection for a host. If it is still
+        carrying an unfinished response, a one-off connection is used
+        instead, which is closed as soon as its response is done.
+        """
+
+        key = f'{scheme}://{host}:{port}'
+        conn = self._connections.get(key)
+        if conn is None:
+            conn = HttpConnection(scheme, host, port, self._timeouts, self._resolver)
+            self._connections[key] = conn
+        elif conn._busy:
+            Log.d(f'Net: connection to {host} busy, opening another')
+            conn = HttpConnection(scheme, host, port, self._timeouts, self._resolver)
+            conn._oneoff = True
+        return conn
+
+    def warmup(self, url):
+        """
+        Open the keep-alive connection to the host of a URL (DNS lookup, TCP
+        connect and TLS handshake) ahead of the first request, so that
+        request does not have to wait for it. Returns True if the connection
+        is open.
+        """
+
+        scheme, host, port, path = parseUrl(url)
+        try:
+            conn = self._connection(scheme, host, port)
+            if conn._oneoff:
+                # The pooled connection is busy, so it is open already
+                return True
+            conn.warmup()
+            return True
+        except Exception as e:
+            Log.e(f'Net: warming up {host} failed: {e}')
+            return False
+
+    def openChannel(self, url):
+        """
+        A connection to the host of a URL that is not shared with the pool,
+        for requests the server may hold open (see HttpConnection.send) so
+        they do not hold up other requests. It is opened on first use.
+        """
+
+        scheme, host, port, path = parseUrl(url)
+        return HttpConnection(scheme, host, port, self._timeouts, self._resolver)
+
+    def setTimeouts(self, **timeouts):
+        """
+        Change the time limits (seconds) used for requests, for example
+        net.setTimeouts(connect=2, total=10). See TIMEOUTS for the phases.
+        """
+
+        for phase in timeouts:
+            if phase not in self._timeouts:
+                raise ValueError(f'Unknown timeout {phase}')
+            self._timeouts[phase] = timeouts[phase]
+
+    def _breaker(self, url):
+        """ Get the circuit breaker of the endpoint a URL belongs to """
+
+        key = endpointKey(url)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            self._breakers[key] = breaker
+        return breaker
+
+    def setCompression(self, enabled):
+        """
+        Turn compressed (gzip/deflate) responses for GETs on or off. They are
+        on by default; turning them off trades bandwidth for a little CPU.
+        """
+
+        self._compression = enabled
+
+    def poll(self):
+        """
+        Do the next piece of background network housekeeping, such as
+        refreshing a cached host address before it expires or re-syncing the
+        clock. At most one is done per call. Call this regularly. Returns
+        True if it did anything.
+        """
+
+        if not self.isConnected():
+            return False
+        return self._resolver.poll() or self._clock.poll()
+
+    def getDnsStats(self):
+        """ Get the resolver cache hit/miss/fallback counts and lookup time """
+
+        return self._resolver.getStats()
+
+    def getBreakerStates(self):
+        """ Get a dictionary of endpoint -> circuit state ('closed', 'open' or 'half-open') """
+
+        return {key: self._breakers[key].state() for key in self._breakers}
+
+    def request(self, method, url, data=None, headers=None, timeout=None):
+        """
+        Send an HTTP request over the keep-alive connection for the URL's host
+        and return the HttpResponse. Remember to close the response (or read
+        its content/json) so the connection can be reused.
+
+        Raises CircuitOpenError without sending anything if the endpoint has
+        been failing, and OSError if the request runs past its deadline.
+        """
+
+        breaker = self._breaker(url)
+        if not breaker.allow():
+            raise CircuitOpenError(f'circuit open for {endpointKey(url)}')
+        scheme, host, port, path = parseUrl(url)
+        conn = self._connection(scheme, host, port)
+        timing = self._timings.begin(method, endpointKey(path))
+        try:
+            response, reused = conn.request(method, path, data, headers, timeout, timing)
+        except:
+            breaker.failure()
+            timing.end(ok=False)
+            raise
+        if response.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        self._requests += 1
+        if reused:
+            self._reused += 1
+        return response
+
+    def getTimings(self, count=None):
+        """
+        Get the phase timings (ms), byte counts and connection reuse of the
+        most recent requests (newest first, at most count of them)
+        """
+
+        return self._timings.recent(count)
+
+    def getTimingSummary(self):
+        """
+        Get the p50/p95 time (ms) of each request phase - dns, connect, tls,
+        send, ttfb, body and parse - per endpoint, over the recent requests.
+        See Timings.py.
+        """
+
+        return self._timings.summary()
+
+    def formatTimings(self):
+        """ The timing summary as text, one line per endpoint and phase """
+
+        return self._timings.format()
+
+    def logTimings(self):
+        """ Log the timing summary """
+
+        self._timings.log()
+
+    def getConnectionStats(self):
+        """
+        Get a dictionary with the number of requests made, how many of them
+        reused an already open connection, how many connections were opened
+        how many conditional GETs came back not modified, how many
+        responses were compressed, how many were spilled to flash and the
+        body bytes received (as sent on the wire) over the pooled connections
+        """
+
+        return {
+            'requests': self._requests,
+            'reused': self._reused,
+            'opened': sum(c.opened for c in self._connections.values()) +
+                      sum(c.opened for conns in self._aconnections.values() for c in conns),
+            'not_modified': self._notmodified,
+            'compressed': self._compressed,
+            'spilled': self._spilled,
+            'received': sum(c.received for c in self._connections.values()) +
+                        sum(c.received for conns in self._aconnections.values() for c in conns)
+        }
+
+    def _conditionalHeaders(self, url):
+        """ Build If-None-Match/If-Modified-Since headers from stored validators """
+
+        headers = {}
+        validators = self._validators.get(url)
+        if validators:
+            etag, modified = validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if modified:
+                headers['If-Modified-Since'] = modified
+        return headers
+
+    def _storeValidators(self, url, headers):
+        """ Remember the ETag/Last-Modified of a response for the next conditional GET """
+
+        etag = headers.get('etag')
+        modified = headers.get('last-modified')
+        if not etag and not modified:
+            self._validators.pop(url, None)
+            return
+        if url not in self._validators and len(self._validators) >= MAX_VALIDATORS:
+            del self._validators[next(iter(self._validators))]
+        self._validators[url] = (etag, modified)
+
+    def _getHeaders(self, url, conditional):
+        """ The headers for a GET: validators if conditional, and Accept-Encoding """
+
+        headers = self._conditionalHeaders(url) if conditional else {}
+        if self._compression and canInflate('gzip'):
+            headers['Accept-Encoding'] = ACCEPT_ENCODING
+        return headers
+
+    def _body(self, response, spill=True):
+        """
+        The readable body of a response: the response itself, or an
+        InflatedBody decompressing it as it is read if it was compressed.
+        If spill, a large body is first spilled to flash and read from there.
+        """
+
+        encoding = response.headers.get('content-encoding', 'identity').lower()
+        if encoding != 'identity' and not canInflate(encoding):
+            response.close()
+            raise OSError(f'unsupported Content-Encoding {encoding}')
+        source = self._spillLarge(response) if spill else response
+        if encoding == 'identity':
+            return source
+        self._compressed += 1
+        return InflatedBody(source, encoding)
+
+    def _spillLarge(self, response):
+        """
+        A SpillFile with the body of response if it crosses the spill
+        threshold and fits on flash, otherwise the response itself
+        """
+
+        if self._spillthreshold is None:
+            return response
+        expected = None
+        if response._chunked:
+            # The size of a chunked body is not known up front
+            try:
+                large = response._available(self._spillthreshold + 1) > self._spillthreshold
+            except:
+                response._failed()
+                raise
+        else:
+            expected = response._remaining
+            large = expected is not None and expected > self._spillthreshold
+        if not large:
+            return response
+        body = spill(response, expected)
+        if body is None:
+            return response
+        self._spilled += 1
+        return body
+
+    def setSpillThreshold(self, threshold):
+        """
+        Spill collection bodies bigger than threshold bytes to flash (see
+        Spill.py), or never if threshold is None
+        """
+
+        self._spillthreshold = threshold
+
+    def _get(self, url, conditional, timeout=None):
+        """
+        Send a GET, conditional on the stored validators if asked to.
+        Returns the response, or NOT_MODIFIED on a 304.
+        """
+
+        headers = self._getHeaders(url, conditional)
+        response = self.request('GET', url, headers=headers, timeout=timeout)
+        if response.status_code == 304:
+            response.close()
+            self._notmodified += 1
+            Log.d(f'Net: {url} not modified')
+            return NOT_MODIFIED
+        if response.status_code < 300:
+            self._storeValidators(url, response.headers)
+        return response
+
+    def closeConnections(self):
+        """ Close all kept-alive connections """
+
+        for conn in self._connections.values():
+            conn.close()
+        for conns in self._aconnections.values():
+            for conn in conns:
+                conn.close()
+
+    async def _aconnection(self, key, scheme, host, port):
+        """
+        Get an idle async connection to a host, opening another one if fewer
+        than MAX_ASYNC_CONNECTIONS exist, or else waiting for one to be free
+        """
+
+        idle = self._aidle.setdefault(key, [])
+        conns = self._aconnections.setdefault(key, [])
+        while True:
+            if idle:
+                return idle.pop()
+            if len(conns) < MAX_ASYNC_CONNECTIONS:
+                conn = AsyncHttpConnection(scheme, host, port, self._timeouts, self._resolver)
+                conns.append(conn)
+                return conn
+            await asyncio.sleep(0.01)
+
+    async def arequest(self, method, url, data=None, headers=None, timeout=None, timing=None):
+        """
+        Send an HTTP request without blocking the event loop. Several
+        requests can be in flight at once, each on its own keep-alive
+        connection. Returns (status, headers, body). Deadlines and circuit
+        breakers work as in request.
+
+        The request is timed into the ring of request timings. A caller that
+        passes its own timing (from self._timings.begin) ends it itself,
+        once it has parsed the body.
+        """
+
+        breaker = self._breaker(url)
+        if not breaker.allow():
+            raise CircuitOpenError(f'circuit open for {endpointKey(url)}')
+        scheme, host, port, path = parseUrl(url)
+        key = f'{scheme}://{host}:{port}'
+        owntiming = timing is None
+        if owntiming:
+            timing = self._timings.begin(method, endpointKey(path))
+        conn = await self._aconnection(key, scheme, host, port)
+        try:
+            status, rheaders, body, reused = await conn.request(method, path, data, headers, timeout, timing)
+        except:
+            breaker.failure()
+            timing.end(ok=False)
+            raise
+        finally:
+            self._aidle[key].append(conn)
+        if owntiming:
+            timing.end()
+        if status >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        self._requests += 1
+        if reused:
+            self._reused += 1
+        return status, rheaders, body
+
+    async def agetJson(self, url, conditional=False):
+        """
+        The coroutine version of getJson. Returns the parsed json structure,
+        NOT_MODIFIED for an unchanged conditional GET, or None on failure.
+        """
+
+        timing = self._timings.begin('GET', endpointKey(parseUrl(url)[3]))
+        try:
+            headers = self._getHeaders(url, conditional)
+            status, rheaders, body = await self.arequest('GET', url, headers=headers, timing=timing)
+            if status == 304:
+                self._notmodified += 1
+                timing.end()
+                return NOT_MODIFIED
+            if status < 300:
+                self._storeValidators(url, rheaders)
+            encoding = rheaders.get('content-encoding', 'identity').lower()
+            if encoding != 'identity':
+                self._compressed += 1
+                body = inflate(body, encoding)
+            jsondata = json.loads(body)
+            timing.end()
+            return jsondata
+        except Exception as e:
+            timing.end(ok=False)
+            Log.e(f"could not connect {e}")
+            return None
+
+    async def _asendJson(self, method, url, data, headers):
+        try:
+            if data:
+                status, rheaders, body = await self.arequest(method, url, data=json.dumps(data), headers=headers)
+            else:
+                status, rheaders, body = await self.arequest(method, url, headers=headers)
+            Log.d(f"Status Code:{status}")
+            return status, json.loads(body)
+        except Exception as e:
+            Log.e(f"Failed to send request: {e}")
+            return None
+
+    async def aputJson(self, url, data=None, headers=None):
+        """ The coroutine version of putJson. Returns (status, json) or None """
+
+        return await self._asendJson('PUT', url, data, headers)
+
+    async def apostJson(self, url, data=None, headers=None):
+        """ The coroutine version of postJson. Returns (status, json) or None """
+
+        return await self._asendJson('POST', url, data, headers)
+
+    def getJson(self, url, conditional=False, timeout=None):
         """
         Get the JSON data from a REST API. Only valid JSON supported.
         Only GET for now. No POST or PUT. Returns the parsed json structure
+
+        If conditional is True, the ETag/Last-Modified seen the last time this
+        URL was fetched are sent along, and NOT_MODIFIED is returned if the
+        server says the data has not changed since.
+
+        A compressed response (see setCompression) is decompressed as it is
+        read. The request must finish within timeout seconds (the 'total'
+        timeout if not given).
         """
         
         try:
-            if self._sta == None:
+            if self._sta == None and network is not None:
                 self.connect()
-            data=requests.get(url)
-            jsondata = data.json()
-            data.close()
+            data = self._get(url, conditional, timeout)
+            if data is NOT_MODIFIED:
+                return data
+            # Parsed whole, so spilling would not save any memory
+            body = self._body(data, spill=False)
+            jsondata = json.loads(body.read())
+            body.close()
             return jsondata
         except Exception as e:
             Log.e(f"could not connect {e}")
             return None
 
-    def putJson(self, url, data=None, headers=None):
+    def getJsonStatus(self, url, timeout=None):
+        """
+        Like getJson, but returns (status, json) as putJson and postJson do,
+        so an error body can be told from the data asked for. json is None
+        if the body is not JSON (such as a gateway's HTML error page).
+        Returns None if the request fails.
+        """
+
+        try:
+            if self._sta == None and network is not None:
+                self.connect()
+            response = self._get(url, False, timeout)
+            status = response.status_code
+            body = self._body(response, spill=False)
+            try:
+                jsondata = json.loads(body.read())
+            except ValueError:
+                jsondata = None
+            body.close()
+            return status, jsondata
+        except Exception as e:
+            Log.e(f"could not connect {e}")
+            return None
+
+    def getItems(self, url, key='items', conditional=False, timeout=None):
+        """
+        Get a JSON collection (such as an ORDS items list) from a REST API
+        without loading the whole document. Returns an ItemsStream that reads
+        the response in chunks and yields one element of the key array at a
+        time, or None if the request fails. The other top-level members are
+        available in the stream's fields once it has been iterated.
+
+        conditional works as in getJson - NOT_MODIFIED is returned if the
+        collection has not changed since it was last fetched, and so does
+        timeout.
+        """
+
+        try:
+            if self._sta == None and network is not None:
+                self.connect()
+            response = self._get(url, conditional, timeout)
+            if response is NOT_MODIFIED:
+                return response
+            if response.status_code >= 400:
+                Log.e(f"GET {url} failed with status {response.status_code}")
+                response.close()
+                return None
+            return ItemsStream(self._body(response), key)
+        except Exception as e:
+            Log.e(f"could not connect {e}")
+            return None
+
+    def getItemsPipelined(self, urls, key='items', conditional=None):
+        """
+        Get several JSON collections from one host over a single keep-alive
+        connection with HTTP/1.1 pipelining: up to PIPELINE_DEPTH requests
+        are sent ahead without waiting for their answers, and the responses,
+        which come back in the order the requests were sent, are matched
+        with their URLs as they stream in. This saves a round trip per URL
+        over calling getItems in a loop.
+
+        A generator of (url, items) in the order of urls, where items is
+        what getItems would return for the url: an ItemsStream, NOT_MODIFIED,
+        or None if the request failed. Read each ItemsStream before taking
+        the next one; whatever is left of it is skipped. conditional is a
+        list with a conditional flag per URL, all False if not given.
+
+        If the connection is lost, the requests that have not been answered
+        are sent again on a new one. A request that fails twice is given up.
+        """
+
+        if not urls:
+            return
+        scheme, host, port, path = parseUrl(urls[0])
+        conn = self._connection(scheme, host, port)
+        # Indices of the requests sent and not yet answered, in order, and
+        # the timings of the requests sent
+        inflight = []
+        timings = {}
+        refused = set()
+        retried = -1
+        nextsend = 0
+        scratch = None
+        i = 0
+        try:
+            while i < len(urls):
+                url = urls[i]
+                try:
+                    while nextsend < len(urls) and len(inflight) < PIPELINE_DEPTH:
+                        sendurl = urls[nextsend]
+                        if self._breaker(sendurl).allow():
+                            path = parseUrl(sendurl)[3]
+                            timings[nextsend] = self._timings.begin('GET', endpointKey(path))
+                            headers = self._getHeaders(sendurl, conditional is not None and conditional[nextsend])
+                            if conn.send('GET', path, headers=headers, timing=timings[nextsend]):
+                                self._reused += 1
+                            self._requests += 1
+                            inflight.append(nextsend)
+                            refused.discard(nextsend)
+                        else:
+                            refused.add(nextsend)
+                        nextsend += 1
+                    if i in refused:
+                        Log.e(f'GET {url} refused, circuit open for {endpointKey(url)}')
+                        yield url, None
+                        i += 1
+                        continue
+                    response = conn.response(timings.pop(i))
+                    inflight.pop(0)
+                except Exception as e:
+                    conn.close()
+                    self._releaseTrials(urls, inflight)
+                    inflight = []
+                    for j in timings:
+                        timings[j].end(ok=False)
+                    timings = {}
+                    if retried != i:
+                        # Send everything from here on again on a new connection
+                        Log.d(f'Net: pipelined connection failed ({e}), reopening')
+                        retried = i
+                        nextsend = i
+                        continue
+                    self._breaker(url).failure()
+                    Log.e(f"GET {url} failed: {e}")
+                    yield url, None
+                    i += 1
+                    nextsend = i
+                    continue
+                status = response.status_code
+                if status >= 500:
+                    self._breaker(url).failure()
+                else:
+                    self._breaker(url).success()
+                items = None
+                if status == 304:
+                    response.close()
+                    self._notmodified += 1
+                    items = NOT_MODIFIED
+                elif status >= 400:
+                    Log.e(f"GET {url} failed with status {status}")
+                    response.close()
+                else:
+                    self._storeValidators(url, response.headers)
+                    try:
+                        items = ItemsStream(self._body(response), key)
+                    except Exception as e:
+                        Log.e(f"GET {url} failed: {e}")
+                yield url, items
+                i += 1
+                if response._conn is not None:
+                    # Skip what the caller did not read of the body
+                    if scratch is None:
+                        scratch = bytearray(256)
+                    try:
+                        while response.readinto(scratch):
+                            pass
+                    except Exception:
+                        pass
+                    response.close()
+                if inflight and not conn.isOpen():
+                    # The server closed the connection after this response -
+                    # the requests sent after it have to be sent again
+                    self._releaseTrials(urls, inflight)
+                    inflight = []
+                    for j in timings:
+                        timings[j].end(ok=False)
+                    timings = {}
+                    nextsend = i
+        finally:
+            if inflight:
+                # Given up part way - the responses still to come are dropped
+                conn.close()
+                self._releaseTrials(urls, inflight)
+            for j in timings:
+                timings[j].end(ok=False)
+
+    def _releaseTrials(self, urls, inflight):
+        """
+        Give back the circuit breaker trials of pipelined requests that were
+        sent but will not be answered, so their endpoints are not left half
+        open for good when they are sent again (or dropped)
+        """
+
+        for j in inflight:
+            self._breaker(urls[j]).release()
+
+    def _sendResult(self, response):
+        """
+        (status, json) of the response to a PUT or POST. The body is read
+        once and parsed from that; only its size is logged.
+        """
+
+        status = response.status_code
+        body = response.content
+        Log.d(f"Status Code:{status}, {len(body)} bytes")
+        return status, json.loads(body)
+
+    def putJson(self, url, data=None, headers=None, timeout=None):
         """
         Use the PUT method to update data into a remote webservice
         The webservice should be configured to accept data in JSON format.
         Passed in data should be a dictionary with all parameters
-        that are expected by this webservice.
+        that are expected by this webservice. The request must finish
+        within timeout seconds (the 'total' timeout if not given).
         
         Returns the status code or None if fail
         """
         try:
             if data:
-                response = requests.put(url, data=json.dumps(data), headers=headers)
+                response = self.request('PUT', url, data=json.dumps(data), headers=headers, timeout=timeout)
             else:
-                response = requests.put(url)
-            status = response.status_code
-            jsondata = response.json()
-            Log.d(f"Status Code:{status}")
-            Log.d(f"Response:{response.text}")
-            response.close()
-            return status, jsondata
+                response = self.request('PUT', url, headers=headers, timeout=timeout)
+            return self._sendResult(response)
         except Exception as e:
             Log.e(f"Failed to send request: {e}")
             return None
         
-    def postJson(self, url, data=None, headers=None):
+    def postJson(self, url, data=None, headers=None, timeout=None):
         """
         Similar to the above, use POST instead of PUT
         Configure web service to accept JSON and create new entries
         """
         try:
             if data:
-                response = requests.post(url, data=json.dumps(data), headers=headers)
+                response = self.request('POST', url, data=json.dumps(data), headers=headers, timeout=timeout)
             else:
-                response = requests.post(url)
-            status = response.status_code
-            jsondata = response.json()
-            Log.d(f"Status Code:{status}")
-            Log.d(f"Response:{response.text}")
-            response.close()
-            return status, jsondata
+                response = self.request('POST', url, headers=headers, timeout=timeout)
+            return self._sendResult(response)
         except Exception as e:
             Log.e(f"Failed to send request: {e}")
             return None
@@ -365,7 +2229,7 @@ class WebServer:
                     Log.i(f"Client connected from {addr}")
                     request = cl.recv(1024).decode('utf-8')
                     #request = str(request)
-                    Log.d(f"Request: {request[:200] + "..." if len(request) > 200 else request}")
+                    Log.d(f"Request: {request[:200] + '...' if len(request) > 200 else request}")
                     
                     params = self.parse_request(request)
                     Log.d(f"Params: {params}")
@@ -439,6 +2303,8 @@ class WebServer:
             <body>
             <h1>Network Status</h1>
             <pre>{self._net.getStatusString()}</pre>
+            <h2>Request Timings</h2>
+            <pre>{self._net.formatTimings()}</pre>
             <pre>Params: {params}</pre>
             </body></html>"""
         return html
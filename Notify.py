@@ -0,0 +1,215 @@
+"""
+Notify.py - new-assessment notifications by long-polling
+
+Without notifications the device only learns about a new assessment when
+the provider opens the patient, and cached lists have to be refetched
+every time they expire in case something changed. An AssessmentNotifier
+keeps one request outstanding to the new_assessments endpoint instead:
+
+GET new_assessments/<provider_id>?since=<assessment_id>&wait=<seconds>
+
+The server holds the request until an assessment newer than since is
+recorded for one of the provider's patients, or until wait seconds have
+passed, and answers with an ORDS-style collection of the new rows plus
+last_id, the newest assessment id it knows of. Without since it answers
+straight away with no rows, which tells the notifier where to start. A
+server that cannot hold requests can answer at once every time - the
+notifier then simply polls, no more often than every
+NOTIFY_MIN_INTERVAL_MS. A server without the endpoint at all (such as
+the real ORDS backend) answers the first request with a 404; the notifier
+then stops, and isUnsupported() tells the caller to fall back to polling
+the assessments itself.
+
+The request runs on its own connection, so the pooled one stays free for
+the rest of the DAL, and is sent and collected from poll() without ever
+blocking the controller loop while the server holds it.
+
+Basic usage:
+
+notifier = AssessmentNotifier(net, handler=newRows)
+notifier.start(f'{BASEURL}new_assessments/1')
+notifier.poll()     # call regularly - handler(rows) gets the new assessment rows
+notifier.stop()
+"""
+
+import time
+import json
+from Log import *
+from Net import *
+
+# Seconds the server is asked to hold a request open
+NOTIFY_WAIT = 25
+# Extra seconds allowed for the answer on top of the wait
+NOTIFY_GRACE = 10
+# Least time between two requests, for servers that answer at once
+NOTIFY_MIN_INTERVAL_MS = 2000
+# Wait before retrying doubles from MIN to MAX after each failure
+NOTIFY_RETRY_MIN_MS = 2000
+NOTIFY_RETRY_MAX_MS = 60000
+
+class AssessmentNotifier:
+    """
+    Long-polls a new-assessments URL and calls handler(rows) with the rows
+    of every assessment recorded after it was started.
+    """
+
+    def __init__(self, net, handler=None, wait=NOTIFY_WAIT):
+        self._net = net
+        self._handler = handler
+        self._wait = wait
+        self._url = None
+        self._conn = None
+        self._pending = False
+        self._since = None
+        self._sent = 0
+        self._next = time.ticks_ms()
+        self._backoff = 0
+        self._requests = 0
+        self._notified = 0
+        self._failures = 0
+        self._unsupported = False
+
+    def setHandler(self, handler):
+        self._handler = handler
+
+    def start(self, url):
+        """
+        Start listening on url. Only assessments recorded from now on are
+        passed to the handler.
+        """
+
+        self.stop()
+        self._url = url
+        self._unsupported = False
+        self._since = None
+        self._backoff = 0
+        self._next = time.ticks_ms()
+
+    def stop(self):
+        """ Stop listening and drop the outstanding request """
+
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self._pending = False
+        self._url = None
+
+    def isRunning(self):
+        return self._url is not None
+
+    def isListening(self):
+        """ True if running and the last request got an answer """
+
+        return self._url is not None and self._since is not None and self._backoff == 0
+
+    def isUnsupported(self):
+        """ True if the notifier stopped because the server has no such endpoint """
+
+        return self._unsupported
+
+    def _requestUrl(self):
+        if self._since is None:
+            return self._url
+        return f'{self._url}?since={self._since}&wait={self._wait}'
+
+    def poll(self):
+        """
+        Send the next request if one is due, or collect the answer to the
+        outstanding one if it has arrived. Never waits for the server to
+        answer. Returns True if it sent or read anything.
+        """
+
+        if self._url is None:
+            return False
+        if self._pending:
+            return self._collect()
+        if time.ticks_diff(time.ticks_ms(), self._next) < 0:
+            return False
+        url = self._requestUrl()
+        scheme, host, port, path = parseUrl(url)
+        try:
+            if self._conn is None:
+                self._conn = self._net.openChannel(url)
+            self._conn.send('GET', path, timeout=self._wait + NOTIFY_GRACE)
+        except Exception as e:
+            self._failed(e)
+            return True
+        self._pending = True
+        self._sent = time.ticks_ms()
+        self._requests += 1
+        return True
+
+    def _collect(self):
+        """ Read the answer to the outstanding request if it has arrived. Returns True if it did """
+
+        try:
+            if not self._conn.ready():
+                return False
+            response = self._conn.response()
+            status = response.status_code
+            if status == 404 and self._since is None:
+                response.close()
+                self._pending = False
+                self._notFound()
+                return True
+            reply = response.json()
+            if status >= 300:
+                raise OSError(f'status {status}')
+        except Exception as e:
+            self._pending = False
+            self._failed(e)
+            return True
+        self._pending = False
+        self._backoff = 0
+        self._next = time.ticks_add(self._sent, NOTIFY_MIN_INTERVAL_MS)
+        self._received(reply)
+        return True
+
+    def _received(self, reply):
+        rows = reply.get('items', [])
+        last = reply.get('last_id')
+        first = self._since is None
+        for row in rows:
+            if last is None or row['assessment_id'] > last:
+                last = row['assessment_id']
+        if last is not None and (self._since is None or last > self._since):
+            self._since = last
+        elif self._since is None:
+            self._since = 0
+        if first or not rows:
+            return
+        self._notified += len(rows)
+        Log.d(f'Notify: {len(rows)} new assessments')
+        if self._handler is not None:
+            try:
+                self._handler(rows)
+            except Exception as e:
+                Log.e(f'Notify: handler failed: {e}')
+
+    def _notFound(self):
+        """ The first request got a 404, so the server has no such endpoint """
+
+        Log.i(f'Notify: {self._url} not found, stopping notifications')
+        self.stop()
+        self._unsupported = True
+
+    def _failed(self, e):
+        self._failures += 1
+        if self._conn is not None:
+            self._conn.close()
+        self._backoff = min(NOTIFY_RETRY_MAX_MS, self._backoff * 2 if self._backoff else NOTIFY_RETRY_MIN_MS)
+        self._next = time.ticks_add(time.ticks_ms(), self._backoff)
+        Log.e(f'Notify: request failed ({e}), retrying in {self._backoff} ms')
+
+    def getStats(self):
+        """ Get a dictionary with the request/notification/failure counts and the last id seen """
+
+        return {
+            'running': self.isRunning(),
+            'unsupported': self._unsupported,
+            'requests': self._requests,
+            'notified': self._notified,
+            'failures': self._failures,
+            'since': self._since,
+            'backoff_ms': self._backoff
+        }
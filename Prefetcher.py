@@ -0,0 +1,96 @@
+"""
+Prefetcher.py - loads assessments ahead of time while the provider is idle
+
+While the provider browses the patient list, the assessments for the patient
+on screen and its neighbours are fetched into the DAL cache one at a time,
+so pressing select can be answered from memory instead of waiting on a
+round trip. Work is only done from poll(), which the controller calls from
+its stateDo loop, so buttons and timers keep being serviced between fetches.
+
+Basic usage:
+
+prefetcher = Prefetcher(dal)
+prefetcher.schedule([12, 13, 11])   # current patient first, then neighbours
+prefetcher.poll()                   # call regularly - does at most one fetch
+prefetcher.cancel()                 # provider moved on, drop pending work
+"""
+
+import time
+from Log import *
+
+class Prefetcher:
+    """
+    Keeps a small bounded queue of patient ids whose assessments should be
+    loaded, and fetches them one per poll once the provider has been idle
+    for a short while.
+    """
+
+    def __init__(self, dal, maxpending=3, idle_ms=300):
+        """
+        dal is the DAL used to fetch assessments. At most maxpending patients
+        are queued at a time, and nothing is fetched until idle_ms have passed
+        since the last schedule call so fast scrolling does not trigger
+        fetches for patients that are skipped over.
+        """
+
+        self._dal = dal
+        self._maxpending = maxpending
+        self._idle_ms = idle_ms
+        self._pending = []
+        self._scheduled = time.ticks_ms()
+        self._fetched = 0
+        self._cancelled = 0
+
+    def schedule(self, patient_ids):
+        """
+        Replace the pending work with the given patient ids, in priority
+        order. Anything queued for patients no longer in the list is dropped.
+        """
+
+        self._cancelled += len([p for p in self._pending if p not in patient_ids])
+        self._pending = []
+        for patient_id in patient_ids:
+            if patient_id not in self._pending and len(self._pending) < self._maxpending:
+                self._pending.append(patient_id)
+        self._scheduled = time.ticks_ms()
+
+    def cancel(self):
+        """ Drop all pending work """
+
+        self._cancelled += len(self._pending)
+        self._pending = []
+
+    def isIdle(self):
+        """ True when there is nothing left to prefetch """
+
+        return not self._pending
+
+    def poll(self):
+        """
+        Fetch the assessments for the next pending patient, if the provider has
+        been idle long enough. Patients already in the cache are skipped
+        without a request. At most one request is made per call.
+        """
+
+        if not self._pending:
+            return
+        if time.ticks_diff(time.ticks_ms(), self._scheduled) < self._idle_ms:
+            return
+        while self._pending:
+            patient_id = self._pending.pop(0)
+            if not self._dal.hasAssessments(patient_id):
+                try:
+                    self._dal.prefetchAssessments(patient_id)
+                    self._fetched += 1
+                except Exception as e:
+                    Log.e(f'Prefetcher: could not load assessments for {patient_id}: {e}')
+                return
+
+    def getStats(self):
+        """ Get a dictionary with the number of fetches made and cancelled """
+
+        return {
+            'pending': len(self._pending),
+            'fetched': self._fetched,
+            'cancelled': self._cancelled
+        }
@@ -0,0 +1,126 @@
+"""
+Retry.py - retrying writes to the backend, and keeping track of them
+
+On flaky Wi-Fi a write (a review mark, a request to generate assessments)
+can fail, or succeed on the server with the answer lost on the way back.
+Every write therefore carries an idempotency token, sent as the
+Idempotency-Key header and kept across its retries, so a server that has
+already carried it out can answer the retry without doing it twice.
+
+A RetrySchedule gives the wait before each retry: exponential backoff from
+base_ms up to max_ms, with jitter so that devices that failed together do
+not all retry together, and a bound on the number of attempts. WriteMetrics
+records every attempt and how it turned out.
+
+Basic usage:
+
+schedule = RetrySchedule()
+token = makeToken()
+delay = schedule.delay(attempt)         # ms to wait after the attempt'th failure
+if schedule.exhausted(attempt): ...     # give up
+metrics = WriteMetrics()
+metrics.record('review', 42, attempt, OK, ms=120, status=200)
+print(metrics.getStats())
+"""
+
+import time
+import random
+from Log import *
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+# Wait before the first retry, most wait between two attempts, and most
+# attempts at one write
+RETRY_BASE_MS = 2000
+RETRY_MAX_MS = 120000
+RETRY_ATTEMPTS = 6
+# Number of attempts kept by WriteMetrics
+METRICS_RING = 16
+
+# Outcomes of an attempt
+OK = 'ok'
+RETRY = 'retry'
+REJECTED = 'rejected'
+GAVE_UP = 'gave_up'
+OUTCOMES = (OK, RETRY, REJECTED, GAVE_UP)
+
+def makeToken():
+    """ A new random idempotency token """
+
+    return '%08x%08x' % (random.getrandbits(32), random.getrandbits(32))
+
+class RetrySchedule:
+    """
+    Jittered exponential backoff: after the nth failure of a write, wait a
+    random time between half and all of min(max_ms, base_ms * 2^(n-1)).
+    attempts is the most attempts at a write, or None for no limit.
+    """
+
+    def __init__(self, base_ms=RETRY_BASE_MS, max_ms=RETRY_MAX_MS, attempts=RETRY_ATTEMPTS):
+        self._base = base_ms
+        self._max = max_ms
+        self._attempts = attempts
+
+    def delay(self, failures):
+        """ ms to wait before the next attempt, after failures failed attempts """
+
+        ceiling = self._max
+        if failures < 32:
+            ceiling = min(self._max, self._base << max(0, failures - 1))
+        return ceiling // 2 + random.randint(0, ceiling // 2)
+
+    def exhausted(self, attempts):
+        """ True if a write that has been tried this many times should be given up """
+
+        return self._attempts is not None and attempts >= self._attempts
+
+class WriteMetrics:
+    """
+    Counts of attempts and outcomes per kind of write, and the last
+    METRICS_RING attempts.
+    """
+
+    def __init__(self, size=METRICS_RING):
+        self._counts = {}
+        self._ring = [None] * size
+        self._next = 0
+
+    def record(self, op, key, attempt, outcome, ms=0, status=None):
+        """
+        Record attempt number attempt (1 for the first) at write key of kind
+        op, its outcome (one of OUTCOMES), how long it took and the HTTP
+        status if there was one
+        """
+
+        counts = self._counts.get(op)
+        if counts is None:
+            counts = {'attempts': 0, 'retries': 0, OK: 0, RETRY: 0, REJECTED: 0, GAVE_UP: 0}
+            self._counts[op] = counts
+        counts['attempts'] += 1
+        if attempt > 1:
+            counts['retries'] += 1
+        counts[outcome] += 1
+        self._ring[self._next] = (op, key, attempt, outcome, ms, status)
+        self._next = (self._next + 1) % len(self._ring)
+        if outcome != OK:
+            Log.d(f'{op} {key}: attempt {attempt} {outcome} (status {status}, {ms} ms)')
+
+    def getStats(self):
+        """
+        Get a dictionary of op -> {'attempts', 'retries' (attempts after the
+        first), and a count per outcome}
+        """
+
+        return {op: dict(self._counts[op]) for op in self._counts}
+
+    def recent(self, count=None):
+        """ The attempts kept, newest first, as dictionaries """
+
+        result = []
+        for i in range(len(self._ring)):
+            entry = self._ring[(self._next - 1 - i) % len(self._ring)]
+            if entry is None or (count is not None and len(result) >= count):
+                break
+            op, key, attempt, outcome, ms, status = entry
+            result.append({'op': op, 'key': key, 'attempt': attempt, 'outcome': outcome,
+                           'ms': ms, 'status': status})
+        return result
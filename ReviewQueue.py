@@ -0,0 +1,202 @@
+"""
+ReviewQueue.py - a durable write-behind queue for provider review marks
+
+Marking an assessment reviewed should not make the provider wait on the
+network. The mark is recorded here right away (and appended to a small
+file on flash, so it survives a reboot), and poll() sends queued marks to
+the backend in batches, retrying with jittered exponential backoff when
+that fails (see Retry.py). Marking the same assessment twice only sends it
+once. Each mark gets an idempotency token that is sent with every attempt
+at it, and every attempt is recorded in the WriteMetrics if given.
+
+The file is append-only: a line "R <assessment_id> <patient_id> <token>"
+queues a mark and "A <assessment_id>" records that it was sent. Replaying
+the file on start-up rebuilds the queue. Once everything has been sent the
+file is removed so it never grows without bound.
+
+Basic usage:
+
+queue = ReviewQueue(send)       # send(assessment_id, token) -> (True/False/None, status)
+queue.add(42, 7)                # assessment 42 of patient 7 was reviewed
+queue.poll()                    # call regularly - flushes when due
+"""
+
+import os
+import time
+from Log import *
+from Retry import *
+
+QUEUE_FILE = 'reviewqueue.txt'
+# Marks sent per flush
+BATCH_SIZE = 5
+# Wait this long after the last mark before flushing, so marks made in
+# quick succession go out together
+FLUSH_DELAY_MS = 2000
+# Retry backoff after a failed flush doubles from MIN to MAX, with jitter.
+# Marks are never given up, so a long outage does not lose them
+BACKOFF_MIN_MS = 2000
+BACKOFF_MAX_MS = 120000
+
+class ReviewQueue:
+    """
+    Queue of assessment ids waiting to be marked reviewed on the backend.
+    send is called with one assessment id and its idempotency token at a
+    time and should return (result, status): result is True if the
+    backend accepted it, False if it should be retried later and None if
+    it was rejected for good (it is then dropped from the queue), and
+    status is the HTTP status of the answer, or None if there was none.
+    """
+
+    def __init__(self, send, path=QUEUE_FILE, schedule=None, metrics=None):
+        self._send = send
+        self._path = path
+        self._schedule = schedule if schedule is not None else RetrySchedule(BACKOFF_MIN_MS, BACKOFF_MAX_MS, None)
+        self._metrics = metrics
+        # assessment_id -> [patient_id, token, attempts]
+        self._pending = {}
+        self._nextflush = time.ticks_ms()
+        self._backoff = 0
+        # Flushes that have failed in a row
+        self._failed = 0
+        self._sent = 0
+        self._coalesced = 0
+        self._failures = 0
+        self._load()
+
+    def _load(self):
+        """ Rebuild the queue by replaying the file left by a previous run """
+
+        try:
+            with open(self._path) as f:
+                for line in f:
+                    parts = line.split()
+                    try:
+                        if len(parts) in (3, 4) and parts[0] == 'R':
+                            patient_id = None if parts[2] == '-' else int(parts[2])
+                            # Files from before tokens have none - give the mark one
+                            token = parts[3] if len(parts) == 4 else makeToken()
+                            self._pending[int(parts[1])] = [patient_id, token, 0]
+                        elif len(parts) == 2 and parts[0] == 'A':
+                            self._pending.pop(int(parts[1]), None)
+                    except ValueError:
+                        # A line cut short by a reset - ignore it
+                        pass
+        except OSError:
+            return
+        if self._pending:
+            Log.i(f'ReviewQueue: {len(self._pending)} reviews left from last run')
+        else:
+            self._compact()
+
+    def _append(self, line):
+        try:
+            with open(self._path, 'a') as f:
+                f.write(line + '\n')
+        except OSError as e:
+            Log.e(f'ReviewQueue: could not write {self._path}: {e}')
+
+    def _compact(self):
+        """ Remove the file once nothing is pending """
+
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+    def add(self, assessment_id, patient_id=None):
+        """
+        Queue a review mark. Returns False if the assessment was already
+        queued (the duplicate is coalesced), True otherwise.
+        """
+
+        if assessment_id in self._pending:
+            self._coalesced += 1
+            return False
+        token = makeToken()
+        self._pending[assessment_id] = [patient_id, token, 0]
+        self._append(f'R {assessment_id} {"-" if patient_id is None else patient_id} {token}')
+        if not self._backoff:
+            self._nextflush = time.ticks_add(time.ticks_ms(), FLUSH_DELAY_MS)
+        return True
+
+    def isPending(self, assessment_id):
+        return assessment_id in self._pending
+
+    def pending(self):
+        """ The assessment ids still waiting to be sent """
+
+        return list(self._pending)
+
+    def poll(self, batch=BATCH_SIZE):
+        """
+        Send up to batch queued marks if a flush is due. On the first
+        failure the rest of the batch is left queued and the next attempt is
+        pushed back by the retry schedule's jittered, exponentially growing
+        delay. Returns True if anything was sent.
+        """
+
+        if not self._pending or time.ticks_diff(time.ticks_ms(), self._nextflush) < 0:
+            return False
+        for assessment_id in list(self._pending)[:batch]:
+            entry = self._pending[assessment_id]
+            entry[2] += 1
+            start = time.ticks_ms()
+            try:
+                result, status = self._send(assessment_id, entry[1])
+            except Exception as e:
+                Log.e(f'ReviewQueue: sending {assessment_id} failed: {e}')
+                result, status = False, None
+            elapsed = time.ticks_diff(time.ticks_ms(), start)
+            if result is False and not self._schedule.exhausted(entry[2]):
+                self._record(assessment_id, entry[2], RETRY, elapsed, status)
+                self._failures += 1
+                self._failed += 1
+                self._backoff = self._schedule.delay(self._failed)
+                self._nextflush = time.ticks_add(time.ticks_ms(), self._backoff)
+                Log.d(f'ReviewQueue: retrying in {self._backoff} ms')
+                return True
+            if result is False:
+                self._record(assessment_id, entry[2], GAVE_UP, elapsed, status)
+                Log.e(f'ReviewQueue: giving up on review of {assessment_id} after {entry[2]} attempts')
+            elif result is None:
+                self._record(assessment_id, entry[2], REJECTED, elapsed, status)
+                Log.e(f'ReviewQueue: review of {assessment_id} rejected, dropping it')
+            else:
+                self._record(assessment_id, entry[2], OK, elapsed, status)
+                self._sent += 1
+            del self._pending[assessment_id]
+            self._append(f'A {assessment_id}')
+        self._backoff = 0
+        self._failed = 0
+        if not self._pending:
+            self._compact()
+        return True
+
+    def _record(self, assessment_id, attempt, outcome, ms, status=None):
+        if self._metrics is not None:
+            self._metrics.record('review', assessment_id, attempt, outcome, ms, status)
+
+    def flush(self):
+        """
+        Send everything queued right away, ignoring the flush delay and any
+        backoff. Returns True if the queue is empty afterwards.
+        """
+
+        while self._pending:
+            self._nextflush = time.ticks_ms()
+            failures = self._failures
+            self.poll()
+            if self._failures != failures:
+                return False
+        return True
+
+    def getStats(self):
+        """ Get a dictionary with the queue length and send/retry counts """
+
+        return {
+            'pending': len(self._pending),
+            'sent': self._sent,
+            'coalesced': self._coalesced,
+            'failures': self._failures,
+            'backoff_ms': self._backoff
+        }
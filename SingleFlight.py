@@ -0,0 +1,83 @@
+"""
+SingleFlight.py - one request at a time per URL for the async DAL
+
+With the async DAL, prefetching, refreshes and the provider's own
+navigation can all ask for the same patients/ or assessments/ URL while
+an earlier request for it is still on its way. SingleFlight lets only the
+first of them (the leader) make the request; the others wait for it and
+get the same result, or the same error, and the request they did not
+have to make is counted as saved.
+
+Basic usage:
+
+flights = SingleFlight()
+patients = await flights.run(url, load)   # load() returns a coroutine
+print(flights.getStats())
+"""
+
+from Log import *
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+class Flight:
+    """ A request in flight, and what became of it """
+
+    def __init__(self):
+        self.done = asyncio.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical reads: one in-flight load per key,
+    shared by every caller that asks for the key before it finishes.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._flown = 0
+        self._saved = 0
+
+    async def run(self, key, load):
+        """
+        The result of await load(), or of the load of key already in flight
+        """
+
+        flight = self._flights.get(key)
+        if flight is not None:
+            self._saved += 1
+            Log.d(f'SingleFlight: joining the request for {key}')
+            await flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        flight = Flight()
+        self._flights[key] = flight
+        self._flown += 1
+        try:
+            flight.result = await load()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        except BaseException:
+            # Cancelled - the callers waiting on it still need an answer
+            flight.error = OSError(f'request for {key} was cancelled')
+            raise
+        finally:
+            del self._flights[key]
+            flight.done.set()
+
+    def isInFlight(self, key):
+        return key in self._flights
+
+    def getStats(self):
+        """ Get a dictionary with the loads made, the requests saved and the loads in flight """
+
+        return {
+            'requests': self._flown,
+            'saved': self._saved,
+            'in_flight': len(self._flights)
+        }
@@ -0,0 +1,240 @@
+"""
+Sntp.py - keeping the RTC right with SNTP
+
+An SntpClient asks an NTP server for the time over UDP: one 48-byte
+datagram each way, instead of a DNS lookup, TLS handshake and JSON
+document from a web API. It takes a few samples and keeps the one with
+the least round-trip delay, since that is the one whose answer was held
+up the least on its way back. The server's receive (t2) and transmit (t3)
+times, and the send (t1) and receive (t4) times of the sample on the
+Pico's own tick counter, give
+
+delay  = (t4 - t1) - (t3 - t2)
+UTC at t4 = t3 + delay / 2
+
+All arithmetic is done in integer milliseconds, since MicroPython floats
+cannot hold a timestamp to the second.
+
+A ClockSync sets the RTC to local time in a zone (see TimeZones.py) from
+the client, and re-syncs every SYNC_INTERVAL seconds from poll() to keep
+the drift of the RTC bounded. How far the RTC had drifted by each re-sync
+is kept in its stats.
+
+Basic usage:
+
+clock = ClockSync(timezone='America/New_York')
+clock.sync()        # sets the RTC, True if it could
+clock.poll()        # call regularly - re-syncs when due, without blocking
+"""
+
+import time
+import struct
+import socket
+import random
+from Log import *
+from TimeZones import *
+
+SNTP_HOST = 'pool.ntp.org'
+SNTP_PORT = 123
+# Samples taken per sync, and seconds to wait for each answer
+SNTP_SAMPLES = 4
+SNTP_TIMEOUT = 1
+# Seconds from 1900-01-01 (the NTP epoch) to 1970-01-01
+NTP_DELTA = 2208988800
+# Seconds between syncs, and before trying again after a failed one
+SYNC_INTERVAL = 6 * 3600
+SYNC_RETRY = 300
+# Longest a re-sync from poll() may spend waiting for answers (ms)
+POLL_QUERY_BUDGET_MS = 1000
+
+def fromNtp(seconds, fraction):
+    """ Unix time in ms of an NTP timestamp """
+
+    return (seconds - NTP_DELTA) * 1000 + ((fraction * 1000) >> 32)
+
+class SntpClient:
+    """
+    Gets UTC from an NTP server. resolver, if given, is a Net Resolver used
+    to look the server up.
+    """
+
+    def __init__(self, host=SNTP_HOST, port=SNTP_PORT, samples=SNTP_SAMPLES,
+                 timeout=SNTP_TIMEOUT, resolver=None):
+        self._host = host
+        self._port = port
+        self._samples = samples
+        self._timeout = timeout
+        self._resolver = resolver
+        self._request = bytearray(48)
+        # Delay (ms) of the sample used by the last query
+        self.delay = None
+
+    def _address(self):
+        if self._resolver is not None:
+            return self._resolver.resolve(self._host, self._port)
+        return socket.getaddrinfo(self._host, self._port, 0, socket.SOCK_DGRAM)[0][-1]
+
+    def _sample(self, sock, addr):
+        """
+        One request and its answer: (delay ms, UTC ms at t4, t4 ticks_ms).
+        Raises OSError if there is no valid answer in time.
+        """
+
+        # LI 0, version 4, mode 3 (client). The transmit timestamp is only
+        # a cookie the server echoes back, to pair its answer with this request
+        self._request[0] = 0x23
+        cookie = (random.getrandbits(32), random.getrandbits(32))
+        struct.pack_into('!II', self._request, 40, cookie[0], cookie[1])
+        t1 = time.ticks_us()
+        sock.sendto(self._request, addr)
+        while True:
+            reply = sock.recv(48)
+            t4 = time.ticks_us()
+            t4ms = time.ticks_ms()
+            if len(reply) >= 48 and struct.unpack_from('!II', reply, 24) == cookie:
+                break
+            # A late answer to an earlier sample - wait for this one
+        if reply[0] & 7 != 4 or reply[1] == 0:
+            raise OSError(f'SNTP: refused by {self._host} (stratum {reply[1]})')
+        t2 = fromNtp(*struct.unpack_from('!II', reply, 32))
+        t3 = fromNtp(*struct.unpack_from('!II', reply, 40))
+        delay = max(0, time.ticks_diff(t4, t1) // 1000 - (t3 - t2))
+        return delay, t3 + delay // 2, t4ms
+
+    def query(self, budget=None):
+        """
+        Ask the server for the time. Returns (UTC ms, ticks_ms) - the time
+        and the tick count it was that time at - from the sample with the
+        least delay, or raises OSError if no sample got an answer. If a
+        budget (ms) is given, no more samples are taken once it is spent.
+        """
+
+        addr = self._address()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        best = None
+        deadline = None if budget is None else time.ticks_add(time.ticks_ms(), budget)
+        try:
+            sock.settimeout(self._timeout)
+            for i in range(self._samples):
+                if deadline is not None:
+                    left = time.ticks_diff(deadline, time.ticks_ms())
+                    if left <= 0:
+                        break
+                    sock.settimeout(min(self._timeout, left / 1000))
+                try:
+                    sample = self._sample(sock, addr)
+                except OSError as e:
+                    if best is None and i == 0:
+                        # Nothing back at all - the server is not there
+                        raise
+                    Log.d(f'SNTP: sample {i} failed: {e}')
+                    continue
+                if best is None or sample[0] < best[0]:
+                    best = sample
+        finally:
+            sock.close()
+        if best is None:
+            raise OSError(f'SNTP: no answer from {self._host}')
+        self.delay = best[0]
+        return best[1], best[2]
+
+class ClockSync:
+    """
+    Keeps the RTC set to local time in a zone from an SntpClient.
+    """
+
+    def __init__(self, timezone='UTC', client=None, interval=SYNC_INTERVAL, retry=SYNC_RETRY):
+        self._timezone = timezone
+        self._client = client if client is not None else SntpClient()
+        self._interval = interval
+        self._retry = retry
+        self._started = False
+        self._next = time.ticks_ms()
+        self._syncs = 0
+        self._failures = 0
+        self._drift = None
+        self._synced = None
+        # (UTC second, ticks_ms) the RTC is to be set to from poll()
+        self._setat = None
+
+    def setTimezone(self, timezone):
+        """ The zone the RTC is kept in. Raises ValueError if it is not in ZONES """
+
+        utcOffset(timezone, 0)
+        self._timezone = timezone
+
+    def sync(self, wait=True):
+        """
+        Set the RTC from the server now, and re-sync from poll() from now on.
+        Returns True if the RTC was set. The RTC only takes whole seconds, so
+        it is set at the start of the next one: with wait False the query is
+        cut short after POLL_QUERY_BUDGET_MS and, instead of sleeping until
+        then, the RTC is set by a later poll(), and True means it will be.
+        """
+
+        self._started = True
+        try:
+            utc, ticks = self._client.query(None if wait else POLL_QUERY_BUDGET_MS)
+        except OSError as e:
+            self._failures += 1
+            self._next = time.ticks_add(time.ticks_ms(), self._retry * 1000)
+            Log.e(f'ClockSync: sync failed ({e}), retrying in {self._retry} s')
+            return False
+        now = utc + time.ticks_diff(time.ticks_ms(), ticks)
+        self._setat = ((now // 1000) + 1, time.ticks_add(time.ticks_ms(), 1000 - now % 1000))
+        if wait:
+            time.sleep_ms(max(0, time.ticks_diff(self._setat[1], time.ticks_ms())))
+            self._setRtc()
+        return True
+
+    def _setRtc(self):
+        """ Set the RTC to the second a sync worked out, once it has started """
+
+        second, at = self._setat
+        self._setat = None
+        utc = second + time.ticks_diff(time.ticks_ms(), at) // 1000
+        offset = utcOffset(self._timezone, utc)
+        local = utc + offset
+        if self._synced is not None:
+            # How far the RTC had drifted since the last sync
+            self._drift = (local - (time.time() + EPOCH_OFFSET)) * 1000
+        import machine
+        tm = gmtime(local)
+        machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+        self._syncs += 1
+        self._synced = utc
+        self._next = time.ticks_add(time.ticks_ms(), self._interval * 1000)
+        Log.i(f'ClockSync: RTC set to {tm[0]}-{tm[1]:02}-{tm[2]:02} {tm[3]:02}:{tm[4]:02}:{tm[5]:02} '
+              f'{self._timezone} (delay {self._client.delay} ms)')
+
+    def poll(self):
+        """
+        Re-sync without blocking if the interval (or the retry wait after a
+        failure) has passed, or set the RTC once the second a re-sync is
+        waiting for has started. Returns True if it asked the server.
+        """
+
+        if self._setat is not None:
+            if time.ticks_diff(time.ticks_ms(), self._setat[1]) >= 0:
+                self._setRtc()
+            return False
+        if self._started and time.ticks_diff(time.ticks_ms(), self._next) >= 0:
+            self.sync(wait=False)
+            return True
+        return False
+
+    def getStats(self):
+        """
+        Get a dictionary with the sync and failure counts, the delay (ms) of
+        the last sample used, the drift (ms) corrected by the last sync and
+        when it was (Unix seconds, UTC)
+        """
+
+        return {
+            'timezone': self._timezone,
+            'syncs': self._syncs,
+            'failures': self._failures,
+            'delay_ms': self._client.delay,
+            'drift_ms': self._drift,
+            'synced': self._synced
+        }
@@ -0,0 +1,127 @@
+"""
+Spill.py - spilling large response bodies to flash
+
+A response body bigger than the free heap cannot be read into memory, and
+streaming it straight off the connection keeps the connection (and the
+server) waiting for as long as the rows take to process. Net writes a body
+that crosses its spill threshold to a temporary file on flash instead, in
+small blocks, and hands back a SpillFile to read it from. The connection
+is free again as soon as the body has been written, and the JSON is parsed
+from the file a buffer at a time (see JsonStream.py), so the RAM used stays
+bounded whatever the size of the body.
+
+The file is removed when the SpillFile is closed. Files left behind by a
+reset are removed by cleanup().
+
+Basic usage:
+
+body = spill(response)      # a SpillFile, or None if it did not fit on flash
+items = ItemsStream(body)   # parse it as if it were the response
+"""
+
+import os
+from Log import *
+
+SPILL_PREFIX = 'spill'
+SPILL_SUFFIX = '.tmp'
+# Bytes copied from the connection to the file at a time
+SPILL_BLOCK = 512
+# Flash left free after a spill
+SPILL_RESERVE = 32768
+
+_counter = 0
+
+def freeFlash(path='/'):
+    """ Bytes free on the filesystem, or None if it cannot be told """
+
+    try:
+        stat = os.statvfs(path)
+        return stat[0] * stat[4]
+    except (AttributeError, OSError):
+        return None
+
+def cleanup():
+    """ Remove spill files left behind by an earlier run """
+
+    try:
+        names = os.listdir()
+    except OSError:
+        return
+    for name in names:
+        if name.startswith(SPILL_PREFIX) and name.endswith(SPILL_SUFFIX):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+class SpillFile:
+    """
+    A response body on flash: readinto/read like the response itself, and
+    the file is removed on close.
+    """
+
+    # Nothing is left on a connection to drain when it is closed early
+    spilled = True
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._file = open(path, 'rb')
+
+    def readinto(self, buf):
+        if self._file is None:
+            return 0
+        return self._file.readinto(buf) or 0
+
+    def read(self, size=-1):
+        if self._file is None:
+            return b''
+        return self._file.read(size) or b''
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def spill(response, expected=None):
+    """
+    Copy the rest of a response body to a new spill file and close the
+    response. expected is the size of the body if known; if it would not
+    fit on flash (keeping SPILL_RESERVE free), nothing is read and None is
+    returned so the body can be streamed as usual. Raises OSError (with the
+    response closed and the file removed) if the copy fails.
+    """
+
+    global _counter
+    free = freeFlash()
+    if expected is not None and free is not None and expected > free - SPILL_RESERVE:
+        Log.d(f'Spill: {expected} bytes will not fit in {free} bytes of flash')
+        return None
+    _counter += 1
+    path = f'{SPILL_PREFIX}{_counter}{SPILL_SUFFIX}'
+    block = bytearray(SPILL_BLOCK)
+    view = memoryview(block)
+    size = 0
+    try:
+        with open(path, 'wb') as f:
+            while True:
+                count = response.readinto(block)
+                if not count:
+                    break
+                f.write(view[:count])
+                size += count
+        response.close()
+    except Exception:
+        response.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        raise
+    Log.d(f'Spill: {size} bytes written to {path}')
+    return SpillFile(path, size)
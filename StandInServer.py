@@ -0,0 +1,567 @@
+"""
+StandInServer.py - a local stand-in for the Oracle Apex ORDS endpoints
+
+Serves the same REST endpoints the DAL uses (rfidtag, provider, patients,
+assessments, provider_reviewed) from made-up in-memory data, so Net and DAL
+can be exercised offline. It runs under CPython on a laptop, not on the Pico.
+
+Responses carry an ETag and a Last-Modified header, and conditional GETs
+(If-None-Match / If-Modified-Since) are answered with 304 Not Modified when
+the data has not changed.
+
+Collections honour a simple ORDS q= filter: equality and $eq/$ne/$gt
+conditions on columns, and $orderby.
+
+JSON bodies are gzip or deflate compressed when the client's
+Accept-Encoding allows it, unless the server is started with
+compress=False.
+
+new_assessments/<provider_id>?since=<id>&wait=<s> is a long poll. It is
+held until an assessment newer than since is added for one of the
+provider's patients, or for wait seconds.
+
+Marking an assessment reviewed or posting new assessments changes the
+data, just like the real backend.
+
+StandInServer(latency=0.05) delays every response by that many seconds on
+its way back, like a slow link to the real backend would. The next request
+on the connection is read and answered meanwhile, so pipelined requests
+overlap their waits as they would over the network.
+
+Writes (PUT and POST) that carry an Idempotency-Key header are carried out
+once per key: a retry with the same key gets the first answer again
+without changing anything. StandInServer(write_failures=0.3) answers that
+share of writes with a 503 after carrying them out, as if the answer had
+been lost on the way back, to exercise the client's retries.
+
+StandInNtpServer answers SNTP requests over UDP for Sntp.py, with a
+clock that can be set off from the host's and requests that can be held
+up by a random latency, to check that the client corrects for both.
+
+Basic usage:
+
+python StandInServer.py 8080 [latency] [patients] [assessments]
+
+and then, on the Pico or the host:
+
+import DAL
+DAL.setBaseUrl('http://<laptop ip>:8080/ords/c85/pihealth/')
+
+Or from a host script:
+
+server = StandInServer(port=8080)
+server.start()      # serves from a background thread
+...
+print(server.stats)
+server.stop()
+"""
+
+import json
+import time
+import zlib
+import gzip
+import threading
+import queue
+import random
+import socket
+import struct
+from urllib.parse import unquote, quote
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BASEPATH = '/ords/c85/pihealth/'
+RESULTS = ['HEALTHY', 'UNHEALTHY']
+
+class StandInData:
+    """
+    The made-up backend data: one provider (badge c908e41134) with a number
+    of patients, each with a history of assessments. Every collection keeps
+    the time it was last changed, which is used as its Last-Modified.
+    """
+
+    def __init__(self, patients=5, assessments=4):
+        # Reentrant so addAssessment can be called with or without it held
+        self.lock = threading.RLock()
+        # Notified whenever an assessment is added, for long polls
+        self.changed = threading.Condition(self.lock)
+        # Idempotency-Key -> (answer, status) of the writes carried out
+        self.written = {}
+        self.rfidtags = {
+            'c908e41134': {'provider_id': 1, 'card_code': 'c908e41134', 'card_status': 'ACTIVE'},
+            'deadbeef00': {'provider_id': 2, 'card_code': 'deadbeef00', 'card_status': 'INACTIVE'}
+        }
+        self.providers = {
+            1: {'provider_id': 1, 'first_name': 'Ada', 'last_name': 'Lovelace',
+                'title': 'MD', 'specialty': 'Cardiology'},
+            2: {'provider_id': 2, 'first_name': 'Alan', 'last_name': 'Turing',
+                'title': 'RN', 'specialty': 'General'}
+        }
+        self.patients = {1: [], 2: []}
+        self.assessments = {}
+        self.modified = {}
+        self._nextassessment = 1
+        for i in range(patients):
+            patient_id = 100 + i
+            self.patients[1].append({'patient_id': patient_id, 'first_name': f'Pat{i}',
+                                     'last_name': f'Patient{i}', 'birth_date': '1970-01-01T00:00:00Z'})
+            self.assessments[patient_id] = []
+            for j in range(assessments):
+                self.addAssessment(patient_id, reviewed='Y' if j < assessments // 2 else 'N')
+        now = time.time()
+        self.modified['patients/1'] = now
+        self.modified['patients/2'] = now
+
+    def addAssessment(self, patient_id, reviewed='N'):
+        """ Record a new assessment for a patient and return it """
+
+        with self.lock:
+            return self._addAssessment(patient_id, reviewed)
+
+    def _addAssessment(self, patient_id, reviewed):
+        assessment_id = self._nextassessment
+        self._nextassessment += 1
+        tm = time.gmtime(time.time() - 3600 * (100 - assessment_id % 100))
+        assessment = {
+            'assessment_id': assessment_id,
+            'patient_id': patient_id,
+            'assessment_dt': time.strftime('%Y-%m-%dT%H:%M:%SZ', tm),
+            'assessment_result': RESULTS[assessment_id % 2],
+            'provider_id': 1,
+            'provider_reviewed': reviewed
+        }
+        self.assessments[patient_id].append(assessment)
+        self.modified[f'assessments/{patient_id}'] = time.time()
+        self.changed.notify_all()
+        return assessment
+
+    def lastAssessmentId(self):
+        return self._nextassessment - 1
+
+    def newAssessments(self, provider_id, since):
+        """ The assessments of a provider's patients with an id above since """
+
+        rows = []
+        for patient in self.patients.get(provider_id, []):
+            rows.extend(a for a in self.assessments[patient['patient_id']] if a['assessment_id'] > since)
+        return sorted(rows, key=lambda a: a['assessment_id'])
+
+    def markReviewed(self, assessment_id):
+        """ Set provider_reviewed to Y. Returns the assessment or None """
+
+        for patient_id in self.assessments:
+            for assessment in self.assessments[patient_id]:
+                if assessment['assessment_id'] == assessment_id:
+                    assessment['provider_reviewed'] = 'Y'
+                    self.modified[f'assessments/{patient_id}'] = time.time()
+                    return assessment
+        return None
+
+def parseQuery(query):
+    """ Turn a query string into a dictionary of URL-decoded values """
+
+    params = {}
+    for pair in query.split('&'):
+        if '=' in pair:
+            k, v = pair.split('=', 1)
+            params[k] = unquote(v)
+    return params
+
+def filterItems(items, q):
+    """
+    Apply an ORDS q= filter object to a list of rows. Only what the DAL
+    uses is supported: column conditions ("col": value, or {"$eq": value},
+    {"$ne": value} or {"$gt": value}) and "$orderby" with asc/desc columns.
+    """
+
+    orderby = {}
+    for column, condition in q.items():
+        if column == '$orderby':
+            orderby = condition
+        elif isinstance(condition, dict):
+            if '$eq' in condition:
+                items = [item for item in items if item.get(column) == condition['$eq']]
+            if '$ne' in condition:
+                items = [item for item in items if item.get(column) != condition['$ne']]
+            if '$gt' in condition:
+                items = [item for item in items if item.get(column) > condition['$gt']]
+        else:
+            items = [item for item in items if item.get(column) == condition]
+    for column, direction in reversed(list(orderby.items())):
+        items = sorted(items, key=lambda item: item.get(column), reverse=str(direction).lower() == 'desc')
+    return items
+
+def collection(items, path, query='', host=''):
+    """
+    Wrap a list the way ORDS returns a collection: one page of at most
+    limit rows starting at offset, with a next link if there are more.
+    A q= filter is applied before paging and carried into the next link.
+    """
+
+    params = parseQuery(query)
+    limit = int(params.get('limit', 25))
+    offset = int(params.get('offset', 0))
+    filterarg = ''
+    if 'q' in params:
+        items = filterItems(items, json.loads(params['q']))
+        filterarg = '&q=' + quote(params['q'], safe='')
+    page = items[offset:offset + limit]
+    hasmore = offset + limit < len(items)
+    links = [{'rel': 'self', 'href': f'{host}{BASEPATH}{path}'}]
+    if hasmore:
+        links.append({'rel': 'next',
+                      'href': f'{host}{BASEPATH}{path}?offset={offset + limit}&limit={limit}{filterarg}'})
+    return {
+        'items': page,
+        'hasMore': hasmore,
+        'limit': limit,
+        'offset': offset,
+        'count': len(page),
+        'links': links
+    }
+
+class DelayedWriter:
+    """
+    Stands in for a handler's wfile, delivering everything written to it
+    latency seconds later from a thread of its own.
+    """
+
+    def __init__(self, sock, latency):
+        self._sock = sock
+        self._latency = latency
+        self._queue = queue.Queue()
+        self.closed = False
+        self._thread = threading.Thread(target=self._deliver, daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        self._queue.put((time.monotonic() + self._latency, bytes(data)))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _deliver(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            due, data = item
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self._sock.sendall(data)
+            except OSError:
+                pass
+
+    def close(self):
+        """ Wait for everything written to be delivered """
+
+        if not self.closed:
+            self.closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ Handles one connection. HTTP/1.1 so connections are kept alive. """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately - without this, Nagle's
+    # algorithm and delayed ACKs add 40 ms to every response
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        if self.server.latency:
+            self.wfile = DelayedWriter(self.connection, self.server.latency)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def sendJson(self, obj, status=200, modified=None):
+        """
+        Send obj as JSON with an ETag (and Last-Modified if given), or a 304
+        if the request's validators show the client already has it.
+        """
+
+        body = json.dumps(obj).encode()
+        etag = '"%08x"' % zlib.crc32(body)
+        lastmodified = formatdate(modified, usegmt=True) if modified else None
+        if status == 200 and self.isNotModified(etag, modified):
+            self.server.count('not_modified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body, encoding = self.encodeBody(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', etag)
+        if lastmodified:
+            self.send_header('Last-Modified', lastmodified)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count('bytes_sent', len(body))
+
+    def encodeBody(self, body):
+        """ Compress body if the client accepts it. Returns (body, encoding) """
+
+        if not self.server.compress:
+            return body, None
+        accepted = [e.split(';', 1)[0].strip() for e in self.headers.get('Accept-Encoding', '').split(',')]
+        if 'gzip' in accepted:
+            return gzip.compress(body), 'gzip'
+        if 'deflate' in accepted:
+            return zlib.compress(body), 'deflate'
+        return body, None
+
+    def isNotModified(self, etag, modified):
+        inm = self.headers.get('If-None-Match')
+        if inm is not None:
+            return inm == etag
+        ims = self.headers.get('If-Modified-Since')
+        if ims is not None and modified:
+            try:
+                return int(modified) <= parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def hostUrl(self):
+        """ The scheme and host the client used, for absolute links """
+
+        return f"http://{self.headers.get('Host', 'localhost')}"
+
+    def notFound(self):
+        self.sendJson({'code': 'NotFound', 'message': f'{self.path} not found'}, status=404)
+
+    def route(self):
+        """ Split the request path into (resource, argument, query) """
+
+        path = self.path
+        query = ''
+        if '?' in path:
+            path, query = path.split('?', 1)
+        if not path.startswith(BASEPATH):
+            return None, None, query
+        parts = path[len(BASEPATH):].strip('/').split('/')
+        return parts[0], parts[1] if len(parts) > 1 else None, query
+
+    def do_GET(self):
+        self.server.count('requests')
+        data = self.server.data
+        resource, arg, query = self.route()
+        with data.lock:
+            if resource == 'rfidtag' and arg in data.rfidtags:
+                self.sendJson(data.rfidtags[arg])
+            elif resource == 'provider' and arg and int(arg) in data.providers:
+                self.sendJson(data.providers[int(arg)])
+            elif resource == 'patients' and arg and int(arg) in data.patients:
+                self.sendJson(collection(data.patients[int(arg)], f'patients/{arg}', query, self.hostUrl()),
+                              modified=data.modified.get(f'patients/{arg}'))
+            elif resource == 'assessments' and arg and int(arg) in data.assessments:
+                self.sendJson(collection(data.assessments[int(arg)], f'assessments/{arg}', query, self.hostUrl()),
+                              modified=data.modified.get(f'assessments/{arg}'))
+            elif resource == 'new_assessments' and arg and int(arg) in data.patients:
+                self.longPoll(int(arg), parseQuery(query))
+            else:
+                self.notFound()
+
+    def longPoll(self, provider_id, params):
+        """
+        Answer a new_assessments request, waiting (with the data lock
+        released) for up to wait seconds for an assessment newer than since
+        """
+
+        data = self.server.data
+        rows = []
+        if 'since' in params:
+            since = int(params['since'])
+            deadline = time.time() + min(float(params.get('wait', 0)), 60)
+            rows = data.newAssessments(provider_id, since)
+            while not rows and time.time() < deadline:
+                data.changed.wait(deadline - time.time())
+                rows = data.newAssessments(provider_id, since)
+            self.server.count('long_polls')
+        self.sendJson({'items': rows, 'count': len(rows), 'last_id': data.lastAssessmentId()})
+
+    def sendWrite(self, obj, status=200):
+        """
+        Answer a write, remembering the answer under its Idempotency-Key.
+        Some answers are replaced by a 503 if write_failures is set.
+        """
+
+        key = self.headers.get('Idempotency-Key')
+        if key:
+            self.server.data.written[key] = (obj, status)
+        if random.random() < self.server.write_failures:
+            self.server.count('write_failures')
+            self.sendJson({'message': 'answer lost'}, status=503)
+            return
+        self.sendJson(obj, status)
+
+    def replayWrite(self):
+        """ Answer a retried write as before, if its Idempotency-Key has been seen. Returns True if it was """
+
+        key = self.headers.get('Idempotency-Key')
+        if not key or key not in self.server.data.written:
+            return False
+        self.server.count('replayed')
+        obj, status = self.server.data.written[key]
+        self.sendJson(obj, status)
+        return True
+
+    def do_PUT(self):
+        self.server.count('requests')
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        resource, arg, query = self.route()
+        with self.server.data.lock:
+            if self.replayWrite():
+                return
+            if resource == 'provider_reviewed' and arg:
+                assessment = self.server.data.markReviewed(int(arg))
+                if assessment:
+                    self.sendWrite({'assessment_id': assessment['assessment_id'], 'provider_reviewed': 'Y'})
+                    return
+            self.notFound()
+
+    def do_POST(self):
+        self.server.count('requests')
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        resource, arg, query = self.route()
+        data = self.server.data
+        with data.lock:
+            if self.replayWrite():
+                return
+            if resource == 'assessments':
+                # Like the real backend, generate an assessment for each patient
+                created = [data.addAssessment(patient_id) for patient_id in data.assessments]
+                self.sendWrite({'created': len(created)}, status=201)
+            else:
+                self.notFound()
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    The stand-in server itself. Keeps simple counters in stats so tests and
+    benchmarks can see how many requests, 304s and body bytes (as sent on
+    the wire, after any compression) were served.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=8080, host='0.0.0.0', data=None, verbose=False, compress=True, latency=0,
+                 write_failures=0):
+        super().__init__((host, port), StandInHandler)
+        self.data = data if data is not None else StandInData()
+        self.verbose = verbose
+        self.compress = compress
+        self.latency = latency
+        self.write_failures = write_failures
+        self.stats = {'requests': 0, 'not_modified': 0, 'bytes_sent': 0}
+        self._statslock = threading.Lock()
+        self._thread = None
+
+    def count(self, name, amount=1):
+        with self._statslock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def baseUrl(self, host='127.0.0.1'):
+        """ The base URL to pass to DAL.setBaseUrl """
+
+        return f'http://{host}:{self.server_address[1]}{BASEPATH}'
+
+    def start(self):
+        """ Serve from a background thread """
+
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+# Seconds from 1900-01-01 (the NTP epoch) to 1970-01-01
+NTP_DELTA = 2208988800
+
+def ntpTimestamp(t):
+    """ The NTP (seconds, fraction) of a Unix time in seconds """
+
+    seconds = int(t)
+    return (seconds + NTP_DELTA) & 0xffffffff, int((t - seconds) * 2 ** 32)
+
+class StandInNtpServer:
+    """
+    A stratum 1 SNTP server whose clock is offset seconds ahead of the
+    host's. Every request is held up by a random 0..latency seconds before
+    the server reads its clock, like a slow link on the way there would,
+    so samples are off by half their delay and the client has to pick the
+    one with the least.
+    """
+
+    def __init__(self, port=0, host='0.0.0.0', offset=0, latency=0):
+        self.offset = offset
+        self.latency = latency
+        self.stats = {'requests': 0}
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((host, port))
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._sock.getsockname()[1]
+
+    def now(self):
+        return time.time() + self.offset
+
+    def serve_forever(self):
+        while True:
+            try:
+                request, addr = self._sock.recvfrom(512)
+            except OSError:
+                return
+            if len(request) < 48:
+                continue
+            self.stats['requests'] += 1
+            if self.latency:
+                time.sleep(random.random() * self.latency)
+            received = self.now()
+            reply = bytearray(48)
+            # LI 0, version 4, mode 4 (server), stratum 1
+            reply[0] = 0x24
+            reply[1] = 1
+            reply[24:32] = request[40:48]
+            struct.pack_into('!II', reply, 32, *ntpTimestamp(received))
+            struct.pack_into('!II', reply, 40, *ntpTimestamp(self.now()))
+            try:
+                self._sock.sendto(reply, addr)
+            except OSError:
+                return
+
+    def start(self):
+        """ Serve from a background thread """
+
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._sock.close()
+
+if __name__ == '__main__':
+    import sys
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    patients = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    assessments = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+    server = StandInServer(port=port, data=StandInData(patients, assessments), verbose=True, latency=latency)
+    print(f'Stand-in ORDS server on {server.baseUrl()} - Ctrl-C to stop')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
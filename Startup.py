@@ -0,0 +1,69 @@
+"""
+Startup.py - timing of the boot phases
+
+The controller starts Wi-Fi first and sets up the hardware while the
+association completes, so boot phases overlap. A BootTimer records when
+each phase started and when it was ready, measured from the start of boot,
+so the time-to-ready of each phase (and of the whole device) can be seen.
+
+Basic usage:
+
+boot = BootTimer()
+boot.start('wifi')
+...
+boot.ready('wifi')
+boot.report()       # logs each phase and returns the timings
+"""
+
+import time
+from Log import *
+
+class BootTimer:
+    """
+    Start and ready times (ms since the BootTimer was created) of named
+    boot phases, in the order they were started.
+    """
+
+    def __init__(self):
+        self._boot = time.ticks_ms()
+        self._phases = []
+        self._times = {}
+
+    def _now(self):
+        return time.ticks_diff(time.ticks_ms(), self._boot)
+
+    def start(self, phase):
+        """ Note that a phase has started """
+
+        if phase not in self._times:
+            self._phases.append(phase)
+        self._times[phase] = [self._now(), None, True]
+
+    def ready(self, phase, ok=True):
+        """ Note that a phase has finished, and whether it succeeded """
+
+        if phase not in self._times:
+            self.start(phase)
+        self._times[phase][1] = self._now()
+        self._times[phase][2] = ok
+
+    def report(self):
+        """
+        Log the time each phase took and when it was ready. Returns a
+        dictionary of phase -> (started_ms, ready_ms, ok), with 'total' the
+        time from the start of boot to the last phase being ready.
+        """
+
+        result = {}
+        total = 0
+        for phase in self._phases:
+            started, ready, ok = self._times[phase]
+            if ready is None:
+                Log.i(f'Boot: {phase} started at {started} ms, not ready')
+                continue
+            total = max(total, ready)
+            Log.i(f"Boot: {phase} took {ready - started} ms, ready at {ready} ms{'' if ok else ' (failed)'}")
+            result[phase] = (started, ready, ok)
+        Log.i(f'Boot: ready after {total} ms')
+        result['total'] = total
+        return result
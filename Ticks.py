@@ -0,0 +1,47 @@
+"""
+Ticks.py - MicroPython's tick counter functions on a host
+
+The network code keeps time with time.ticks_ms and friends, which only
+MicroPython has. Importing this module adds them to the time module when
+they are missing, built on time.perf_counter_ns and wrapping around like
+the Pico's counter, so the same code runs under CPython on a laptop (the
+benchmarks, the stand-in server and the async client). On the Pico it
+does nothing.
+
+Basic usage:
+
+import Ticks        # before anything calls time.ticks_ms
+"""
+
+import time
+
+# MicroPython ticks wrap around at 2^30
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALF = TICKS_PERIOD // 2
+
+def ticks_ms():
+    return (time.perf_counter_ns() // 1000000) & TICKS_MAX
+
+def ticks_us():
+    return (time.perf_counter_ns() // 1000) & TICKS_MAX
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + TICKS_HALF) & TICKS_MAX) - TICKS_HALF
+
+def sleep_ms(ms):
+    time.sleep(ms / 1000)
+
+def sleep_us(us):
+    time.sleep(us / 1000000)
+
+if not hasattr(time, 'ticks_ms'):
+    time.ticks_ms = ticks_ms
+    time.ticks_us = ticks_us
+    time.ticks_add = ticks_add
+    time.ticks_diff = ticks_diff
+    time.sleep_ms = sleep_ms
+    time.sleep_us = sleep_us
@@ -0,0 +1,112 @@
+"""
+TimeZones.py - UTC offsets and daylight saving time from a local rule table
+
+The Pico's RTC keeps local wall-clock time, but SNTP gives UTC. Rather
+than asking a web service for the offset, each zone the device may be
+used in is listed in ZONES with its standard offset and the rule for when
+daylight saving time starts and ends, so the offset of any moment can be
+worked out on the device.
+
+Times are Unix seconds (since 1970-01-01 UTC) whatever the epoch of the
+MicroPython port; gmtime converts them for the port's time functions.
+
+Basic usage:
+
+offset = utcOffset('America/New_York', utc)    # seconds, DST included
+tm = gmtime(utc + offset)                      # local time tuple
+"""
+
+import time
+
+# Unix time of the port's epoch: 1970 on most ports, 2000 on some
+EPOCH_OFFSET = 0 if time.gmtime(0)[0] == 1970 else 946684800
+# Daylight saving time is this many seconds ahead of standard time
+DST_SAVING = 3600
+
+# A DST rule is (start month, start week, start minute, end month, end
+# week, end minute, minutes in UTC). It starts and ends on a Sunday: week
+# n is the nth Sunday of the month, -1 the last one. The minutes are the
+# time of day of the change in local standard time, or in UTC if the last
+# member is True. Southern zones start in a later month than they end.
+US_DST = (3, 2, 120, 11, 1, 60, False)
+EU_DST = (3, -1, 60, 10, -1, 60, True)
+AU_DST = (10, 1, 120, 4, 1, 120, False)
+
+# Zone -> (standard offset from UTC in minutes, DST rule or None)
+ZONES = {
+    'UTC': (0, None),
+    'America/New_York': (-300, US_DST),
+    'America/Chicago': (-360, US_DST),
+    'America/Denver': (-420, US_DST),
+    'America/Phoenix': (-420, None),
+    'America/Los_Angeles': (-480, US_DST),
+    'America/Anchorage': (-540, US_DST),
+    'Pacific/Honolulu': (-600, None),
+    'Europe/London': (0, EU_DST),
+    'Europe/Paris': (60, EU_DST),
+    'Europe/Berlin': (60, EU_DST),
+    'Europe/Helsinki': (120, EU_DST),
+    'Asia/Kolkata': (330, None),
+    'Asia/Tokyo': (540, None),
+    'Australia/Sydney': (600, AU_DST)
+}
+
+def daysFromCivil(year, month, day):
+    """ Days from 1970-01-01 to a date of the proleptic Gregorian calendar """
+
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month - 3 if month > 2 else month + 9) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+def weekday(days):
+    """ Day of the week (Monday = 0) of a day number from daysFromCivil """
+
+    # 1970-01-01 was a Thursday
+    return (days + 3) % 7
+
+def sunday(year, month, week):
+    """ The day number of the week'th Sunday of a month, or of the last one if week is -1 """
+
+    if week > 0:
+        first = daysFromCivil(year, month, 1)
+        return first + (6 - weekday(first)) % 7 + 7 * (week - 1)
+    if month == 12:
+        last = daysFromCivil(year + 1, 1, 1) - 1
+    else:
+        last = daysFromCivil(year, month + 1, 1) - 1
+    return last - (weekday(last) + 1) % 7
+
+def gmtime(unix):
+    """ time.gmtime of Unix seconds, whatever the port's epoch """
+
+    return time.gmtime(unix - EPOCH_OFFSET)
+
+def isDst(rule, standard, utc):
+    """ True if DST rule is in effect at utc, in a zone standard seconds ahead of UTC """
+
+    smonth, sweek, sminute, emonth, eweek, eminute, inutc = rule
+    year = gmtime(utc + standard)[0]
+    shift = 0 if inutc else standard
+    start = sunday(year, smonth, sweek) * 86400 + sminute * 60 - shift
+    end = sunday(year, emonth, eweek) * 86400 + eminute * 60 - shift
+    if start < end:
+        return start <= utc < end
+    return utc >= start or utc < end
+
+def utcOffset(zone, utc):
+    """
+    Seconds a zone is ahead of UTC at Unix time utc, daylight saving
+    included. Raises ValueError for a zone not in ZONES.
+    """
+
+    if zone not in ZONES:
+        raise ValueError(f'Unknown time zone {zone}')
+    minutes, rule = ZONES[zone]
+    standard = minutes * 60
+    if rule is not None and isDst(rule, standard, utc):
+        return standard + DST_SAVING
+    return standard
@@ -0,0 +1,208 @@
+"""
+Timings.py - where the time of each HTTP request goes
+
+Net times every request it makes, phase by phase, with ticks_us:
+
+dns      looking up the host (0 when the connection was reused)
+connect  the TCP connect (0 when reused)
+tls      the TLS handshake (0 when reused or plain http)
+send     writing the request
+ttfb     from the request being sent to the response head arriving
+body     reading the body off the connection
+parse    the rest of the time until the response was closed - parsing
+         the JSON and building the rows from it
+
+Along with the bytes sent and received and whether the connection was
+reused, the last RING_SIZE requests are kept in a ring buffer. summary()
+gives the median (p50) and 95th percentile (p95) of each phase per
+endpoint, for the controller, the log or the web server to show.
+
+Basic usage:
+
+timings = RequestTimings()
+timing = timings.begin('GET', '/ords/c85/pihealth/patients')
+timing.lap('send')
+...
+timing.end()        # keeps it in the ring
+print(timings.summary())
+timings.log()
+"""
+
+import time
+from Log import *
+
+PHASES = ('dns', 'connect', 'tls', 'send', 'ttfb', 'body', 'parse')
+# Number of requests kept
+RING_SIZE = 32
+
+class RequestTiming:
+    """
+    The phase timings (us) of one request, filled in as it goes. lap(phase)
+    adds the time since the previous lap to a phase, and end() hands the
+    request to the RequestTimings that began it.
+    """
+
+    def __init__(self, method, endpoint, owner=None):
+        self._owner = owner
+        self.method = method
+        self.endpoint = endpoint
+        self.us = [0] * len(PHASES)
+        self.reused = False
+        self.sent = 0
+        self.received = 0
+        self.status = None
+        self.ok = True
+        self._start = time.ticks_us()
+        self._last = self._start
+        self._bodystart = None
+        self.total = 0
+
+    def lap(self, phase):
+        now = time.ticks_us()
+        self.us[PHASES.index(phase)] += time.ticks_diff(now, self._last)
+        self._last = now
+
+    def add(self, phase, us):
+        """ Add us to a phase without starting a new lap """
+
+        self.us[PHASES.index(phase)] += us
+
+    def startBody(self):
+        """ Called once the response head has arrived, before the body is read """
+
+        self.lap('ttfb')
+        self._bodystart = self._last
+
+    def finish(self):
+        """
+        End the request. The time since the head arrived that was not spent
+        reading the body goes to parse; if the head never arrived, the time
+        since the last lap was spent waiting for it.
+        """
+
+        now = time.ticks_us()
+        if self._bodystart is None:
+            self.lap('ttfb')
+        else:
+            parse = time.ticks_diff(now, self._bodystart) - self.us[PHASES.index('body')]
+            self.us[PHASES.index('parse')] = max(0, parse)
+        self.total = time.ticks_diff(now, self._start)
+
+    def end(self, ok=True):
+        """ Finish timing the request and record it. Only the first call counts. """
+
+        if self._owner is None:
+            return
+        if not ok:
+            self.ok = False
+        owner = self._owner
+        self._owner = None
+        owner.record(self)
+
+    def asDict(self):
+        result = {'method': self.method, 'endpoint': self.endpoint, 'status': self.status,
+                  'ok': self.ok, 'reused': self.reused, 'sent': self.sent,
+                  'received': self.received, 'total_ms': self.total / 1000}
+        for i in range(len(PHASES)):
+            result[PHASES[i] + '_ms'] = self.us[i] / 1000
+        return result
+
+def percentile(ordered, fraction):
+    """ The value at fraction (0-1) of a sorted list """
+
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class RequestTimings:
+    """
+    A fixed-size ring buffer of the timings of the most recent requests.
+    """
+
+    def __init__(self, size=RING_SIZE):
+        self._ring = [None] * size
+        self._next = 0
+        self.recorded = 0
+
+    def begin(self, method, endpoint):
+        """ Start timing a request to endpoint (a URL path without its id) """
+
+        return RequestTiming(method, endpoint, self)
+
+    def record(self, timing):
+        """ Finish timing a request and keep it, dropping the oldest if the ring is full """
+
+        timing.finish()
+        self._ring[self._next] = timing
+        self._next = (self._next + 1) % len(self._ring)
+        self.recorded += 1
+
+    def recent(self, count=None):
+        """ The timings kept, newest first, as dictionaries """
+
+        result = []
+        for i in range(len(self._ring)):
+            timing = self._ring[(self._next - 1 - i) % len(self._ring)]
+            if timing is None or (count is not None and len(result) >= count):
+                break
+            result.append(timing.asDict())
+        return result
+
+    def summary(self):
+        """
+        Get a dictionary of endpoint -> {'count', 'failed', 'reused',
+        'bytes' (mean received), 'p50' and 'p95'}, where p50 and p95 are
+        dictionaries of phase (and 'total') -> ms over the requests kept
+        that succeeded.
+        """
+
+        groups = {}
+        for timing in self._ring:
+            if timing is not None:
+                groups.setdefault(timing.endpoint, []).append(timing)
+        result = {}
+        for endpoint in groups:
+            timings = groups[endpoint]
+            good = [t for t in timings if t.ok]
+            entry = {
+                'count': len(timings),
+                'failed': len(timings) - len(good),
+                'reused': len([t for t in timings if t.reused]),
+                'bytes': sum(t.received for t in timings) // len(timings),
+                'p50': {},
+                'p95': {}
+            }
+            if good:
+                for i in range(len(PHASES) + 1):
+                    if i < len(PHASES):
+                        name = PHASES[i]
+                        ordered = sorted(t.us[i] for t in good)
+                    else:
+                        name = 'total'
+                        ordered = sorted(t.total for t in good)
+                    entry['p50'][name] = percentile(ordered, 0.5) / 1000
+                    entry['p95'][name] = percentile(ordered, 0.95) / 1000
+            result[endpoint] = entry
+        return result
+
+    def format(self):
+        """ The summary as lines of text: one per endpoint with p50/p95 ms per phase """
+
+        lines = []
+        summary = self.summary()
+        for endpoint in summary:
+            entry = summary[endpoint]
+            lines.append(f"{endpoint}: {entry['count']} requests, {entry['failed']} failed, "
+                         f"{entry['reused']} reused, {entry['bytes']} bytes")
+            for name in entry['p50']:
+                lines.append(f"  {name:>7} p50 {entry['p50'][name]:8.1f} ms  p95 {entry['p95'][name]:8.1f} ms")
+        return '\n'.join(lines)
+
+    def log(self):
+        """ Log the summary """
+
+        for line in self.format().split('\n'):
+            if line:
+                Log.i(f'Timings: {line}')
+
+    def clear(self):
+        self._ring = [None] * len(self._ring)
+        self._next = 0
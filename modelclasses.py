@@ -87,8 +87,10 @@ class HealthAssessments:
                           (e.g., 'Y' for yes, 'N' for no).
         """
         self._assessment_id = assessment_id
+        self._patient_id = patient_id
         self._result = result
         self._datetime = datetime
+        self._reviewed = reviewed
 
     def line1(self):
         """